@@ -0,0 +1,219 @@
+"""Slot reservations at the gate
+
+An entry is only let in once a specific free slot has been reserved for the
+card, so two gates (or two handler workers) can never admit more cars than
+there are slots. The gate reply names the slot to drive to.
+
+A reservation is a claim on the slot row, made with one conditional UPDATE
+inside the caller's write transaction:
+
+    reserved_by     the card
+    reserved_until  epoch seconds the claim lasts (0 when unreserved)
+
+When the slot's sensor reports it occupied, the reservation is confirmed
+and cleared (confirm()). A card leaving gives back a slot it never parked
+in (release()). If the car never arrives, the claim lapses after
+RESERVATION_TTL seconds: it can be taken over at once, and expire() clears
+lapsed claims from the table. The Allocator clears a lot's lapsed claims
+whenever it refills, so whichever process serves the gates keeps the table
+clean; the MQTT handler also expires them in its resync loop.
+
+Each process keeps an Allocator with a set of slot ids it believes are
+free in each lot, so picking a candidate is O(1). The set is only a hint
+(other processes reserve too). The database claim decides, and a lot whose
+set runs dry is refilled from the idx_slots_free index.
+"""
+import argparse
+import os
+import threading
+
+import db
+import metrics
+import migrations
+import timestamps
+
+# Seconds a driver has to reach the reserved slot
+RESERVATION_TTL = int(os.environ.get('PARKING_RESERVATION_TTL', '300'))
+
+# Free slots loaded into a lot's set when it runs dry
+REFILL = 64
+
+# The card's own live reservation in the lot, renewed, so a repeated read
+# doesn't take a second slot
+_RENEW = '''
+    UPDATE slots SET reserved_until = ?
+    WHERE reserved_by = ? AND lot_id = ? AND reserved_until > ?
+    RETURNING slot_id
+'''
+
+_CLAIM = '''
+    UPDATE slots SET reserved_by = ?, reserved_until = ?
+    WHERE lot_id = ? AND slot_id = ? AND status = 'free' AND reserved_until <= ?
+'''
+
+_FREE = '''
+    SELECT slot_id FROM slots
+    WHERE lot_id = ? AND status = 'free' AND reserved_until <= ?
+    LIMIT ?
+'''
+
+
+class Full(Exception):
+    """Every slot in the lot is occupied or reserved"""
+
+
+class UnknownLot(Exception):
+    pass
+
+
+class Allocator:
+    """Reserves slots for entries; one per process"""
+
+    def __init__(self, ttl=RESERVATION_TTL, refill=REFILL):
+        self.ttl = ttl
+        self.refill = refill
+        self._lock = threading.Lock()
+        self._free = {}    # lot_id -> set of slot ids believed free
+
+    def _candidate(self, lot_id):
+        with self._lock:
+            free = self._free.get(lot_id)
+            return free.pop() if free else None
+
+    def _load(self, cur, lot_id, now):
+        expire(cur, now, lot_id)
+        cur.execute(_FREE, (lot_id, now, self.refill))
+        slot_ids = [row[0] for row in cur.fetchall()]
+        with self._lock:
+            self._free.setdefault(lot_id, set()).update(slot_ids)
+        return bool(slot_ids)
+
+    def reserve(self, cur, lot_id, rfid, now):
+        """Reserve a free slot in the lot for the card; returns its slot id
+
+        Must run inside a write transaction (db.transaction). Returns None
+        for a lot without slots, which takes any number of cars. Raises Full
+        if no slot is free and UnknownLot for a lot that doesn't exist.
+        """
+        until = now + self.ttl
+        cur.execute(_RENEW, (until, rfid, lot_id, now))
+        row = cur.fetchone()
+        if row is not None:
+            metrics.slot_reservations.inc('renewed')
+            return row[0]
+
+        while True:
+            slot_id = self._candidate(lot_id)
+            if slot_id is None:
+                # Under the write lock the reload sees every committed claim,
+                # so the first of these slots is as good as taken
+                if self._load(cur, lot_id, now):
+                    continue
+                break
+            cur.execute(_CLAIM, (rfid, until, lot_id, slot_id, now))
+            if cur.rowcount:
+                metrics.slot_reservations.inc('reserved')
+                return slot_id
+            # Taken by another process, or no longer free
+
+        cur.execute("SELECT capacity FROM lots WHERE lot_id = ?", (lot_id,))
+        row = cur.fetchone()
+        if row is None:
+            raise UnknownLot(lot_id)
+        if row[0] == 0:
+            return None
+        metrics.slot_reservations.inc('full')
+        raise Full(lot_id)
+
+    def slot_changed(self, lot_id, slot_id, status):
+        """Track a slot status change this process has seen"""
+        with self._lock:
+            free = self._free.get(lot_id)
+            if free is None:
+                return
+            if status == 'free':
+                free.add(slot_id)
+            else:
+                free.discard(slot_id)
+
+    def forget(self, lot_id=None):
+        """Drop the candidate slots of one lot, or of all, e.g. after lot changes"""
+        with self._lock:
+            if lot_id is None:
+                self._free.clear()
+            else:
+                self._free.pop(lot_id, None)
+
+
+def confirm(cur, lot_id, slot_id):
+    """Clear the slot's reservation once a car is in it; False if it had none"""
+    cur.execute('''
+        UPDATE slots SET reserved_by = NULL, reserved_until = 0
+        WHERE lot_id = ? AND slot_id = ? AND reserved_by IS NOT NULL
+    ''', (lot_id, slot_id))
+    if not cur.rowcount:
+        return False
+    metrics.slot_reservations.inc('confirmed')
+    return True
+
+
+def release(cur, lot_id, rfid):
+    """Give back the slot reserved for the card in the lot, if any"""
+    cur.execute('''
+        UPDATE slots SET reserved_by = NULL, reserved_until = 0
+        WHERE reserved_by = ? AND lot_id = ?
+    ''', (rfid, lot_id))
+    if cur.rowcount:
+        metrics.slot_reservations.inc('released', amount=cur.rowcount)
+
+
+def expire(cur, now, lot_id=None):
+    """Clear reservations that lapsed, in one lot or all; returns [(lot_id, slot_id)] freed"""
+    if lot_id is None:
+        cur.execute('''
+            UPDATE slots SET reserved_by = NULL, reserved_until = 0
+            WHERE reserved_by IS NOT NULL AND reserved_until <= ?
+            RETURNING lot_id, slot_id
+        ''', (now,))
+    else:
+        # A range of idx_slots_free: reserved and lapsed, in this lot
+        cur.execute('''
+            UPDATE slots SET reserved_by = NULL, reserved_until = 0
+            WHERE lot_id = ? AND status = 'free' AND reserved_until BETWEEN 1 AND ?
+            RETURNING lot_id, slot_id
+        ''', (lot_id, now))
+    expired = [(row[0], row[1]) for row in cur.fetchall()]
+    if expired:
+        metrics.slot_reservations.inc('expired', amount=len(expired))
+    return expired
+
+
+def reservations(cur, lot_id, now):
+    """Live reservations in the lot as (slot_id, rfid, reserved_until) rows"""
+    cur.execute('''
+        SELECT slot_id, reserved_by, reserved_until FROM slots
+        WHERE lot_id = ? AND status = 'free' AND reserved_until > ?
+        ORDER BY reserved_until
+    ''', (lot_id, now))
+    return cur.fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List or expire slot reservations")
+    parser.add_argument('--lot', help="list the live reservations in this lot")
+    parser.add_argument('--expire', action='store_true', help="clear lapsed reservations")
+    args = parser.parse_args()
+
+    conn = db.open_connection()
+    try:
+        migrations.migrate(conn)
+        now = timestamps.now()
+        if args.expire:
+            with db.transaction(conn):
+                expired = expire(conn.cursor(), now)
+            print(f"{len(expired)} reservation(s) expired")
+        if args.lot:
+            for slot_id, rfid, until in reservations(conn.cursor(), args.lot, now):
+                print(f"slot {slot_id}: {rfid} for {until - now} more seconds")
+    finally:
+        conn.close()
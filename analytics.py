@@ -0,0 +1,346 @@
+"""Parking analytics: slot history and time-series rollups
+
+Every slot status change is kept in slot_events. Entries, exits, revenue,
+dwell times and slot occupancy are added to rollups at minute, hour and day
+granularity as they happen, in the same transaction as the write they
+describe:
+
+    lot_rollups    per lot and bucket
+    slot_rollups   per slot and bucket: status changes and occupancy
+
+so a chart reads a few hundred rollup rows instead of scanning the logs.
+Buckets follow local time (PARKING_UTC_OFFSET_MINUTES, by default the
+server's offset): a day bucket starts at local midnight.
+
+Occupancy is stored as change: occupancy_change is the net change in
+occupied slots during the bucket and occupied_seconds the slot-seconds
+those changes add up to by the bucket's end. The occupancy at any moment is
+the sum of every earlier change, which series() takes from day, then hour,
+then minute rows, so old minute rows can be pruned.
+
+Rebuild rollups from logs and slot_events, a day per transaction, after
+importing history or upgrading (tariff.rebill() keeps revenue current
+itself):
+
+    python analytics.py --backfill
+    python analytics.py --backfill --from 2026-01-01 --to 2026-02-01
+    python analytics.py --prune        # minute rollups older than PARKING_MINUTE_ROLLUP_DAYS
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+import db
+import lots
+import migrations
+import timestamps
+from occupancy import OCCUPIED
+
+GRANULARITIES = {'minute': 60, 'hour': 3600, 'day': 86400}
+DAY = GRANULARITIES['day']
+
+UTC_OFFSET = int(os.environ.get('PARKING_UTC_OFFSET_MINUTES', time.localtime().tm_gmtoff // 60)) * 60
+
+# Minute rollups are only kept this long; hour and day rollups are kept forever
+MINUTE_RETENTION_DAYS = int(os.environ.get('PARKING_MINUTE_ROLLUP_DAYS', '30'))
+
+# Most buckets one series() call returns
+MAX_POINTS = 10000
+
+# Dwell-time histogram columns, each counting stays shorter than its limit
+# (seconds) and at least as long as the one before
+DWELL_BINS = (
+    ('dwell_15m', 15 * 60),
+    ('dwell_1h', 3600),
+    ('dwell_3h', 3 * 3600),
+    ('dwell_6h', 6 * 3600),
+    ('dwell_24h', 86400),
+    ('dwell_over_24h', None),
+)
+
+_KEYS = {
+    'lot_rollups': ('lot_id',),
+    'slot_rollups': ('lot_id', 'slot_id'),
+}
+
+
+def bucket_start(at, size):
+    """Start (epoch seconds) of the bucket of `size` seconds holding `at`"""
+    return (at + UTC_OFFSET) // size * size - UTC_OFFSET
+
+
+def dwell_bin(duration):
+    for column, limit in DWELL_BINS:
+        if limit is None or duration < limit:
+            return column
+
+
+def _add(cur, table, key, at, change=0, **values):
+    """Add `values` to the rollup rows holding `at`, at every granularity
+
+    `key` is the lot_id, or (lot_id, slot_id) for slot_rollups. A `change`
+    in occupancy at `at` also adds the slot-seconds it makes up in each
+    bucket.
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    if change:
+        values['occupancy_change'] = change
+        values['occupied_seconds'] = 0
+    primary = (*_KEYS[table], 'granularity', 'bucket')
+    columns = (*primary, *values)
+    sql = f'''
+        INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+        ON CONFLICT ({', '.join(primary)}) DO UPDATE SET
+            {', '.join(f'{column} = {column} + excluded.{column}' for column in values)}
+    '''
+    rows = []
+    for size in GRANULARITIES.values():
+        bucket = bucket_start(at, size)
+        if change:
+            values['occupied_seconds'] = change * (bucket + size - at)
+        rows.append((*key, size, bucket, *values.values()))
+    cur.executemany(sql, rows)
+
+
+def record_entry(cur, lot_id, at):
+    _add(cur, 'lot_rollups', lot_id or lots.DEFAULT_LOT, at, entries=1)
+
+
+def record_exit(cur, lot_id, at, duration, amount):
+    _add(cur, 'lot_rollups', lot_id or lots.DEFAULT_LOT, at, exits=1,
+         revenue=amount or 0, dwell_seconds=duration, **{dwell_bin(duration): 1})
+
+
+def adjust_revenue(cur, lot_id, at, delta):
+    """Change the revenue of an exit at `at` after it was re-billed
+
+    Only rollup rows that exist are changed, so pruned minute rows stay gone.
+    """
+    lot_id = lot_id or lots.DEFAULT_LOT
+    cur.executemany('''
+        UPDATE lot_rollups SET revenue = revenue + ?
+        WHERE granularity = ? AND lot_id = ? AND bucket = ?
+    ''', [(delta, size, lot_id, bucket_start(at, size)) for size in GRANULARITIES.values()])
+
+
+def record_slot(cur, lot_id, slot_id, previous, status, at):
+    """Keep a slot's change from `previous` to `status` in the history and rollups"""
+    cur.execute('''
+        INSERT INTO slot_events (lot_id, slot_id, previous, status, at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (lot_id, slot_id, previous, status, at))
+    change = (status == OCCUPIED) - (previous == OCCUPIED)
+    _add(cur, 'slot_rollups', (lot_id, slot_id), at, change, changes=1)
+    if change:
+        _add(cur, 'lot_rollups', lot_id, at, change)
+
+
+def _dwell_columns(duration):
+    bins = []
+    low = 0
+    for column, limit in DWELL_BINS:
+        high = f' AND {duration} < {limit}' if limit is not None else ''
+        bins.append(f'({duration} >= {low}{high}) AS {column}')
+        low = limit
+    return ', '.join(bins)
+
+
+_BUCKET = '(at + :offset) / :size * :size - :offset'
+_BINS = ', '.join(column for column, _ in DWELL_BINS)
+_NO_BINS = ', '.join(f'0 AS {column}' for column, _ in DWELL_BINS)
+
+# One granularity's lot rollups for [:start, :end), from the logs and slot
+# history. The range must be whole buckets.
+_REBUILD_LOTS = f'''
+    INSERT INTO lot_rollups (lot_id, granularity, bucket, entries, exits, revenue,
+                             dwell_seconds, {_BINS}, occupancy_change, occupied_seconds)
+    SELECT lot_id, :size, bucket, SUM(entries), SUM(exits), SUM(revenue), SUM(dwell_seconds),
+           {', '.join(f'SUM({column})' for column, _ in DWELL_BINS)},
+           SUM(change), SUM(change * (bucket + :size - at))
+    FROM (
+        SELECT *, {_BUCKET} AS bucket FROM (
+            SELECT COALESCE(lot_id, :default_lot) AS lot_id, in_time AS at, 1 AS entries,
+                   0 AS exits, 0 AS revenue, 0 AS dwell_seconds, {_NO_BINS}, 0 AS change
+            FROM all_logs WHERE in_time >= :start AND in_time < :end
+            UNION ALL
+            SELECT COALESCE(lot_id, :default_lot), out_time, 0, 1, COALESCE(amount, 0),
+                   COALESCE(duration, 0), {_dwell_columns('COALESCE(duration, 0)')}, 0
+            FROM all_logs WHERE out_time >= :start AND out_time < :end
+            UNION ALL
+            SELECT lot_id, at, 0, 0, 0, 0, {_NO_BINS},
+                   (status IS '{OCCUPIED}') - (previous IS '{OCCUPIED}')
+            FROM slot_events WHERE at >= :start AND at < :end
+        )
+    )
+    GROUP BY lot_id, bucket
+'''
+
+_REBUILD_SLOTS = f'''
+    INSERT INTO slot_rollups (lot_id, slot_id, granularity, bucket, changes,
+                              occupancy_change, occupied_seconds)
+    SELECT lot_id, slot_id, :size, bucket, COUNT(*), SUM(change), SUM(change * (bucket + :size - at))
+    FROM (
+        SELECT lot_id, slot_id, at, {_BUCKET} AS bucket,
+               (status IS '{OCCUPIED}') - (previous IS '{OCCUPIED}') AS change
+        FROM slot_events WHERE at >= :start AND at < :end
+    )
+    GROUP BY lot_id, slot_id, bucket
+'''
+
+
+def rebuild_day(conn, day):
+    """Recompute every rollup of the day starting at `day` (a day bucket start)
+
+    Runs in one transaction, so writes for that day made meanwhile are
+    either counted here or added after it, never both.
+    """
+    params = {'start': day, 'end': day + DAY, 'offset': UTC_OFFSET,
+              'default_lot': lots.DEFAULT_LOT}
+    with db.transaction(conn):
+        for table in _KEYS:
+            conn.execute(f'DELETE FROM {table} WHERE bucket >= ? AND bucket < ?', (day, day + DAY))
+        for size in GRANULARITIES.values():
+            conn.execute(_REBUILD_LOTS, dict(params, size=size))
+            conn.execute(_REBUILD_SLOTS, dict(params, size=size))
+
+
+def backfill(start=None, end=None, conn=None):
+    """Rebuild rollups for the days in [start, end), by default all history
+
+    Returns the number of days rebuilt.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+    migrations.migrate(conn)
+
+    try:
+        if start is None:
+            start = conn.execute('''
+                SELECT MIN(first) FROM (
+                    SELECT MIN(in_time) AS first FROM all_logs
+                    UNION ALL SELECT MIN(at) FROM slot_events
+                )
+            ''').fetchone()[0]
+            if start is None:
+                return 0
+        if end is None:
+            end = timestamps.now() + 1
+        days = 0
+        for day in range(bucket_start(start, DAY), end, DAY):
+            rebuild_day(conn, day)
+            days += 1
+            if days % 30 == 0:
+                print(f"Rebuilt {days} days")
+        return days
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def prune(conn, days=MINUTE_RETENTION_DAYS):
+    """Drop minute rollups older than `days`; returns the rows deleted"""
+    cutoff = bucket_start(timestamps.now() - days * DAY, DAY)
+    deleted = 0
+    for table in _KEYS:
+        with db.transaction(conn):
+            deleted += conn.execute(f'''
+                DELETE FROM {table} WHERE granularity = ? AND bucket < ?
+            ''', (GRANULARITIES['minute'], cutoff)).rowcount
+    return deleted
+
+
+def occupancy_at(conn, table, key, at):
+    """Occupied slots (or 0/1 for one slot) at `at`, which starts a minute
+
+    Sums whole days before `at`, then hours, then minutes.
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    where = ' AND '.join(f'{column} = ?' for column in _KEYS[table])
+    day = bucket_start(at, DAY)
+    hour = bucket_start(at, GRANULARITIES['hour'])
+    row = conn.execute(f'''
+        SELECT COALESCE(SUM(occupancy_change), 0) FROM {table}
+        WHERE {where} AND (
+            (granularity = ? AND bucket < ?)
+            OR (granularity = ? AND bucket >= ? AND bucket < ?)
+            OR (granularity = ? AND bucket >= ? AND bucket < ?))
+    ''', (*key, DAY, day, GRANULARITIES['hour'], day, hour,
+          GRANULARITIES['minute'], hour, at)).fetchone()
+    return row[0]
+
+
+def series(conn, lot_id, granularity, start, end, slot_id=None):
+    """One dict per bucket in [start, end) for a lot, or one of its slots
+
+    Empty buckets are included. `occupancy` is the average number of
+    occupied slots over the bucket (for a slot, the share of the time it was
+    occupied) and `occupied` the number at its end. Raises ValueError for an
+    unknown granularity or a range of more than MAX_POINTS buckets.
+    """
+    size = GRANULARITIES.get(granularity)
+    if size is None:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    start = bucket_start(start, size)
+    if (end - start) / size > MAX_POINTS:
+        raise ValueError(f"more than {MAX_POINTS} {granularity} buckets; use a longer granularity")
+
+    if slot_id is None:
+        table, key = 'lot_rollups', (lot_id,)
+    else:
+        table, key = 'slot_rollups', (lot_id, slot_id)
+    where = ' AND '.join(f'{column} = ?' for column in _KEYS[table])
+    rows = {row['bucket']: row for row in conn.execute(f'''
+        SELECT * FROM {table}
+        WHERE granularity = ? AND {where} AND bucket >= ? AND bucket < ?
+    ''', (size, *key, start, end))}
+
+    level = occupancy_at(conn, table, key, start)
+    points = []
+    for bucket in range(start, end, size):
+        row = rows.get(bucket)
+        point = {'time': bucket}
+        if row is None:
+            point['occupancy'] = level
+        else:
+            point['occupancy'] = round(level + row['occupied_seconds'] / size, 3)
+            level += row['occupancy_change']
+        point['occupied'] = level
+        if slot_id is not None:
+            point['changes'] = row['changes'] if row else 0
+        else:
+            exits = row['exits'] if row else 0
+            point.update(
+                entries=row['entries'] if row else 0,
+                exits=exits,
+                revenue=row['revenue'] if row else 0,
+                average_dwell=round(row['dwell_seconds'] / exits) if exits else None,
+                dwell={column: row[column] if row else 0 for column, _ in DWELL_BINS},
+            )
+        points.append(point)
+    return points
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild or prune parking analytics rollups")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--backfill', action='store_true',
+                        help="rebuild rollups from the logs and slot history")
+    action.add_argument('--prune', action='store_true',
+                        help=f"drop minute rollups older than {MINUTE_RETENTION_DAYS} days")
+    parser.add_argument('--from', dest='start', help="first day to rebuild, YYYY-MM-DD (local time)")
+    parser.add_argument('--to', dest='end', help="day after the last one to rebuild, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    if args.backfill:
+        start = timestamps.from_datetime(datetime.strptime(args.start, "%Y-%m-%d")) if args.start else None
+        end = timestamps.from_datetime(datetime.strptime(args.end, "%Y-%m-%d")) if args.end else None
+        print(f"Rebuilt rollups for {backfill(start, end)} days")
+    else:
+        conn = db.open_connection()
+        try:
+            migrations.migrate(conn)
+            print(f"Pruned {prune(conn)} minute rollups")
+        finally:
+            conn.close()
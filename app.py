@@ -1,76 +1,64 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, session, flash
+from flask import Flask, Response, abort, g, jsonify, render_template, request, redirect, url_for, session, flash
 import sqlite3
-from datetime import datetime
-import math
-import os
+import collections
+import io
+import queue
+import time
+
+import allocation
+import analytics
+import archive
+import billing
+import db
+import events
+import export
+import gates
+import lots
+import metrics
+import migrations
+import pagination
+import profiler
+import rfid_cache
+import timestamps
+import user_import
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
 
-# Ensure database directory exists
-if not os.path.exists('database'):
-    os.makedirs('database')
-
-def get_db_connection():
-    conn = sqlite3.connect('database/db.sqlite3')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Drop existing tables to ensure clean state
-    cur.execute('DROP TABLE IF EXISTS logs')
-    cur.execute('DROP TABLE IF EXISTS user')
-    cur.execute('DROP TABLE IF EXISTS slots')
-    
-    # Create tables with correct schema
-    cur.execute('''
-        CREATE TABLE user (
-            rfid TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            role TEXT NOT NULL,
-            amount REAL DEFAULT 0.0
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            rfid TEXT NOT NULL,
-            in_time TEXT NOT NULL,
-            out_time TEXT,
-            duration TEXT,
-            amount REAL,
-            payment_status TEXT DEFAULT 'unpaid',
-            FOREIGN KEY (rfid) REFERENCES user (rfid)
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE slots (
-            slot_id INTEGER PRIMARY KEY,
-            status TEXT DEFAULT 'free'
-        )
-    ''')
-    
-    # Create default users
-    cur.execute("INSERT INTO user (rfid, name, role) VALUES (?, ?, ?)", 
-                ('10', 'Owner', 'owner'))
-    cur.execute("INSERT INTO user (rfid, name, role) VALUES (?, ?, ?)", 
-                ('1', 'User', 'user'))
-    
-    # Create 8 slots
-    for i in range(1, 9):
-        cur.execute('INSERT INTO slots (slot_id, status) VALUES (?, ?)', 
-                   (i, 'free'))
-    
-    conn.commit()
-    conn.close()
-
-# Initialize database
-init_db()
+# Bring the schema up to date; a no-op on an existing database
+migrations.migrate()
+
+# Users by RFID for the gate; shared by every request thread
+users = rfid_cache.RfidCache()
+
+# Free-slot hints for reserving a slot at entry
+allocator = allocation.Allocator()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    metrics.begin_db_scope()
+    profiler.begin_scope()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.http_request_seconds.observe(time.perf_counter() - g.request_start,
+                                         route, request.method, response.status_code)
+    metrics.end_db_scope(route)
+    profiler.end_scope(route)
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    # after_request is skipped when a view raises
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.end_db_scope(route)
+    profiler.end_scope(route)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -78,11 +66,11 @@ def login():
         rfid = request.form['rfid']
         role = request.form['role']
 
-        conn = sqlite3.connect('database/db.sqlite3')
+        conn = db.acquire()
         cur = conn.cursor()
         cur.execute("SELECT * FROM user WHERE rfid=? AND role=?", (rfid, role))
         user = cur.fetchone()
-        conn.close()
+        db.release(conn)
 
         if user:
             session['rfid'] = user[0]
@@ -95,6 +83,53 @@ def login():
 
     return render_template('login.html')
 
+# A log row as shown on the page, with times and duration already formatted
+LogRow = collections.namedtuple(
+    'LogRow', 'id rfid name in_time out_time duration amount payment_status')
+
+def owner_logs_page(cur, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """One page of every parking log, archived ones included, newest first"""
+    rows, next_cursor = pagination.fetch_page(cur, '''
+        SELECT logs.id, logs.rfid, user.name, logs.in_time, logs.out_time, 
+               logs.duration, logs.amount, COALESCE(logs.payment_status, 'unpaid') as payment_status
+        FROM all_logs AS logs 
+        LEFT JOIN user ON logs.rfid = user.rfid
+    ''', (), ('logs.in_time', 'logs.id'), cursor, limit)
+
+    logs = [LogRow(
+        log['id'], log['rfid'], log['name'],
+        timestamps.format_timestamp(log['in_time']),
+        timestamps.format_timestamp(log['out_time'], None),
+        timestamps.format_duration(log['duration']) if log['duration'] is not None else None,
+        log['amount'], log['payment_status']
+    ) for log in rows]
+    return logs, next_cursor
+
+def users_page(cur, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """One page of registered users"""
+    return pagination.fetch_page(cur, "SELECT * FROM user", (), ('rfid',), cursor, limit)
+
+def user_history_page(cur, rfid, status, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """One page of a user's own logs with the given payment status"""
+    # Only paid sessions are ever archived
+    table = 'all_logs' if status == 'paid' else 'logs'
+    rows, next_cursor = pagination.fetch_page(cur, f"""
+        SELECT id, rfid, in_time, out_time, duration, amount, 
+               COALESCE(payment_status, 'unpaid') as payment_status
+        FROM {table} 
+        WHERE rfid = ? AND COALESCE(payment_status, 'unpaid') = ?
+    """, (rfid, status), ('in_time', 'id'), cursor, limit, where='AND')
+
+    logs = [{
+        'id': log['id'],
+        'in_time': timestamps.format_timestamp(log['in_time']),
+        'out_time': timestamps.format_timestamp(log['out_time']),
+        'duration': timestamps.format_duration(log['duration']) if log['duration'] is not None else 'N/A',
+        'status': log['payment_status'],
+        'amount': log['amount'] if log['amount'] else 0
+    } for log in rows]
+    return logs, next_cursor
+
 @app.route('/dashboard')
 def dashboard():
     if 'role' not in session:
@@ -104,208 +139,371 @@ def dashboard():
     role = session['role']
     name = session.get('name', '')
 
-    conn = sqlite3.connect('database/db.sqlite3')
+    lot_id = request.args.get('lot', lots.DEFAULT_LOT)
+
+    conn = db.acquire()
     cur = conn.cursor()
 
-    # Get all slots for both views
-    cur.execute("SELECT * FROM slots ORDER BY slot_id")
+    # Both views get the per-lot summary, read from the counters in lots, and
+    # the slots of the lot being viewed
+    all_lots = lots.summary(cur)
+    cur.execute("SELECT slot_id, status FROM slots WHERE lot_id = ? ORDER BY slot_id", (lot_id,))
     all_slots = cur.fetchall()
 
-    # Get all logs for both views
-    cur.execute('''
-        SELECT logs.id, logs.rfid, user.name, logs.in_time, logs.out_time, 
-               logs.duration, logs.amount, COALESCE(logs.payment_status, 'unpaid') as payment_status
-        FROM logs 
-        LEFT JOIN user ON logs.rfid = user.rfid
-        ORDER BY logs.in_time DESC
-    ''')
-    all_logs = cur.fetchall()
-
-    # Get all users for owner view
-    cur.execute("SELECT * FROM user")
-    all_users = cur.fetchall()
-
-    # Prepare user-specific data
-    cur.execute("""
-        SELECT id, rfid, in_time, out_time, duration, amount, 
-               COALESCE(payment_status, 'unpaid') as payment_status
-        FROM logs 
-        WHERE rfid = ? 
-        ORDER BY in_time DESC
-    """, (rfid,))
-    user_logs = cur.fetchall()
-    
-    paid_logs = []
-    unpaid_logs = []
-
-    for log in user_logs:
-        # Get payment status
-        payment_status = log[6]  # payment_status is at index 6
-
-        log_dict = {
-            'id': log[0],
-            'in_time': log[2],
-            'out_time': log[3] if log[3] else 'N/A',
-            'duration': log[4] if log[4] else 'N/A',
-            'status': payment_status,
-            'amount': log[5] if log[5] else 0
-        }
-
-        if payment_status == 'paid':
-            paid_logs.append(log_dict)
-        else:
-            unpaid_logs.append(log_dict)
+    # Only the first page of each list is rendered; the page asks the /api/
+    # endpoints for more with the matching cursor.
+    all_logs, all_users = [], []
+    logs_cursor = users_cursor = None
+    unpaid_logs, paid_logs = [], []
+    unpaid_cursor = paid_cursor = None
+    total = outstanding = session_count = 0
+    last_visit = None
+
+    if role == 'owner':
+        all_logs, logs_cursor = owner_logs_page(cur)
+        all_users, users_cursor = users_page(cur)
+    else:
+        unpaid_logs, unpaid_cursor = user_history_page(cur, rfid, 'unpaid')
+        paid_logs, paid_cursor = user_history_page(cur, rfid, 'paid')
+        totals = billing.totals(cur, rfid)
+        if totals:
+            total = totals['amount'] or 0
+            outstanding = totals['outstanding'] or 0
+            session_count = totals['session_count']
+            last_visit = timestamps.format_timestamp(totals['last_visit'], None)
 
-    total = sum(log['amount'] for log in paid_logs)
-    conn.close()
+    db.release(conn)
 
     return render_template(
         'dashboard.html',
         name=name,
         role=role,
+        lots=all_lots,
+        lot_id=lot_id,
         all_slots=all_slots,
         all_logs=all_logs,
         all_users=all_users,
         user_logs=unpaid_logs,
         paid_logs=paid_logs,
-        total=total
+        total=total,
+        outstanding=outstanding,
+        session_count=session_count,
+        last_visit=last_visit,
+        logs_cursor=logs_cursor,
+        users_cursor=users_cursor,
+        unpaid_cursor=unpaid_cursor,
+        paid_cursor=paid_cursor
     )
 
-def format_duration(seconds):
-    """Convert seconds to hours and minutes format"""
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
-    
-    if hours == 0:
-        if minutes == 0:
-            return f"{seconds} second{'s' if seconds != 1 else ''}"
-        return f"{minutes} minute{'s' if minutes != 1 else ''} {seconds} second{'s' if seconds != 1 else ''}"
-    return f"{hours} hour{'s' if hours != 1 else ''} {minutes} minute{'s' if minutes != 1 else ''}"
-
-def calculate_parking_charge(seconds):
-    """Calculate parking charge based on duration in seconds"""
-    hours = seconds / 3600
-    # First hour or part thereof: ₹50
-    # Each additional hour or part thereof: ₹50
-    if hours <= 1:
-        return 50
-    # Round up to nearest hour
-    rounded_hours = math.ceil(hours)
-    return 50 + ((rounded_hours - 1) * 50)
+def _api_page(fetch):
+    """Serve one page from fetch(cur, cursor, limit) as JSON"""
+    conn = db.acquire()
+    try:
+        items, next_cursor = fetch(conn.cursor(), request.args.get('cursor'),
+                                   pagination.page_size(request.args.get('limit')))
+    except pagination.InvalidCursor as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    finally:
+        db.release(conn)
+    items = [item._asdict() if hasattr(item, '_asdict') else dict(item) for item in items]
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/slots')
+def api_slots():
+    if 'role' not in session:
+        return jsonify({'status': 'error', 'message': 'Login required'}), 401
+
+    lot_id = request.args.get('lot', lots.DEFAULT_LOT)
+    conn = db.acquire()
+    try:
+        # Who a slot is reserved for stays private
+        slots = conn.execute('''
+            SELECT lot_id, slot_id, status, reserved_until > ? AS reserved FROM slots
+            WHERE lot_id = ? ORDER BY slot_id
+        ''', (timestamps.now(), lot_id)).fetchall()
+    finally:
+        db.release(conn)
+    return jsonify({'items': [dict(slot, reserved=bool(slot['reserved'])) for slot in slots]})
+
+@app.route('/api/lots')
+def api_lots():
+    if 'role' not in session:
+        return jsonify({'status': 'error', 'message': 'Login required'}), 401
+
+    conn = db.acquire()
+    try:
+        summary = lots.summary(conn.cursor())
+    finally:
+        db.release(conn)
+    return jsonify({'items': [dict(lot) for lot in summary]})
+
+@app.route('/api/analytics')
+def api_analytics():
+    """Occupancy, traffic, dwell and revenue per minute, hour or day for charts"""
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+
+    lot_id = request.args.get('lot', lots.DEFAULT_LOT)
+    granularity = request.args.get('granularity', 'hour')
+    try:
+        end = export.parse_date(request.args.get('to')) or timestamps.now()
+        start = export.parse_date(request.args.get('from')) or end - 7 * 86400
+        slot_id = int(request.args['slot']) if request.args.get('slot') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'from and to must be YYYY-MM-DD, slot a number'}), 400
+
+    conn = db.acquire()
+    try:
+        points = analytics.series(conn, lot_id, granularity, start, end, slot_id)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    finally:
+        db.release(conn)
+    return jsonify({'lot_id': lot_id, 'slot_id': slot_id, 'granularity': granularity,
+                    'items': points})
+
+def _load_slots():
+    with db.connection() as conn:
+        return conn.execute("SELECT lot_id, slot_id, status FROM slots").fetchall()
+
+@app.route('/events')
+def events_stream():
+    """Server-Sent Events: a snapshot of the slots, then live changes"""
+    if 'role' not in session:
+        return jsonify({'status': 'error', 'message': 'Login required'}), 401
+
+    # Gate events carry the card's RFID and name, which only owners may see
+    show = (lambda event: event) if session['role'] == 'owner' else events.redact
+    # The hub reads the slots once when the first viewer connects; after
+    # that viewers are served from memory
+    try:
+        events.hub.start(_load_slots)
+    except OSError as e:
+        # Only one process can host the hub; another web worker has the port
+        return jsonify({'status': 'error',
+                        'message': f"Live events unavailable: {str(e)}"}), 503
+    sub = events.hub.subscribe(request.headers.get('Last-Event-ID'))
+
+    def stream():
+        try:
+            for event in sub.initial:
+                yield events.format_sse(show(event))
+            while not sub.dropped:
+                try:
+                    event = sub.queue.get(timeout=15)
+                except queue.Empty:
+                    # Keep proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    continue
+                yield events.format_sse(show(event))
+        finally:
+            events.hub.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/logs')
+def api_logs():
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+    return _api_page(owner_logs_page)
+
+@app.route('/debug/queries')
+def debug_queries():
+    """Statements by total time, when running with PARKING_PROFILE=1"""
+    if not profiler.ENABLED:
+        abort(404)
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+    return jsonify({'statements': profiler.report(request.args.get('limit', 20, type=int))})
+
+@app.route('/export/logs')
+def export_logs():
+    """Stream logs as CSV or NDJSON, gzipped if the client accepts it"""
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+
+    fmt = request.args.get('format', 'csv')
+    status = request.args.get('status') or None
+    if fmt not in export.FORMATS:
+        return jsonify({'status': 'error', 'message': 'format must be csv or ndjson'}), 400
+    if status not in (None, 'paid', 'unpaid'):
+        return jsonify({'status': 'error', 'message': 'status must be paid or unpaid'}), 400
+    try:
+        start = export.parse_date(request.args.get('from'))
+        end = export.parse_date(request.args.get('to'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'from and to must be YYYY-MM-DD'}), 400
+
+    compress = 'gzip' in request.accept_encodings
+    body = export.stream(fmt, compress, start=start, end=end,
+                         rfid=request.args.get('rfid') or None, status=status)
+    headers = {
+        'Content-Disposition': f'attachment; filename=parking-logs.{fmt}',
+        'Vary': 'Accept-Encoding',
+    }
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype=export.FORMATS[fmt], headers=headers)
+
+@app.route('/api/users')
+def api_users():
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+    return _api_page(users_page)
+
+@app.route('/api/history')
+def api_history():
+    if 'role' not in session:
+        return jsonify({'status': 'error', 'message': 'Login required'}), 401
+
+    status = request.args.get('status', 'unpaid')
+    if status not in ('paid', 'unpaid'):
+        return jsonify({'status': 'error', 'message': 'status must be paid or unpaid'}), 400
+    rfid = session['rfid']
+    return _api_page(lambda cur, cursor, limit: user_history_page(cur, rfid, status, cursor, limit))
 
 @app.route('/rfid_auth', methods=['POST'])
 def rfid_auth():
+    """Gate reads from devices; answers in JSON only, since devices have no session"""
     rfid = request.form.get('rfid')
     gate = request.form.get('gate')
+    lot_id = request.form.get('lot_id', lots.DEFAULT_LOT)
+    # Anything but an entry is handled as an exit; label it that way too, so
+    # a missing or made-up gate doesn't add a metrics series
+    gate_label = 'entry' if gate == 'entry' else 'exit'
     
-    conn = sqlite3.connect('database/db.sqlite3')
-    cur = conn.cursor()
-    
-    # Check if RFID exists in database and get user role
-    cur.execute("SELECT role FROM user WHERE rfid = ?", (rfid,))
-    result = cur.fetchone()
+    conn = db.acquire()
     
-    if result:
-        role = result[0]
-        if role == 'owner':
-            flash('Owner RFID cards cannot be used for parking', 'error')
-            conn.close()
+    try:
+        # Check if RFID exists and get user role, usually without a query
+        user = users.lookup(conn, rfid)
+        
+        if not user:
+            metrics.gate_decisions.inc(gate_label, 'unauthorized')
+            return jsonify({'status': 'error', 'message': 'Invalid RFID card'})
+        if user.role == 'owner':
+            metrics.gate_decisions.inc(gate_label, 'unauthorized')
             return jsonify({'status': 'error', 'message': 'Owner RFID cards cannot be used for parking'})
         
         if gate == 'entry':
-            # Create new parking log
-            cur.execute('''
-                INSERT INTO logs (rfid, in_time, payment_status)
-                VALUES (?, datetime('now', 'localtime'), 'unpaid')
-            ''', (rfid,))
-            conn.commit()
-            flash('Entry recorded successfully', 'success')
-        else:  # exit
-            # Update existing log
-            cur.execute('''
-                SELECT id, in_time FROM logs 
-                WHERE rfid = ? AND out_time IS NULL 
-                ORDER BY in_time DESC LIMIT 1
-            ''', (rfid,))
-            log = cur.fetchone()
-            
-            if log:
-                log_id, in_time = log
-                # Calculate duration and amount
-                in_dt = datetime.strptime(in_time, "%Y-%m-%d %H:%M:%S")
-                out_dt = datetime.now()
-                duration_seconds = int((out_dt - in_dt).total_seconds())
-                amount = calculate_parking_charge(duration_seconds)
-                formatted_duration = format_duration(duration_seconds)
-                
-                cur.execute('''
-                    UPDATE logs 
-                    SET out_time = datetime('now', 'localtime'),
-                        duration = ?,
-                        amount = ?
-                    WHERE id = ?
-                ''', (formatted_duration, amount, log_id))
-                conn.commit()
-                flash('Exit recorded successfully', 'success')
-            else:
-                flash('No active parking session found', 'error')
-    else:
-        flash('Invalid RFID card', 'error')
-    
-    conn.close()
-    return jsonify({'status': 'success'})
+            # Reserve a slot for the car and create the parking log together
+            try:
+                with db.transaction(conn):
+                    cur = conn.cursor()
+                    now = timestamps.now()
+                    slot_id = allocator.reserve(cur, lot_id, rfid, now)
+                    gates.open_session(cur, rfid, lot_id, now)
+            except allocation.Full:
+                metrics.gate_decisions.inc('entry', 'full')
+                return jsonify({'status': 'error', 'message': 'Parking lot is full'})
+            except allocation.UnknownLot:
+                metrics.gate_decisions.inc('entry', 'unauthorized')
+                return jsonify({'status': 'error', 'message': 'Unknown parking lot'})
+            metrics.gate_decisions.inc('entry', 'open')
+            return jsonify({'status': 'success', 'message': 'Entry recorded successfully',
+                            'slot_id': slot_id})
+        
+        # exit: close the open session, priced for the card's role
+        with db.transaction(conn):
+            closed = gates.close_session(conn.cursor(), rfid, timestamps.now())
+        if not closed:
+            metrics.gate_decisions.inc('exit', 'unauthorized')
+            return jsonify({'status': 'error', 'message': 'No active parking session found'})
+        metrics.gate_decisions.inc('exit', 'open')
+        return jsonify({'status': 'success', 'message': 'Exit recorded successfully',
+                        'amount': closed.amount, 'duration': closed.duration})
+    finally:
+        db.release(conn)
 
 @app.route('/update_slot_status', methods=['POST'])
 def update_slot_status():
     slot_id = request.form.get('slot_id')
     status = request.form.get('status')
+    lot_id = request.form.get('lot_id', lots.DEFAULT_LOT)
     
-    conn = sqlite3.connect('database/db.sqlite3')
+    conn = db.acquire()
     cur = conn.cursor()
     
     try:
-        cur.execute('''
-            UPDATE slots 
-            SET status = ? 
-            WHERE slot_id = ?
-        ''', (status, slot_id))
+        with db.transaction(conn):
+            cur.execute("SELECT status FROM slots WHERE lot_id = ? AND slot_id = ?", (lot_id, slot_id))
+            row = cur.fetchone()
+            cur.execute('''
+                UPDATE slots 
+                SET status = ? 
+                WHERE lot_id = ? AND slot_id = ?
+            ''', (status, lot_id, slot_id))
+            if row and row['status'] != status:
+                analytics.record_slot(cur, lot_id, int(slot_id), row['status'], status, timestamps.now())
+            # A car in the slot, or the slot closed, ends its reservation
+            if status != 'free':
+                allocation.confirm(cur, lot_id, slot_id)
+        allocator.slot_changed(lot_id, int(slot_id), status)
         
-        conn.commit()
+        events.publish('slot', lot_id=lot_id, slot_id=int(slot_id), status=status, source='owner')
         flash(f'Slot {slot_id} status updated successfully', 'success')
     except Exception as e:
         conn.rollback()
         flash(f'Error updating slot status: {str(e)}', 'error')
     finally:
-        conn.close()
+        db.release(conn)
     
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('dashboard', lot=lot_id))
 
 @app.route('/pay/<int:log_id>')
 def pay(log_id):
     if 'role' not in session or session['role'] != 'user':
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect('database/db.sqlite3')
+    conn = db.acquire()
     cur = conn.cursor()
     
     try:
-        # Update log with payment status
-        cur.execute("""
-            UPDATE logs 
-            SET payment_status = 'paid' 
-            WHERE id = ? AND rfid = ?
-        """, (log_id, session['rfid']))
-        conn.commit()
-        flash('Payment successful', 'success')
+        with db.transaction(conn):
+            paid, _ = billing.pay(cur, session['rfid'], [log_id])
+        if paid:
+            flash('Payment successful', 'success')
+        else:
+            flash('Nothing to pay for this parking log; it may be paid already or still in progress', 'error')
     except Exception as e:
-        conn.rollback()
         flash(f'Error processing payment: {str(e)}', 'error')
     finally:
-        conn.close()
+        db.release(conn)
 
     return redirect(url_for('dashboard'))
 
+@app.route('/api/pay', methods=['POST'])
+def api_pay():
+    """Pay several sessions at once: {"log_ids": [...]} or {"all": true} for every finished one"""
+    if session.get('role') != 'user':
+        return jsonify({'status': 'error', 'message': 'User login required'}), 401
+
+    body = request.get_json(silent=True) or {}
+    log_ids = body.get('log_ids')
+    if body.get('all') is True:
+        log_ids = None
+    elif not isinstance(log_ids, list) or not log_ids \
+            or not all(isinstance(log_id, int) and not isinstance(log_id, bool) for log_id in log_ids):
+        return jsonify({'status': 'error', 'message': 'log_ids must be a non-empty list of ids, or all must be true'}), 400
+
+    conn = db.acquire()
+    try:
+        with db.transaction(conn):
+            paid, amount = billing.pay(conn.cursor(), session['rfid'], log_ids)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Error processing payment: {str(e)}'}), 500
+    finally:
+        db.release(conn)
+
+    # Ids that aren't the user's, are already paid or are still in progress
+    paid_ids = set(paid)
+    skipped = [log_id for log_id in log_ids or [] if log_id not in paid_ids]
+    if not paid:
+        return jsonify({'status': 'error', 'message': 'Nothing to pay', 'paid': [], 'amount': 0,
+                        'skipped': skipped})
+    return jsonify({'status': 'success', 'paid': paid, 'amount': amount, 'skipped': skipped})
+
 @app.route('/update_user', methods=['POST'])
 def update_user():
     if 'role' not in session or session['role'] != 'owner':
@@ -315,18 +513,19 @@ def update_user():
     name = request.form['name']
     role = request.form['role']
 
-    conn = sqlite3.connect('database/db.sqlite3')
+    conn = db.acquire()
     cur = conn.cursor()
     
     try:
         cur.execute("UPDATE user SET name = ?, role = ? WHERE rfid = ?", (name, role, rfid))
         conn.commit()
+        users.invalidate(rfid)
         flash('User updated successfully', 'success')
     except Exception as e:
         conn.rollback()
         flash(f'Error updating user: {str(e)}', 'error')
     finally:
-        conn.close()
+        db.release(conn)
 
     return redirect(url_for('dashboard'))
 
@@ -339,12 +538,14 @@ def add_user():
     name = request.form['name']
     role = request.form['role']
 
-    conn = sqlite3.connect('database/db.sqlite3')
+    conn = db.acquire()
     cur = conn.cursor()
     
     try:
         cur.execute("INSERT INTO user (rfid, name, role) VALUES (?, ?, ?)", (rfid, name, role))
         conn.commit()
+        # Drop a cached "unknown card"
+        users.invalidate(rfid)
         flash('User added successfully', 'success')
     except sqlite3.IntegrityError:
         conn.rollback()
@@ -353,30 +554,53 @@ def add_user():
         conn.rollback()
         flash(f'Error adding user: {str(e)}', 'error')
     finally:
-        conn.close()
+        db.release(conn)
 
     return redirect(url_for('dashboard'))
 
+@app.route('/api/users/import', methods=['POST'])
+def import_users():
+    """Add or update users from CSV (rfid,name,role), as the body or a "file" upload"""
+    if session.get('role') != 'owner':
+        return jsonify({'status': 'error', 'message': 'Owner login required'}), 403
+
+    upload = request.files.get('file')
+    lines = io.TextIOWrapper(upload.stream if upload else request.stream,
+                             encoding='utf-8-sig', newline='')
+    conn = db.acquire()
+    try:
+        result = user_import.import_users(conn, lines)
+    except ValueError as e:
+        # Includes a file that isn't UTF-8
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    finally:
+        db.release(conn)
+    if result['added'] or result['updated']:
+        users.clear()
+    return jsonify(dict(result, status='success'))
+
 @app.route('/delete_user/<rfid>')
 def delete_user(rfid):
     if 'role' not in session or session['role'] != 'owner':
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect('database/db.sqlite3')
-    cur = conn.cursor()
+    conn = db.acquire()
     
     try:
-        # First delete all logs associated with the user
-        cur.execute("DELETE FROM logs WHERE rfid = ?", (rfid,))
-        # Then delete the user
-        cur.execute("DELETE FROM user WHERE rfid = ?", (rfid,))
-        conn.commit()
+        # First delete the user's logs, in batches so gates aren't held up
+        # by a long history
+        archive.delete_logs(conn, rfid)
+        # Then the user, with any session that started meanwhile
+        with db.transaction(conn):
+            conn.execute("DELETE FROM logs WHERE rfid = ?", (rfid,))
+            conn.execute("DELETE FROM user WHERE rfid = ?", (rfid,))
+        users.invalidate(rfid)
         flash('User and associated logs deleted successfully', 'success')
     except Exception as e:
         conn.rollback()
         flash(f'Error deleting user: {str(e)}', 'error')
     finally:
-        conn.close()
+        db.release(conn)
 
     return redirect(url_for('dashboard'))
 
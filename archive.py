@@ -0,0 +1,142 @@
+"""Moving old, settled parking sessions out of the active logs table
+
+Sessions that ended and were paid more than PARKING_RETENTION_DAYS ago are
+copied to the archive database (db.ARCHIVE_PATH, attached to every
+connection as `archive`) and deleted from logs, a small batch per
+transaction, so the table the gates write to stays small. History pages,
+exports and billing checks read the all_logs view, which covers both.
+
+Each batch is copied in one transaction and deleted in the next; a crash in
+between leaves the rows in both places, where all_logs shows them once and
+the next run finishes the move. Archived sessions are final: tariff.py
+re-billing and payments only see the active table.
+
+    python archive.py                       # one pass with the default age
+    python archive.py --days 90 --vacuum
+    python archive.py --loop 3600           # keep archiving every hour
+"""
+import argparse
+import os
+import time
+
+import db
+import migrations
+import timestamps
+
+RETENTION_DAYS = int(os.environ.get('PARKING_RETENTION_DAYS', '180'))
+
+# Sessions moved per transaction, and the pause between batches that lets
+# gate traffic take the write lock
+BATCH_SIZE = 2000
+PAUSE = 0.05
+
+
+def archive_batch(conn, cutoff, last=(-1, 0), batch_size=BATCH_SIZE):
+    """Move the next batch of sessions that were closed and paid before cutoff
+
+    `last` is the (in_time, id) the previous batch ended at. Returns the
+    number of sessions moved and the key to continue from, or None when done.
+    """
+    with db.transaction(conn):
+        rows = conn.execute(f'''
+            SELECT {db.LOG_COLUMNS} FROM main.logs
+            WHERE (in_time, id) > (?, ?) AND in_time < ?
+            ORDER BY in_time, id
+            LIMIT ?
+        ''', (*last, cutoff, batch_size)).fetchall()
+        if not rows:
+            return 0, None
+        settled = [row for row in rows
+                   if row['out_time'] is not None and row['out_time'] < cutoff
+                   and row['payment_status'] == 'paid']
+        conn.executemany(f'''
+            INSERT OR IGNORE INTO archive.logs ({db.LOG_COLUMNS})
+            VALUES ({', '.join('?' * len(rows[0]))})
+        ''', [tuple(row) for row in settled])
+
+    # Only rows that made it into the archive are removed
+    with db.transaction(conn):
+        conn.executemany('''
+            DELETE FROM main.logs
+            WHERE id = ? AND EXISTS (SELECT 1 FROM archive.logs WHERE archive.logs.id = ?)
+        ''', [(row['id'], row['id']) for row in settled])
+
+    return len(settled), (rows[-1]['in_time'], rows[-1]['id'])
+
+
+def run(days=RETENTION_DAYS, batch_size=BATCH_SIZE, conn=None):
+    """Archive every settled session that ended more than `days` ago
+
+    Returns the number of sessions moved.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+    migrations.migrate(conn)
+
+    cutoff = timestamps.now() - days * 86400
+    last = (-1, 0)
+    moved = 0
+    try:
+        while last is not None:
+            count, last = archive_batch(conn, cutoff, last, batch_size)
+            moved += count
+            if count:
+                print(f"Archived {moved} sessions")
+            time.sleep(PAUSE)
+        return moved
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def delete_logs(conn, rfid, batch_size=BATCH_SIZE):
+    """Delete a user's sessions, active and archived, a batch per transaction
+
+    Returns the number of rows deleted.
+    """
+    deleted = 0
+    for table in ('main.logs', 'archive.logs'):
+        while True:
+            with db.transaction(conn):
+                count = conn.execute(f'''
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table} WHERE rfid = ? LIMIT ?
+                    )
+                ''', (rfid, batch_size)).rowcount
+            deleted += count
+            if count < batch_size:
+                break
+            time.sleep(PAUSE)
+    return deleted
+
+
+def vacuum(conn):
+    """Compact the archive file after large moves or deletions"""
+    conn.execute('VACUUM archive')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move old, paid parking sessions to the archive database")
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS,
+                        help=f"archive sessions that ended more than this many days ago (default {RETENTION_DAYS})")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--loop', type=float, metavar='SECONDS',
+                        help="keep running, archiving again every SECONDS")
+    parser.add_argument('--vacuum', action='store_true', help="compact the archive after each pass")
+    args = parser.parse_args()
+
+    conn = db.open_connection()
+    try:
+        while True:
+            moved = run(args.days, args.batch_size, conn)
+            print(f"Archived {moved} sessions older than {args.days} days")
+            if args.vacuum and moved:
+                vacuum(conn)
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
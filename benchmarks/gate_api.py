@@ -0,0 +1,140 @@
+"""Load test for the async gate API (gate_api.py)
+
+Starts `gate_api.py` on a scratch database and opens one connection per
+simulated controller. Every controller sends an entry and then an exit for
+its own card, one request at a time, all of them at once. Reports requests per
+second and latency percentiles, then checks that every card ended with
+exactly one closed session. Needs aiohttp.
+
+    python benchmarks/gate_api.py --controllers 2000
+    python benchmarks/gate_api.py --controllers 2000 --batch 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db
+import lots
+import migrations
+
+PORT = 5301
+
+
+def create_database(path, cards):
+    conn = db.open_connection(path)
+    migrations.migrate(conn)
+    with db.transaction(conn):
+        lots.ensure_lot(conn.cursor(), lots.DEFAULT_LOT, slots=cards)
+        conn.executemany("INSERT INTO user (rfid, name, role) VALUES (?, ?, 'user')",
+                         [(f'G{i}', f'Gate user {i}') for i in range(cards)])
+    conn.close()
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def controller(session, url, cards, latencies, failures):
+    for gate in ('entry', 'exit'):
+        body = {'events': [{'gate': gate, 'rfid': card} for card in cards]}
+        start = time.perf_counter()
+        try:
+            async with session.post(url, json=body) as response:
+                result = await response.json()
+        except Exception as e:
+            failures.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            failures.append(result.get('message'))
+            continue
+        failures.extend(f"{d['rfid']} {d['gate']}: {d['decision']}"
+                        for d in result['decisions'] if d['decision'] != 'open')
+
+
+async def load(url, controllers, batch):
+    import aiohttp
+
+    latencies, failures = [], []
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            controller(session, url, [f'G{i * batch + j}' for j in range(batch)], latencies, failures)
+            for i in range(controllers)))
+        elapsed = time.perf_counter() - start
+    return latencies, failures, elapsed
+
+
+def wait_for_server(url, timeout=15):
+    import urllib.request
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gate API did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--controllers', type=int, default=2000, help="concurrent connections")
+    parser.add_argument('--batch', type=int, default=1, help="cards per request")
+    args = parser.parse_args()
+
+    # Every card gets a slot: the scratch lot has one per card
+    tmp = tempfile.mkdtemp(prefix='gate-api-bench-')
+    path = os.path.join(tmp, 'db.sqlite3')
+    create_database(path, args.controllers * args.batch)
+    env = dict(os.environ, PARKING_DB=path)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'gate_api.py'), '--port', str(PORT)],
+                              env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(f'http://127.0.0.1:{PORT}/metrics')
+        latencies, failures, elapsed = asyncio.run(
+            load(f'http://127.0.0.1:{PORT}/gate', args.controllers, args.batch))
+    finally:
+        server.terminate()
+        server.wait()
+
+    conn = sqlite3.connect(path)
+    closed = conn.execute("SELECT COUNT(DISTINCT rfid) FROM logs WHERE out_time IS NOT NULL").fetchone()[0]
+    sessions = conn.execute("SELECT COUNT(*) FROM logs").fetchone()[0]
+    conn.close()
+
+    latencies.sort()
+    requests = len(latencies)
+    print(json.dumps({
+        'controllers': args.controllers,
+        'events_per_request': args.batch,
+        'requests': requests,
+        'requests_per_second': round(requests / elapsed, 1),
+        'events_per_second': round(requests * args.batch / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+        'failures': len(failures),
+        'cards_closed': closed,
+        'sessions': sessions,
+    }))
+    for failure in failures[:10]:
+        print(f"  {failure}")
+    if failures or closed != args.controllers * args.batch or sessions != closed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
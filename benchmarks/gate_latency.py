@@ -0,0 +1,71 @@
+"""Gate reply latency while the handler is flooded with slot telemetry
+
+Feeds mqtt_handler.on_message directly (no broker): a steady stream of
+parking/slots messages plus RFID entry/exit reads, and reports p50/p99 of
+the time from an RFID message arriving to its gate reply being published.
+
+    python benchmarks/gate_latency.py --telemetry 50000 --swipes 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+os.environ.setdefault('PARKING_DB', os.path.join(tempfile.mkdtemp(prefix='gate-latency-'), 'db.sqlite3'))
+db.configure(os.environ['PARKING_DB'])
+
+import mqtt_handler
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode()
+
+
+class StubClient:
+    def publish(self, topic, payload):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--telemetry', type=int, default=20000,
+                        help="slot messages to send")
+    parser.add_argument('--swipes', type=int, default=200,
+                        help="RFID reads to interleave with them")
+    args = parser.parse_args()
+
+    mqtt_handler.setup()
+    client = StubClient()
+    every = max(1, args.telemetry // max(1, args.swipes))
+
+    start = time.perf_counter()
+    swipes = 0
+    # The handler logs every message; keep that out of the measurement
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.telemetry):
+            status = 'occupied' if (i // 8) % 2 else 'free'
+            mqtt_handler.on_message(client, None, Message('parking/slots', f'{i % 8 + 1}:{status}'))
+            if i % every == 0 and swipes < args.swipes:
+                gate = 'entry' if swipes % 2 == 0 else 'exit'
+                mqtt_handler.on_message(client, None, Message('parking/rfid', f'{gate}:1'))
+                swipes += 1
+        mqtt_handler.shutdown()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.telemetry + swipes} messages in {elapsed:.2f}s")
+    print(f"telemetry lane: {mqtt_handler.telemetry_lane.stats()}")
+    print(f"gate lane: {mqtt_handler.gate_lane.stats()}")
+    print(f"gate latency (ms): {mqtt_handler.gate_latency.percentiles(50, 99)}")
+
+
+if __name__ == '__main__':
+    main()
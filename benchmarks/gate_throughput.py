@@ -0,0 +1,149 @@
+"""Gate-event throughput: per-message connections vs the shared db layer
+
+Replays the SQL that mqtt_handler runs for an entry and an exit against a
+scratch database, once the way the handler used to do it (a fresh
+sqlite3.connect with the default rollback journal per message) and once
+through db.py (pooled WAL connections). Optional reader threads run the
+dashboard's log query at the same time to show lock contention.
+
+    python benchmarks/gate_throughput.py --events 5000 --readers 2
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import migrations
+
+USERS = 200
+
+
+def create_database(path):
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    conn.executemany("INSERT INTO user (rfid, name, role) VALUES (?, ?, 'user')",
+                     [(f'C{i}', f'User {i}') for i in range(USERS)])
+    conn.commit()
+    conn.close()
+
+
+def gate_event(conn, rfid, entry):
+    cur = conn.cursor()
+    if entry:
+        cur.execute("SELECT * FROM user WHERE rfid = ?", (rfid,))
+        cur.fetchone()
+        cur.execute("SELECT COUNT(*) FROM slots WHERE status = 'occupied'")
+        cur.fetchone()
+        cur.execute('''
+            INSERT INTO logs (rfid, in_time, payment_status)
+            VALUES (?, ?, 'unpaid')
+        ''', (rfid, int(time.time())))
+    else:
+        cur.execute('''
+            SELECT * FROM logs
+            WHERE rfid = ? AND out_time IS NULL
+            ORDER BY in_time DESC LIMIT 1
+        ''', (rfid,))
+        log = cur.fetchone()
+        if log:
+            cur.execute('''
+                UPDATE logs
+                SET out_time = ?, duration = ?, amount = ?
+                WHERE id = ?
+            ''', (int(time.time()), 3600, 50, log[0]))
+    conn.commit()
+
+
+def legacy_event(path, rfid, entry):
+    conn = sqlite3.connect(path)
+    try:
+        gate_event(conn, rfid, entry)
+    finally:
+        conn.close()
+
+
+def pooled_event(path, rfid, entry):
+    with db.connection() as conn:
+        gate_event(conn, rfid, entry)
+
+
+def dashboard_reader(connect, stop, errors):
+    while not stop.is_set():
+        try:
+            conn = connect()
+            conn.execute('''
+                SELECT logs.id, logs.rfid, user.name, logs.in_time, logs.out_time
+                FROM logs LEFT JOIN user ON logs.rfid = user.rfid
+                ORDER BY logs.in_time DESC LIMIT 200
+            ''').fetchall()
+            conn.close()
+        except sqlite3.OperationalError:
+            errors.append(1)
+
+
+def run(mode, events, readers):
+    tmp = tempfile.mkdtemp(prefix='gate-bench-')
+    path = os.path.join(tmp, 'db.sqlite3')
+    create_database(path)
+
+    if mode == 'pooled':
+        db.configure(path)
+        handle = pooled_event
+        connect = lambda: db.open_connection(path)
+    else:
+        handle = legacy_event
+        connect = lambda: sqlite3.connect(path, timeout=0.1)
+
+    stop = threading.Event()
+    reader_errors = []
+    threads = [threading.Thread(target=dashboard_reader, args=(connect, stop, reader_errors))
+               for _ in range(readers)]
+    for t in threads:
+        t.start()
+
+    writer_errors = 0
+    start = time.perf_counter()
+    for i in range(events):
+        rfid = f'C{(i // 2) % USERS}'
+        try:
+            handle(path, rfid, entry=(i % 2 == 0))
+        except sqlite3.OperationalError:
+            writer_errors += 1
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    for t in threads:
+        t.join()
+    db.close_all()
+
+    return {
+        'mode': mode,
+        'events': events,
+        'seconds': round(elapsed, 3),
+        'events_per_second': round(events / elapsed, 1),
+        'writer_lock_errors': writer_errors,
+        'reader_lock_errors': len(reader_errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=0)
+    args = parser.parse_args()
+
+    for mode in ('legacy', 'pooled'):
+        result = run(mode, args.events, args.readers)
+        print(f"{result['mode']:>7}: {result['events_per_second']:>9} events/s  "
+              f"({result['seconds']}s, writer lock errors {result['writer_lock_errors']}, "
+              f"reader lock errors {result['reader_lock_errors']})")
+
+
+if __name__ == '__main__':
+    main()
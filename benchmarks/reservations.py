@@ -0,0 +1,182 @@
+"""Stress test for slot reservations (allocation.py)
+
+Several processes, each with several threads and its own connection per
+thread, reserve slots for more cars than the lot holds, all at once, the
+way handler workers and the gate API would. Then:
+
+1. Every slot must have gone to exactly one card, with the rest refused as
+   full.
+2. Sensors confirm half the reservations (the cars parked). The other half
+   are left to lapse after --ttl seconds.
+3. A second wave of new cards must get exactly the lapsed slots and none of
+   the occupied ones.
+
+Reports reservations per second and latency percentiles; exits 1 if any
+check fails.
+
+    python benchmarks/reservations.py --slots 500 --cars 2000 --processes 4 --threads 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import allocation
+import db
+import lots
+import migrations
+import timestamps
+
+
+def create_database(path, slots, cars):
+    conn = db.open_connection(path)
+    migrations.migrate(conn)
+    with db.transaction(conn):
+        lots.ensure_lot(conn.cursor(), lots.DEFAULT_LOT, slots=slots)
+        conn.executemany("INSERT INTO user (rfid, name, role) VALUES (?, ?, 'user')",
+                         [(f'R{i}', f'Car {i}') for i in range(cars)])
+    conn.close()
+
+
+def worker(path, cards, threads, ttl, start_at, results):
+    """One process: `threads` threads sharing an Allocator reserve for `cards`"""
+    allocator = allocation.Allocator(ttl=ttl)
+    outcomes = []
+    lock = threading.Lock()
+
+    def run(part):
+        conn = db.open_connection(path)
+        cur = conn.cursor()
+        mine = []
+        time.sleep(max(0, start_at - time.time()))
+        for card in part:
+            start = time.perf_counter()
+            try:
+                with db.transaction(conn):
+                    slot_id = allocator.reserve(cur, lots.DEFAULT_LOT, card, timestamps.now())
+            except allocation.Full:
+                slot_id = None
+            mine.append((card, slot_id, time.perf_counter() - start))
+        conn.close()
+        with lock:
+            outcomes.extend(mine)
+
+    pool = [threading.Thread(target=run, args=(cards[i::threads],)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(outcomes)
+
+
+def wave(path, cards, processes, threads, ttl):
+    """Reserve for every card at once; returns ([(card, slot_id, seconds)], elapsed)"""
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1
+    workers = [multiprocessing.Process(target=worker,
+                                       args=(path, cards[i::processes], threads, ttl, start_at, results))
+               for i in range(processes)]
+    for process in workers:
+        process.start()
+    outcomes = []
+    for _ in workers:
+        outcomes.extend(results.get())
+    for process in workers:
+        process.join()
+    elapsed = time.time() - start_at
+    return outcomes, elapsed
+
+
+def check_wave(outcomes, expected, allowed, failures, name):
+    """Check admitted cards got distinct slots, all allowed, `expected` of them"""
+    admitted = [(card, slot_id) for card, slot_id, _ in outcomes if slot_id is not None]
+    slot_ids = [slot_id for _, slot_id in admitted]
+    if len(slot_ids) != len(set(slot_ids)):
+        failures.append(f"{name}: {len(slot_ids) - len(set(slot_ids))} slot(s) reserved twice")
+    if len(admitted) != expected:
+        failures.append(f"{name}: {len(admitted)} admitted, expected {expected}")
+    outside = set(slot_ids) - allowed
+    if outside:
+        failures.append(f"{name}: reserved slots that weren't free: {sorted(outside)[:10]}")
+    return admitted
+
+
+def stats(outcomes, elapsed):
+    latencies = sorted(seconds for _, _, seconds in outcomes)
+    return {
+        'reservations': len(outcomes),
+        'per_second': round(len(outcomes) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slots', type=int, default=500)
+    parser.add_argument('--cars', type=int, default=2000, help="cars in each wave")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help="threads per process")
+    parser.add_argument('--ttl', type=int, default=10, help="reservation lifetime in seconds")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='reservations-bench-'), 'db.sqlite3')
+    create_database(path, args.slots, args.cars * 2)
+    failures = []
+    all_slots = set(range(1, args.slots + 1))
+
+    first, first_elapsed = wave(path, [f'R{i}' for i in range(args.cars)],
+                                args.processes, args.threads, args.ttl)
+    admitted = check_wave(first, min(args.slots, args.cars), all_slots, failures, 'first wave')
+
+    # Half the cars park: their sensors confirm the reservation
+    parked = {slot_id for _, slot_id in admitted[::2]}
+    conn = db.open_connection(path)
+    with db.transaction(conn):
+        cur = conn.cursor()
+        for slot_id in parked:
+            cur.execute("UPDATE slots SET status = 'occupied' WHERE lot_id = ? AND slot_id = ?",
+                        (lots.DEFAULT_LOT, slot_id))
+            if not allocation.confirm(cur, lots.DEFAULT_LOT, slot_id):
+                failures.append(f"slot {slot_id} had no reservation to confirm")
+    conn.close()
+
+    # The rest never arrive; their reservations lapse
+    time.sleep(args.ttl + 1)
+    second, second_elapsed = wave(path, [f'R{i}' for i in range(args.cars, args.cars * 2)],
+                                  args.processes, args.threads, args.ttl)
+    free = all_slots - parked
+    check_wave(second, min(len(free), args.cars), free, failures, 'second wave')
+
+    conn = db.open_connection(path)
+    occupied = conn.execute("SELECT occupied FROM lots WHERE lot_id = ?", (lots.DEFAULT_LOT,)).fetchone()[0]
+    conn.close()
+    if occupied != len(parked):
+        failures.append(f"lot counter says {occupied} occupied, expected {len(parked)}")
+
+    print(json.dumps({
+        'slots': args.slots,
+        'cars_per_wave': args.cars,
+        'processes': args.processes,
+        'threads': args.threads,
+        'first_wave': stats(first, first_elapsed),
+        'second_wave': stats(second, second_elapsed),
+        'parked': len(parked),
+        'failures': len(failures),
+    }))
+    for failure in failures[:10]:
+        print(f"  {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
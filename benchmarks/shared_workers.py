@@ -0,0 +1,174 @@
+"""MQTT handler throughput with 1..N workers behind a shared subscription
+
+Needs a local MQTT v5 broker that supports $share (Mosquitto 2, EMQX,
+HiveMQ). For each worker count it starts `mqtt_handler.py --workers N` on a
+scratch database, publishes a mix of slot readings and card reads (every card
+read is sent twice, as a broker would after a crash), and times how long the
+workers take to process it all, from their /metrics counters. It then checks
+that no card read created a duplicate log row.
+
+    python benchmarks/shared_workers.py --workers 1,2,4 --messages 50000
+"""
+import argparse
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db
+import lots
+import migrations
+
+USERS = 2000
+SLOTS = 500
+# Share of messages that are card reads; the rest are slot readings
+RFID_SHARE = 0.1
+METRICS_PORT = 9305
+
+
+def create_database(path):
+    conn = db.open_connection(path)
+    migrations.migrate(conn)
+    with db.transaction(conn):
+        lots.ensure_lot(conn.cursor(), lots.DEFAULT_LOT, slots=SLOTS)
+        conn.executemany("INSERT INTO user (rfid, name, role) VALUES (?, ?, 'user')",
+                         [(f'C{i}', f'User {i}') for i in range(USERS)])
+    conn.close()
+
+
+def traffic(messages, seed):
+    """(topic, payload) pairs; returns them with the number of distinct entries"""
+    rng = random.Random(seed)
+    parked = set()
+    out = []
+    entries = 0
+    while len(out) < messages:
+        if rng.random() < RFID_SHARE:
+            card = f'C{rng.randrange(USERS)}'
+            if card in parked:
+                payload = f'exit:{card}'
+                parked.discard(card)
+            elif len(parked) < SLOTS:
+                payload = f'entry:{card}'
+                parked.add(card)
+                entries += 1
+            else:
+                continue
+            # Sent twice: the second copy stands in for a redelivery
+            out.append(('parking/rfid', payload.encode()))
+            out.append(('parking/rfid', payload.encode()))
+        else:
+            status = rng.choice(('free', 'occupied'))
+            out.append(('parking/slots', f'{rng.randint(1, SLOTS)}:{status}'.encode()))
+    return out, entries
+
+
+def processed(workers):
+    """Messages processed so far, summed over the workers' metrics"""
+    total = 0
+    for i in range(workers):
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{METRICS_PORT + i}/metrics', timeout=1) as r:
+                for line in r.read().decode().splitlines():
+                    if line.startswith('parking_mqtt_event_seconds_count'):
+                        total += float(line.rsplit(' ', 1)[1])
+        except OSError:
+            pass
+    return int(total)
+
+
+def run(workers, messages, host, port, seed, timeout):
+    import paho.mqtt.client as mqtt
+
+    tmp = tempfile.mkdtemp(prefix='shared-bench-')
+    path = os.path.join(tmp, 'db.sqlite3')
+    create_database(path)
+    env = dict(os.environ, PARKING_DB=path, PARKING_MQTT_HOST=host, PARKING_MQTT_PORT=str(port),
+               PARKING_SHARE_GROUP=f'bench{os.getpid()}x{workers}',
+               PARKING_METRICS_PORT=str(METRICS_PORT))
+    msgs, entries = traffic(messages, seed)
+    # Workers drop reads for cards they don't own before processing, so
+    # each message is counted once
+    expected = len(msgs)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+    client.connect(host, port, 60)
+    client.loop_start()
+    handler = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mqtt_handler.py'),
+                                '--workers', str(workers)],
+                               env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while processed(workers) == 0 and time.monotonic() < deadline:
+            # Warm-up readings until the handler is subscribed
+            client.publish('parking/slots', b'1:free', qos=1)
+            time.sleep(0.2)
+        time.sleep(1)
+        baseline = processed(workers)
+
+        start = time.perf_counter()
+        for topic, payload in msgs:
+            client.publish(topic, payload, qos=1)
+        deadline = time.monotonic() + timeout
+        done = processed(workers) - baseline
+        while done < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+            done = processed(workers) - baseline
+        elapsed = time.perf_counter() - start
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        handler.send_signal(signal.SIGINT)
+        handler.wait()
+
+    conn = sqlite3.connect(path)
+    logged = conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+    open_twice = conn.execute('''
+        SELECT COUNT(*) FROM (
+            SELECT rfid FROM logs WHERE out_time IS NULL GROUP BY rfid HAVING COUNT(*) > 1
+        )
+    ''').fetchone()[0]
+    conn.close()
+    return {
+        'workers': workers,
+        'messages': expected,
+        'processed': done,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(done / elapsed, 1),
+        'log_rows': logged,
+        'expected_log_rows': entries,
+        'cards_open_twice': open_twice,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help="comma-separated worker counts")
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    first = None
+    for workers in [int(n) for n in args.workers.split(',')]:
+        result = run(workers, args.messages, args.host, args.port, args.seed, args.timeout)
+        first = first or result['messages_per_second']
+        print(f"{workers:>3} worker(s): {result['messages_per_second']:>9} msg/s "
+              f"(x{result['messages_per_second'] / first:.2f}), "
+              f"{result['processed']}/{result['messages']} processed, "
+              f"{result['log_rows']} log rows for {result['expected_log_rows']} entries, "
+              f"{result['cards_open_twice']} card(s) open twice")
+
+
+if __name__ == '__main__':
+    main()
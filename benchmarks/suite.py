@@ -0,0 +1,290 @@
+"""Benchmark suite for the web and MQTT hot paths
+
+Builds (or reuses) seeded databases of increasing size with
+sample_data.generate_bulk_data, then for each one drives the Flask routes
+through the test client and feeds mqtt_handler messages with a stub client.
+Nothing touches the network. Results (throughput, latency percentiles, peak
+RSS) are written as JSON; pass --baseline to compare against an earlier run
+and exit non-zero on regressions. Each database also gets the query plan
+check (query_plans.py), and the suite exits non-zero if a hot path reads a
+whole table or sorts for ORDER BY.
+
+    python benchmarks/suite.py --sizes 1000,100000,1000000 --output results.json
+    python benchmarks/suite.py --sizes 1000,100000 --baseline results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db
+import query_plans
+import slot_protocol
+
+DATA_DIR = os.path.join(ROOT, 'benchmarks', 'data')
+DAYS = 180
+END = datetime(2026, 1, 1)
+
+# Stand-ins used only when the real templates are not on disk, so the
+# dashboard benchmark still exercises the view's queries and a render
+FALLBACK_TEMPLATES = {
+    'login.html': 'login',
+    'dashboard.html': (
+        '{% for s in all_slots %}{{ s[0] }}{{ s[1] }}{% endfor %}'
+        '{% for l in all_logs %}{{ l[0] }}{{ l[2] }}{{ l[3] }}{{ l[6] }}{% endfor %}'
+        '{% for u in all_users %}{{ u[0] }}{{ u[1] }}{% endfor %}'
+        '{% for l in user_logs %}{{ l.id }}{{ l.in_time }}{{ l.amount }}{% endfor %}'
+        '{% for l in paid_logs %}{{ l.id }}{{ l.in_time }}{{ l.amount }}{% endfor %}'
+        '{{ total }}'
+    ),
+}
+
+
+def database_for(size, seed):
+    """Path to a database with about `size` logs, generating it once"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f'logs-{size}-seed{seed}.sqlite3')
+    if os.path.exists(path):
+        return path
+
+    import sample_data
+
+    tmp = path + '.tmp'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(tmp + suffix):
+            os.remove(tmp + suffix)
+    conn = db.open_connection(tmp)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sample_data.generate_bulk_data(
+            users=max(50, min(size // 100, 20000)), slots=8, days=DAYS, seed=seed,
+            end=END, visits_per_day=size / DAYS, conn=conn)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    os.replace(tmp, path)
+    return path
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(name, fn, iterations):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 3)
+
+    return {
+        'scenario': name,
+        'iterations': iterations,
+        'ops_per_second': round(iterations / elapsed, 1),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def sample_user(path):
+    """The generated card with the longest history, and its unpaid log ids"""
+    conn = db.open_connection(path)
+    try:
+        rfid = conn.execute('''
+            SELECT rfid FROM logs GROUP BY rfid ORDER BY COUNT(*) DESC LIMIT 1
+        ''').fetchone()[0]
+        unpaid = [row[0] for row in conn.execute('''
+            SELECT id FROM logs
+            WHERE rfid = ? AND payment_status = 'unpaid' AND out_time IS NOT NULL
+        ''', (rfid,))]
+    finally:
+        conn.close()
+    return rfid, unpaid
+
+
+def web_scenarios(app, path, iterations):
+    import jinja2
+
+    if not os.path.exists(os.path.join(ROOT, 'templates', 'dashboard.html')):
+        app.jinja_loader = jinja2.DictLoader(FALLBACK_TEMPLATES)
+
+    rfid, unpaid = sample_user(path)
+    owner = app.test_client()
+    with owner.session_transaction() as sess:
+        sess.update(rfid='10', role='owner', name='Owner')
+    user = app.test_client()
+    with user.session_transaction() as sess:
+        sess.update(rfid=rfid, role='user', name='User')
+    device = app.test_client()
+
+    def check(response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+
+    def rfid_auth(i):
+        gate = 'entry' if i % 2 == 0 else 'exit'
+        check(device.post('/rfid_auth', data={'rfid': rfid, 'gate': gate}))
+
+    def pay(i):
+        log_id = unpaid[i % len(unpaid)] if unpaid else 0
+        check(user.get(f'/pay/{log_id}'))
+
+    return [
+        measure('dashboard_owner', lambda i: check(owner.get('/dashboard')), iterations),
+        measure('dashboard_user', lambda i: check(user.get('/dashboard')), iterations),
+        measure('rfid_auth', rfid_auth, iterations),
+        measure('pay', pay, iterations),
+    ]
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else payload.encode()
+
+
+class StubClient:
+    def publish(self, topic, payload):
+        pass
+
+
+def mqtt_scenarios(mqtt_handler, path, iterations):
+    rfid, _ = sample_user(path)
+    client = StubClient()
+
+    def gate(i):
+        event = 'entry' if i % 2 == 0 else 'exit'
+        mqtt_handler.handle_message(client, None, Message('parking/rfid', f'{event}:{rfid}'),
+                                    time.perf_counter())
+
+    def slot(i):
+        status = 'occupied' if (i // 8) % 2 else 'free'
+        mqtt_handler.handle_message(client, None, Message('parking/slots', f'{i % 8 + 1}:{status}'))
+
+    def slot_map(i):
+        # The whole lot in one compact message, as a controller heartbeat
+        statuses = ['occupied' if (i + n) % 3 == 0 else 'free' for n in range(8)]
+        mqtt_handler.handle_message(client, None,
+                                    Message('parking/slots', slot_protocol.encode_bitmap(1, statuses)))
+
+    results = [
+        measure('mqtt_gate', gate, iterations),
+        measure('mqtt_slot', slot, iterations),
+        measure('mqtt_slot_map', slot_map, iterations),
+    ]
+    # Persistence is batched; include the time to drain it
+    start = time.perf_counter()
+    mqtt_handler.writer.stop()
+    results.append({'scenario': 'mqtt_write_flush',
+                    'seconds': round(time.perf_counter() - start, 3),
+                    'writer': mqtt_handler.writer.stats()})
+    return results
+
+
+def run(sizes, seed, iterations):
+    results = []
+    app = mqtt_handler = None
+    for size in sizes:
+        path = database_for(size, seed)
+        # Run against a copy so repeated runs start from the same data
+        work = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'db.sqlite3')
+        with open(path, 'rb') as src, open(work, 'wb') as dst:
+            while True:
+                block = src.read(1 << 20)
+                if not block:
+                    break
+                dst.write(block)
+        db.configure(work)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            if app is None:
+                os.environ['PARKING_DB'] = work
+                from app import app
+                import mqtt_handler
+            mqtt_handler.setup()
+            scenarios = web_scenarios(app, work, iterations)
+            scenarios += mqtt_scenarios(mqtt_handler, work, iterations)
+            mqtt_handler.shutdown()
+
+        # After the timings: the check turns on the profiling cursor while it runs
+        failed = query_plans.check_database(work)
+        scenarios.append({'scenario': 'query_plans', 'failed': failed})
+
+        for scenario in scenarios:
+            scenario['logs'] = size
+            results.append(scenario)
+            print(json.dumps(scenario))
+        db.close_all()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Scenarios whose p50 got more than `tolerance` slower than the baseline"""
+    before = {(r['scenario'], r['logs']): r for r in baseline['results'] if 'p50_ms' in r}
+    regressions = []
+    for r in results:
+        old = before.get((r['scenario'], r['logs']))
+        if old and 'p50_ms' in r and r['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{r['scenario']} @ {r['logs']} logs: "
+                               f"p50 {old['p50_ms']}ms -> {r['p50_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,100000',
+                        help="comma-separated log counts, e.g. 1000,100000,1000000,10000000")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed p50 slowdown vs the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.seed, args.iterations)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': db.sqlite3.sqlite_version,
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    regressions = [f"query plans @ {r['logs']} logs: no index for {', '.join(r['failed'])}"
+                   for r in results if r.get('failed')]
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions += compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Per-user billing totals kept alongside the logs
+
+Each user row carries running totals so balances never need a scan of the
+user's history:
+
+    amount         total paid
+    outstanding    total of finished, unpaid sessions
+    session_count  finished sessions
+    last_visit     out_time of the latest finished session (epoch seconds)
+
+They are updated in the same transaction as the log row they summarise.
+Check them against the logs, or rebuild them, with:
+
+    python billing.py --check
+    python billing.py --rebuild
+"""
+import argparse
+import json
+import sys
+
+import db
+import migrations
+
+# Stored and recomputed money totals closer than this are considered equal
+TOLERANCE = 0.005
+
+# Each total recomputed from logs, correlated with the user row being checked.
+# Outstanding sessions are never archived, so only that one skips all_logs.
+_COMPUTED = {
+    'amount': '''
+        SELECT COALESCE(SUM(logs.amount), 0) FROM all_logs AS logs
+        WHERE logs.rfid = user.rfid AND logs.out_time IS NOT NULL
+          AND logs.payment_status = 'paid'
+    ''',
+    'outstanding': '''
+        SELECT COALESCE(SUM(logs.amount), 0) FROM logs
+        WHERE logs.rfid = user.rfid AND logs.out_time IS NOT NULL
+          AND COALESCE(logs.payment_status, 'unpaid') = 'unpaid'
+    ''',
+    'session_count': '''
+        SELECT COUNT(*) FROM all_logs AS logs
+        WHERE logs.rfid = user.rfid AND logs.out_time IS NOT NULL
+    ''',
+    'last_visit': '''
+        SELECT MAX(logs.out_time) FROM all_logs AS logs
+        WHERE logs.rfid = user.rfid
+    ''',
+}
+
+
+def record_exit(cur, rfid, amount, out_time, paid=False):
+    """Add a just-finished session to the user's totals"""
+    column = 'amount' if paid else 'outstanding'
+    cur.execute(f'''
+        UPDATE user
+        SET {column} = COALESCE({column}, 0) + ?,
+            session_count = session_count + 1,
+            last_visit = MAX(COALESCE(last_visit, 0), ?)
+        WHERE rfid = ?
+    ''', (amount or 0, out_time, rfid))
+
+
+def record_payment(cur, rfid, amount):
+    """Move a paid session's amount from outstanding to total paid"""
+    cur.execute('''
+        UPDATE user
+        SET outstanding = COALESCE(outstanding, 0) - ?,
+            amount = COALESCE(amount, 0) + ?
+        WHERE rfid = ?
+    ''', (amount or 0, amount or 0, rfid))
+
+
+def pay(cur, rfid, log_ids=None):
+    """Mark the card's unpaid sessions paid in one statement
+
+    Pays the given log ids, or every finished unpaid session if log_ids is
+    None. Only finished sessions can be paid: one still in progress has no
+    amount yet, and its exit books the real amount. Ids that aren't the
+    card's finished unpaid sessions are skipped. Returns (ids paid, amount
+    moved from outstanding to paid).
+    """
+    if log_ids is None:
+        condition, params = '', (rfid,)
+    else:
+        condition = 'AND id IN (SELECT value FROM json_each(?))'
+        params = (rfid, json.dumps(list(log_ids)))
+    cur.execute(f'''
+        UPDATE logs
+        SET payment_status = 'paid'
+        WHERE rfid = ? AND COALESCE(payment_status, 'unpaid') = 'unpaid'
+          AND out_time IS NOT NULL {condition}
+        RETURNING id, amount
+    ''', params)
+    rows = cur.fetchall()
+    amount = sum(row['amount'] or 0 for row in rows)
+    if amount:
+        record_payment(cur, rfid, amount)
+    return [row['id'] for row in rows], amount
+
+
+def adjust(cur, rfid, paid_delta=0, outstanding_delta=0):
+    """Apply a change to already-recorded amounts, e.g. after re-billing"""
+    cur.execute('''
+        UPDATE user
+        SET amount = COALESCE(amount, 0) + ?,
+            outstanding = COALESCE(outstanding, 0) + ?
+        WHERE rfid = ?
+    ''', (paid_delta, outstanding_delta, rfid))
+
+
+def totals(cur, rfid):
+    """The user's stored totals, or None for an unknown card"""
+    cur.execute('''
+        SELECT amount, outstanding, session_count, last_visit
+        FROM user WHERE rfid = ?
+    ''', (rfid,))
+    return cur.fetchone()
+
+
+def rebuild(cur, rfid=None):
+    """Recompute totals from logs, for one user or everyone"""
+    assignments = ', '.join(f'{column} = ({sql})' for column, sql in _COMPUTED.items())
+    where = 'WHERE rfid = ?' if rfid is not None else ''
+    cur.execute(f'UPDATE user SET {assignments} {where}', () if rfid is None else (rfid,))
+
+
+def check(cur):
+    """Users whose stored totals disagree with their logs"""
+    computed = ', '.join(f'({sql}) AS computed_{column}' for column, sql in _COMPUTED.items())
+    cur.execute(f'''
+        SELECT * FROM (
+            SELECT rfid, amount, outstanding, session_count, last_visit, {computed}
+            FROM user
+        )
+        WHERE ABS(COALESCE(amount, 0) - computed_amount) > {TOLERANCE}
+           OR ABS(COALESCE(outstanding, 0) - computed_outstanding) > {TOLERANCE}
+           OR session_count != computed_session_count
+           OR last_visit IS NOT computed_last_visit
+    ''')
+    return cur.fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check or rebuild per-user billing totals")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--check', action='store_true',
+                        help="report users whose totals don't match their logs")
+    action.add_argument('--rebuild', action='store_true',
+                        help="recompute every user's totals from the logs")
+    args = parser.parse_args()
+
+    conn = db.open_connection()
+    try:
+        migrations.migrate(conn)
+        if args.rebuild:
+            with db.transaction(conn):
+                rebuild(conn.cursor())
+            print("Billing totals rebuilt")
+        else:
+            mismatches = check(conn.cursor())
+            for row in mismatches:
+                print(f"{row['rfid']}: paid {row['amount']} vs {row['computed_amount']}, "
+                      f"outstanding {row['outstanding']} vs {row['computed_outstanding']}, "
+                      f"sessions {row['session_count']} vs {row['computed_session_count']}, "
+                      f"last visit {row['last_visit']} vs {row['computed_last_visit']}")
+            print(f"{len(mismatches)} user(s) out of step")
+            if mismatches:
+                sys.exit(1)
+    finally:
+        conn.close()
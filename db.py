@@ -0,0 +1,253 @@
+import sqlite3
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import profiler
+
+DB_PATH = os.environ.get('PARKING_DB', 'database/db.sqlite3')
+
+# Connections kept open per process. The web server and the MQTT handler
+# each get their own pool; WAL lets them read while the other one writes.
+POOL_SIZE = int(os.environ.get('PARKING_DB_POOL_SIZE', '8'))
+
+# Milliseconds a writer waits on a locked database before giving up
+BUSY_TIMEOUT_MS = int(os.environ.get('PARKING_DB_BUSY_TIMEOUT_MS', '5000'))
+
+# Number of compiled statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Closed, paid sessions moved out of logs by archive.py live in a second
+# database file, attached to every connection as "archive". Defaults to
+# <database>-archive.sqlite3 next to the main file.
+ARCHIVE_PATH = os.environ.get('PARKING_ARCHIVE_DB')
+
+LOG_COLUMNS = 'id, rfid, in_time, out_time, duration, amount, payment_status, lot_id'
+
+_ARCHIVE_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS archive.logs (
+        id INTEGER PRIMARY KEY,
+        rfid TEXT NOT NULL,
+        in_time INTEGER NOT NULL,
+        out_time INTEGER,
+        duration INTEGER,
+        amount REAL,
+        payment_status TEXT,
+        lot_id TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_rfid ON logs (rfid, in_time DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_recent ON logs (in_time DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_out_time ON logs (out_time)',
+)
+
+# Every log, active or archived. A row is only in both for the moment between
+# archive.py's copy and delete, and is then read from logs.
+_ALL_LOGS_VIEW = f'''
+    CREATE TEMP VIEW IF NOT EXISTS all_logs AS
+        SELECT {LOG_COLUMNS} FROM main.logs
+        UNION ALL
+        SELECT {LOG_COLUMNS} FROM archive.logs AS archived
+        WHERE NOT EXISTS (SELECT 1 FROM main.logs WHERE main.logs.id = archived.id)
+'''
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_pool_lock = threading.Lock()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds its statement time to the current metrics scope"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.add_db_time(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.add_db_time(time.perf_counter() - start)
+
+
+class ProfiledCursor(TimedCursor):
+    """TimedCursor that also reports every statement and fetch to profiler.py"""
+    _statement = None
+
+    def execute(self, sql, parameters=()):
+        started = profiler.mark()
+        stmt = profiler.begin(self, sql, parameters)
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._statement = profiler.end(stmt, self, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        started = profiler.mark()
+        stmt = profiler.begin(self, sql, seq_of_parameters, many=True)
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._statement = profiler.end(stmt, self, started)
+
+    def fetchone(self):
+        started = profiler.mark()
+        row = super().fetchone()
+        profiler.fetched(self._statement, started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = profiler.mark()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        profiler.fetched(self._statement, started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = profiler.mark()
+        rows = super().fetchall()
+        profiler.fetched(self._statement, started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = profiler.mark()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            profiler.fetched(self._statement, started, 0)
+            raise
+        profiler.fetched(self._statement, started, 1)
+        return row
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=None):
+        return super().cursor(factory or (ProfiledCursor if profiler.ENABLED else TimedCursor))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.add_db_time(time.perf_counter() - start)
+
+
+def open_connection(path=None):
+    """Open a new connection with the pragmas every process should use"""
+    path = path or DB_PATH
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=TimedConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if profiler.ENABLED:
+        profiler.install(conn)
+    attach_archive(conn, ARCHIVE_PATH or os.path.splitext(path)[0] + '-archive.sqlite3')
+    return conn
+
+
+def attach_archive(conn, path):
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    conn.execute('PRAGMA archive.journal_mode=WAL')
+    conn.execute('PRAGMA archive.synchronous=NORMAL')
+    for sql in _ARCHIVE_SCHEMA:
+        conn.execute(sql)
+    create_views(conn)
+
+
+def create_views(conn):
+    """Add all_logs to the connection once the logs table has its current shape
+
+    Left out on an older schema, where the view would also get in the way of
+    migrations rebuilding logs; migrations.migrate() calls this when done.
+    """
+    if conn.execute("SELECT 1 FROM pragma_table_info('logs', 'main') WHERE name = 'lot_id'").fetchone():
+        conn.execute(_ALL_LOGS_VIEW)
+
+
+def acquire():
+    """Take a connection from the pool, opening one if the pool is empty"""
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return open_connection()
+
+
+def release(conn):
+    """Return a connection taken with acquire()"""
+    # Never hand a half-finished transaction to the next borrower
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection for the duration of a with-block"""
+    conn = acquire()
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+
+@contextmanager
+def transaction(conn):
+    """Run a write transaction that takes the write lock up front
+
+    BEGIN IMMEDIATE makes a writer wait on busy_timeout for the lock instead
+    of failing with "database is locked" when it tries to upgrade a read.
+    """
+    start = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    metrics.add_lock_wait(time.perf_counter() - start)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def configure(path):
+    """Point the pool at a different database file"""
+    global DB_PATH
+    close_all()
+    DB_PATH = path
+
+
+def close_all():
+    """Close every idle pooled connection"""
+    with _pool_lock:
+        while True:
+            try:
+                _pool.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,84 @@
+import os
+import threading
+
+# Redelivered gate messages. MQTT QoS 1 is at-least-once: after a handler
+# crash or reconnect the broker sends unacknowledged card reads again, and
+# those must not open a second session or close one twice.
+#
+# A message is a duplicate when it is identical to the last message acted on
+# for the same card, within WINDOW seconds. Comparing with the card's last
+# message only means an entry, exit and a new entry are never mistaken for a
+# repeat. The last message per card is written to gate_messages in the same
+# transaction as the log row it caused, so after a crash either both are there
+# (the redelivery is dropped) or neither is (it is processed normally). The
+# reply that message got is kept with it, so a redelivery gets the same
+# answer, slot number included.
+#
+# Only the MQTT handler records messages here, but cards also pass the gates
+# through /rfid_auth and the gate API. So a match is only taken as a
+# redelivery while the card's session still is what the message left it:
+# open after an entry, closed after an exit. The handler checks that against
+# the logs before dropping the read.
+#
+# Publishers that can should make each read unique, either with a trailing
+# field ("entry:<rfid>:<id>") or an MQTT v5 user property named msg_id.
+
+WINDOW = int(os.environ.get('PARKING_DEDUPE_WINDOW', '300'))
+
+
+def message_key(lot_id, payload, properties=None):
+    """What identifies one gate message"""
+    key = f'{lot_id}|{payload}'
+    for name, value in getattr(properties, 'UserProperty', None) or ():
+        if name == 'msg_id':
+            key += f'|{value}'
+    return key
+
+
+def persist(cur, rfid, key, seen_at, reply=None):
+    cur.execute('''
+        INSERT OR REPLACE INTO gate_messages (rfid, message, seen_at, reply)
+        VALUES (?, ?, ?, ?)
+    ''', (rfid, key, seen_at, reply))
+
+
+class GateDedupe:
+    """The last message acted on for each card, kept for `window` seconds"""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._last = {}
+        self._lock = threading.Lock()
+        self._pruned = 0
+
+    def load(self, conn, now):
+        """Pick up what was recorded before a restart"""
+        rows = conn.execute('''
+            SELECT rfid, message, seen_at, reply FROM gate_messages WHERE seen_at >= ?
+        ''', (now - self.window,)).fetchall()
+        with self._lock:
+            self._last = {rfid: (key, seen_at, reply) for rfid, key, seen_at, reply in rows}
+        return self
+
+    def is_duplicate(self, rfid, key, now):
+        with self._lock:
+            last = self._last.get(rfid)
+        return last is not None and last[0] == key and now - last[1] <= self.window
+
+    def reply(self, rfid):
+        """The reply sent for the card's last message, or None if not known"""
+        with self._lock:
+            last = self._last.get(rfid)
+        return last[2] if last is not None else None
+
+    def record(self, rfid, key, now, reply=None):
+        with self._lock:
+            self._last[rfid] = (key, now, reply)
+            if now - self._pruned > self.window:
+                self._pruned = now
+                self._last = {card: last for card, last in self._last.items()
+                              if now - last[1] <= self.window}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._last)
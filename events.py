@@ -0,0 +1,179 @@
+import collections
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+# Live slot and gate events for dashboard viewers. Any process calls publish(),
+# which sends a small JSON datagram to a local UDP port; it costs nothing when
+# nobody is listening. The web process runs one EventHub that receives them,
+# keeps the current slot snapshot and a short history in memory, and fans
+# each event out to every connected viewer. Viewers never touch the database.
+
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('PARKING_EVENTS_PORT', '9106'))
+
+# Events kept for viewers that reconnect with Last-Event-ID
+HISTORY_SIZE = 1000
+# Events buffered per viewer before a slow viewer is disconnected
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Card details in gate events; only owners may see them, since a card's
+# RFID is enough to log in as its holder
+PRIVATE_FIELDS = ('rfid', 'name')
+
+_send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+_send_socket.setblocking(False)
+
+
+def publish(event_type, **data):
+    """Send an event to the web process's hub, if one is listening"""
+    data['type'] = event_type
+    data.setdefault('time', time.time())
+    try:
+        _send_socket.sendto(json.dumps(data, separators=(',', ':')).encode(), (HOST, PORT))
+    except OSError:
+        pass
+
+
+class Subscription:
+    def __init__(self, initial):
+        self.initial = initial
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Set when the viewer fell too far behind; it should reconnect
+        self.dropped = False
+
+
+class EventHub:
+    """Receives published events and fans them out to subscribers"""
+
+    def __init__(self, port=PORT, history_size=HISTORY_SIZE):
+        self.port = port
+        # Event ids are "<epoch>-<seq>" so ids from a previous hub are never
+        # mistaken for ones in this hub's history
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._history = collections.deque(maxlen=history_size)
+        self._slots = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._socket = None
+
+    def start(self, load_slots=None):
+        """Bind the UDP port and start receiving
+
+        load_slots() returns (lot_id, slot_id, status) rows to seed the snapshot.
+        Raises OSError if the port can't be bound, e.g. because another web
+        process already hosts the hub.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return self
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((HOST, self.port))
+                if load_slots is not None:
+                    self._slots = {f'{lot_id}:{slot_id}': status
+                                   for lot_id, slot_id, status in load_slots()}
+            except Exception:
+                # Leave the port free for the next attempt
+                sock.close()
+                raise
+            self._socket = sock
+            self._thread = threading.Thread(target=self._receive, name='event-hub', daemon=True)
+            self._thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _receive(self):
+        while True:
+            try:
+                data, _ = self._socket.recvfrom(65536)
+                self.dispatch(json.loads(data))
+            except (OSError, ValueError) as e:
+                print(f"Error receiving event: {str(e)}")
+
+    def dispatch(self, event):
+        """Record an event and push it to every subscriber"""
+        with self._lock:
+            self._seq += 1
+            event['id'] = f'{self.epoch}-{self._seq}'
+            if event.get('type') == 'slot':
+                key = str(event['slot_id'])
+                if 'lot_id' in event:
+                    key = f"{event['lot_id']}:{key}"
+                self._slots[key] = event['status']
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                sub.dropped = True
+                self.unsubscribe(sub)
+
+    def snapshot(self):
+        with self._lock:
+            slots = dict(self._slots)
+            last_id = f'{self.epoch}-{self._seq}'
+        lots = {}
+        for key, status in slots.items():
+            lot = lots.setdefault(key.rsplit(':', 1)[0], {'occupied': 0, 'capacity': 0})
+            lot['capacity'] += 1
+            lot['occupied'] += status == 'occupied'
+        occupied = sum(lot['occupied'] for lot in lots.values())
+        return {'type': 'snapshot', 'id': last_id, 'slots': slots, 'lots': lots,
+                'occupied': occupied, 'capacity': len(slots)}
+
+    def subscribe(self, last_event_id=None):
+        """Register a viewer
+
+        A viewer reconnecting with an id still in this hub's history gets the
+        events it missed; anyone else gets a snapshot. Live events follow.
+        """
+        with self._lock:
+            initial = None
+            if last_event_id:
+                epoch, _, seq = last_event_id.partition('-')
+                if epoch == self.epoch and seq.isdigit():
+                    seq = int(seq)
+                    oldest = self._seq - len(self._history) + 1
+                    if seq + 1 >= oldest:
+                        initial = [e for e in self._history
+                                   if int(e['id'].rsplit('-', 1)[1]) > seq]
+            sub = Subscription(initial)
+            self._subscribers.add(sub)
+        if sub.initial is None:
+            sub.initial = [self.snapshot()]
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def redact(event):
+    """The event without card details, for viewers who aren't owners"""
+    if not any(field in event for field in PRIVATE_FIELDS):
+        return event
+    return {key: value for key, value in event.items() if key not in PRIVATE_FIELDS}
+
+
+def format_sse(event):
+    """Encode an event as a Server-Sent Events message"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+hub = EventHub()
@@ -0,0 +1,155 @@
+"""Streaming export of parking logs for accounting
+
+Rows are read in keyset chunks over (in_time, id), each chunk its own short
+read, and written out as they are read, so memory stays flat whatever the
+export size and the WAL can be checkpointed while a long export runs. Gate
+writes are never blocked: readers don't take the write lock in WAL mode.
+
+Owners download from /export/logs (see app.py), or from the command line:
+
+    python export.py --from 2026-01-01 --to 2026-04-01 --format csv > q1.csv
+    python export.py --status unpaid --rfid 1 --format ndjson --gzip > user1.ndjson.gz
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import datetime
+
+import db
+import migrations
+import timestamps
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows per read; bounds memory and how long each read holds its snapshot
+CHUNK_SIZE = 5000
+
+COLUMNS = ('id', 'rfid', 'name', 'lot_id', 'in_time', 'out_time', 'duration',
+           'amount', 'payment_status')
+
+
+def parse_date(value):
+    """'YYYY-MM-DD' (local midnight) -> epoch seconds; None for empty"""
+    if not value:
+        return None
+    return timestamps.from_datetime(datetime.strptime(value, "%Y-%m-%d"))
+
+
+def chunks(conn, start=None, end=None, rfid=None, status=None, chunk_size=CHUNK_SIZE):
+    """Yield lists of log rows, oldest first, matching the filters
+
+    `start`/`end` bound in_time as [start, end) epoch seconds. Archived
+    sessions are included; they are all paid, so an unpaid export skips them.
+    """
+    filters = []
+    params = []
+    if end is not None:
+        filters.append('logs.in_time < ?')
+        params.append(end)
+    if rfid is not None:
+        filters.append('logs.rfid = ?')
+        params.append(rfid)
+    if status == 'paid':
+        filters.append("logs.payment_status = 'paid'")
+    elif status == 'unpaid':
+        filters.append("COALESCE(logs.payment_status, 'unpaid') = 'unpaid'")
+    where = ''.join(f' AND {condition}' for condition in filters)
+    table = 'logs' if status == 'unpaid' else 'all_logs'
+
+    # Log ids start at 1, so (start, 0) also takes in the first second
+    last = (start if start is not None else -1, 0)
+    while True:
+        # Times are formatted by SQLite, as local time like
+        # timestamps.format_timestamp, to keep the per-row Python work small
+        rows = conn.execute(f'''
+            SELECT logs.id, logs.rfid, user.name, logs.lot_id,
+                   strftime('%Y-%m-%d %H:%M:%S', logs.in_time, 'unixepoch', 'localtime') AS in_time,
+                   strftime('%Y-%m-%d %H:%M:%S', logs.out_time, 'unixepoch', 'localtime') AS out_time,
+                   logs.duration, logs.amount, logs.payment_status,
+                   logs.in_time AS in_epoch
+            FROM {table} AS logs
+            LEFT JOIN user ON logs.rfid = user.rfid
+            WHERE (logs.in_time, logs.id) > (?, ?) {where}
+            ORDER BY logs.in_time, logs.id
+            LIMIT ?
+        ''', (*last, *params, chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        last = (rows[-1]['in_epoch'], rows[-1]['id'])
+
+
+def render(row_chunks, fmt):
+    """Yield the export as text, one piece per chunk"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+    for rows in row_chunks:
+        # Each row ends with in_epoch, which is only used as the keyset
+        if fmt == 'csv':
+            writer.writerows(tuple(row)[:-1] for row in rows)
+        else:
+            buffer.writelines(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n'
+                              for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzipped(pieces):
+    """Gzip a stream of text pieces as it goes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for piece in pieces:
+        data = compressor.compress(piece.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(fmt, compress=False, path=None, **filters):
+    """The whole export as a generator of bytes, on its own connection
+
+    The connection is opened on first iteration and closed when the generator
+    finishes or is closed, e.g. when a download is cancelled.
+    """
+    conn = db.open_connection(path)
+    try:
+        pieces = render(chunks(conn, **filters), fmt)
+        if compress:
+            yield from gzipped(pieces)
+        else:
+            for piece in pieces:
+                yield piece.encode()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export parking logs as CSV or NDJSON")
+    parser.add_argument('--from', dest='start', help="first day, YYYY-MM-DD (local time)")
+    parser.add_argument('--to', dest='end', help="day after the last one, YYYY-MM-DD")
+    parser.add_argument('--rfid', help="only this user's logs")
+    parser.add_argument('--status', choices=('paid', 'unpaid'), help="only paid or unpaid logs")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--gzip', action='store_true', help="gzip the output")
+    args = parser.parse_args()
+
+    migrations.migrate()
+    out = sys.stdout.buffer
+    for piece in stream(args.format, args.gzip, start=parse_date(args.start),
+                        end=parse_date(args.end), rfid=args.rfid, status=args.status):
+        out.write(piece)
+    out.flush()
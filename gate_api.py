@@ -0,0 +1,255 @@
+"""Async HTTP gate API for controllers that can't speak MQTT
+
+    POST /gate   {"gate": "entry", "rfid": "1234", "lot": "main"}
+    POST /gate   {"events": [{"gate": "exit", "rfid": "1234"}, ...]}
+
+"lot" defaults to the main lot. Every event gets a decision, in order:
+
+    {"decisions": [{"gate": "exit", "rfid": "1234", "lot": "main",
+                    "decision": "open", "log_id": 17, "duration": 5400, "amount": 100.0}]}
+
+A decision is "open", "full" (entry only) or "unauthorized" with a "reason".
+An event that couldn't be recorded, e.g. because the database was locked,
+gets "error" with a "reason" and can be sent again; the other events in the
+request are unaffected.
+An opened entry names the "slot" reserved for the car (see allocation.py),
+or null in a lot without slots.
+
+Requests are served on one asyncio loop and never wait on the database
+themselves. Decisions are made on a single database thread, which takes the
+events of every request waiting at that moment in one transaction, so a
+burst of gate reads costs one commit instead of one each. A card's events
+are decided in the order they arrive.
+
+    python gate_api.py --port 5001
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+
+from aiohttp import web
+
+import allocation
+import db
+import events
+import gates
+import lots
+import metrics
+import migrations
+import profiler
+import rfid_cache
+import timestamps
+
+PORT = int(os.environ.get('PARKING_GATE_API_PORT', '5001'))
+
+# Most events decided in one transaction, and accepted in one request
+BATCH_SIZE = 1000
+MAX_EVENTS = 100
+
+GATES = ('entry', 'exit')
+
+# Users by RFID and free-slot hints; only the database thread uses them
+users = rfid_cache.RfidCache()
+allocator = allocation.Allocator()
+
+
+def _refuse(decision, reason):
+    decision.update(decision='unauthorized', reason=reason)
+    return decision
+
+
+def decide(cur, event, now):
+    """Decide on and record one gate event; returns its decision"""
+    gate, rfid, lot_id = event['gate'], event['rfid'], event['lot']
+    decision = {'gate': gate, 'rfid': rfid, 'lot': lot_id}
+    user = users.lookup(cur.connection, rfid)
+    if user is None:
+        return _refuse(decision, 'unknown card')
+    if user.role == 'owner':
+        return _refuse(decision, 'owner cards cannot be used for parking')
+
+    if gate == 'entry':
+        try:
+            slot_id = allocator.reserve(cur, lot_id, rfid, now)
+        except allocation.UnknownLot:
+            return _refuse(decision, 'unknown lot')
+        except allocation.Full:
+            decision['decision'] = 'full'
+            return decision
+        decision.update(decision='open', slot=slot_id,
+                        log_id=gates.open_session(cur, rfid, lot_id, now), name=user.name)
+        return decision
+
+    closed = gates.close_session(cur, rfid, now)
+    if closed is None:
+        return _refuse(decision, 'no open parking session')
+    # The session's own lot, whichever gate the card left by
+    decision.update(decision='open', lot=closed.lot_id or lot_id, log_id=closed.id,
+                    duration=closed.duration, amount=closed.amount)
+    return decision
+
+
+def _decide_in_transaction(conn, batch, now):
+    with db.transaction(conn):
+        cur = conn.cursor()
+        return [decide(cur, event, now) for event in batch]
+
+
+def decide_batch(conn, batch):
+    """Decisions for a list of events, made and committed in one transaction"""
+    now = timestamps.now()
+    with metrics.track_db('gate_api'), profiler.scope('gate_api'):
+        try:
+            decisions = _decide_in_transaction(conn, batch, now)
+        except Exception as e:
+            # Retry one by one so a single bad event doesn't fail the others
+            print(f"Error deciding batch of {len(batch)}, retrying individually: {str(e)}")
+            decisions = []
+            for event in batch:
+                try:
+                    decisions.extend(_decide_in_transaction(conn, [event], now))
+                except Exception as e:
+                    print(f"Error deciding {event['gate']} for RFID {event['rfid']}: {str(e)}")
+                    decisions.append(dict(event, decision='error', reason='could not be recorded'))
+
+    for decision in decisions:
+        metrics.gate_decisions.inc(decision['gate'], decision['decision'])
+        if decision['decision'] != 'open':
+            continue
+        if decision['gate'] == 'entry':
+            events.publish('entry', lot_id=decision['lot'], rfid=decision['rfid'],
+                           name=decision['name'])
+        else:
+            events.publish('exit', lot_id=decision['lot'], rfid=decision['rfid'])
+    return decisions
+
+
+class GateBatcher:
+    """Hands the events of concurrent requests to one database thread in batches"""
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.batches = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='gate-db')
+        self._queue = None
+        self._task = None
+        self._conn = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(self._executor, db.open_connection, self.path)
+        await loop.run_in_executor(self._executor, migrations.migrate, self._conn)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+        self._executor.shutdown()
+
+    async def decide(self, batch):
+        """Decisions for the events, once they are committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((batch, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Everything that arrived while the last batch was being written
+            waiting = [await self._queue.get()]
+            count = len(waiting[0][0])
+            while count < self.batch_size and not self._queue.empty():
+                waiting.append(self._queue.get_nowait())
+                count += len(waiting[-1][0])
+            batch = [event for request_events, _ in waiting for event in request_events]
+            try:
+                decisions = await loop.run_in_executor(self._executor, decide_batch, self._conn, batch)
+            except Exception as e:
+                print(f"Error deciding gate events: {str(e)}")
+                for _, future in waiting:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            start = 0
+            for request_events, future in waiting:
+                if not future.done():
+                    future.set_result(decisions[start:start + len(request_events)])
+                start += len(request_events)
+
+
+BATCHER = web.AppKey('batcher', GateBatcher)
+
+
+def parse_events(body):
+    """The request's events as [{'gate', 'rfid', 'lot'}]; raises ValueError if malformed"""
+    raw = body.get('events') if isinstance(body, dict) and 'events' in body else [body]
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("expected an event or a non-empty list of events")
+    if len(raw) > MAX_EVENTS:
+        raise ValueError(f"at most {MAX_EVENTS} events per request")
+    parsed = []
+    for event in raw:
+        if not isinstance(event, dict):
+            raise ValueError("each event must be an object")
+        gate, rfid = event.get('gate'), event.get('rfid')
+        lot_id = event.get('lot', lots.DEFAULT_LOT)
+        if gate not in GATES:
+            raise ValueError("gate must be entry or exit")
+        if not isinstance(rfid, str) or not rfid:
+            raise ValueError("rfid must be a non-empty string")
+        if not isinstance(lot_id, str):
+            raise ValueError("lot must be a string")
+        parsed.append({'gate': gate, 'rfid': rfid, 'lot': lot_id})
+    return parsed
+
+
+async def gate(request):
+    try:
+        batch = parse_events(await request.json())
+    except ValueError as e:
+        # Includes bad JSON: json.JSONDecodeError is a ValueError
+        return web.json_response({'status': 'error', 'message': str(e)}, status=400)
+    try:
+        decisions = await request.app[BATCHER].decide(batch)
+    except Exception as e:
+        return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+    return web.json_response({'decisions': decisions})
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_app(path=None):
+    app = web.Application()
+    app[BATCHER] = GateBatcher(path)
+    app.router.add_post('/gate', gate)
+    app.router.add_get('/metrics', metrics_endpoint)
+
+    async def start(app):
+        await app[BATCHER].start()
+
+    async def stop(app):
+        await app[BATCHER].stop()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Async HTTP gate API")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    # backlog: accept bursts of thousands of controllers connecting at once
+    web.run_app(create_app(), host=args.host, port=args.port, backlog=4096, access_log=None)
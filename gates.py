@@ -0,0 +1,64 @@
+"""Opening and closing parking sessions at the gates
+
+The MQTT handler, the /rfid_auth route and the device API
+(gate_api.py) each decide on a card read in their own way, then record it
+with these, inside their own transaction. Billing totals and analytics
+rollups are updated in the same transaction.
+"""
+import collections
+
+import allocation
+import analytics
+import billing
+import tariff
+
+ClosedSession = collections.namedtuple('ClosedSession', 'id lot_id in_time duration amount')
+
+
+def has_open_session(cur, rfid):
+    cur.execute("SELECT 1 FROM logs WHERE rfid = ? AND out_time IS NULL LIMIT 1", (rfid,))
+    return cur.fetchone() is not None
+
+
+def open_session(cur, rfid, lot_id, in_time):
+    """Start a session for the card; returns its log id"""
+    cur.execute('''
+        INSERT INTO logs (rfid, in_time, payment_status, lot_id)
+        VALUES (?, ?, 'unpaid', ?)
+    ''', (rfid, in_time, lot_id))
+    log_id = cur.lastrowid
+    analytics.record_entry(cur, lot_id, in_time)
+    return log_id
+
+
+def close_session(cur, rfid, out_time):
+    """Close the card's latest open session, priced with the current tariff
+
+    Returns a ClosedSession, or None if the card has no open session.
+    """
+    cur.execute('''
+        SELECT logs.id, logs.in_time, logs.payment_status, logs.lot_id, user.role FROM logs
+        LEFT JOIN user ON logs.rfid = user.rfid
+        WHERE logs.rfid = ? AND logs.out_time IS NULL
+        ORDER BY logs.in_time DESC LIMIT 1
+    ''', (rfid,))
+    log = cur.fetchone()
+    if not log:
+        return None
+
+    duration = max(0, out_time - log['in_time'])
+    amount = tariff.charge(duration, log['in_time'], log['role'])
+    cur.execute('''
+        UPDATE logs
+        SET out_time = ?,
+            duration = ?,
+            amount = ?
+        WHERE id = ? AND out_time IS NULL
+    ''', (out_time, duration, amount, log['id']))
+    if not cur.rowcount:
+        return None
+    # A car that leaves before parking gives its reserved slot back
+    allocation.release(cur, log['lot_id'], rfid)
+    billing.record_exit(cur, rfid, amount, out_time, paid=log['payment_status'] == 'paid')
+    analytics.record_exit(cur, log['lot_id'], out_time, duration, amount)
+    return ClosedSession(log['id'], log['lot_id'], log['in_time'], duration, amount)
@@ -0,0 +1,119 @@
+import collections
+import queue
+import threading
+import time
+import zlib
+
+# Worker lanes for the MQTT handler. paho delivers every message on one
+# network thread; the handler routes each one to a lane by topic so a flood
+# of sensor telemetry can never sit in front of a driver waiting at the gate.
+# Each lane has its own workers and queue bound. Messages with the same key
+# (an RFID, a slot) always go to the same worker, so they stay in order.
+
+_STOP = object()
+
+
+class Lane:
+    """A fixed set of worker threads, each with its own bounded queue
+
+    `block_timeout` is how long submit() waits on a full queue before the
+    message is dropped; 0 drops immediately.
+    """
+
+    def __init__(self, name, workers=1, maxsize=1000, block_timeout=0):
+        self.name = name
+        self.block_timeout = block_timeout
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {'submitted': 0, 'processed': 0, 'dropped': 0, 'errors': 0}
+
+    @property
+    def workers(self):
+        return len(self._queues)
+
+    def start(self):
+        if not self._threads:
+            for i, q in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(q,),
+                                          name=f'{self.name}-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """Finish everything already queued and stop the workers"""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) on the worker that owns `key`; False if dropped"""
+        q = self._queues[zlib.crc32(str(key).encode()) % len(self._queues)]
+        try:
+            if self.block_timeout:
+                q.put((fn, args), timeout=self.block_timeout)
+            else:
+                q.put_nowait((fn, args))
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('submitted')
+        return True
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['workers'] = self.workers
+        stats['depth'] = self.depth()
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Error in {self.name} lane: {str(e)}")
+                self._count('errors')
+            self._count('processed')
+
+
+class LatencyRecorder:
+    """Keeps the most recent samples and reports percentiles over them"""
+
+    def __init__(self, size=10000):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def since(self, start):
+        self.observe(time.perf_counter() - start)
+
+    def percentiles(self, *points):
+        """Percentiles in milliseconds, e.g. percentiles(50, 99)"""
+        with self._lock:
+            samples = sorted(self._samples)
+        result = {'count': len(samples)}
+        for point in points:
+            if samples:
+                index = min(len(samples) - 1, int(round(point / 100 * (len(samples) - 1))))
+                result[f'p{point}'] = round(samples[index] * 1000, 3)
+            else:
+                result[f'p{point}'] = None
+        return result
@@ -0,0 +1,108 @@
+"""Parking lots and their slots
+
+Each lot has an id used in MQTT topics and URLs, a display name and its
+slots. lots.capacity and lots.occupied are kept current by triggers on the
+slots table, so a lot summary never has to count slot rows. It counts only
+the slots reserved at entry (see allocation.py), from an index range.
+
+Create a lot, or change how many slots it has:
+
+    python lots.py north --name "North car park" --slots 500
+    python lots.py                      # list lots
+"""
+import argparse
+import re
+
+import db
+import migrations
+import timestamps
+
+# Lot used by the original single-lot topics and forms
+DEFAULT_LOT = 'main'
+
+_LOT_ID = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+def valid_lot_id(lot_id):
+    """Lot ids appear in topics and URLs: letters, digits, '-' and '_' only"""
+    return bool(lot_id) and _LOT_ID.match(lot_id) is not None
+
+
+def parse_topic(topic):
+    """'parking/<lot>/<kind>' or the single-lot 'parking/<kind>' -> (lot_id, kind)
+
+    Returns (None, None) for anything else.
+    """
+    parts = topic.split('/')
+    if len(parts) == 2 and parts[0] == 'parking':
+        return DEFAULT_LOT, parts[1]
+    if len(parts) == 3 and parts[0] == 'parking':
+        return parts[1], parts[2]
+    return None, None
+
+
+def gate_topic(lot_id, legacy=False):
+    """Where gate decisions for a lot are published"""
+    if legacy:
+        return 'parking/gates/status'
+    return f'parking/{lot_id}/gates/status'
+
+
+def ensure_lot(cur, lot_id, name=None, slots=None):
+    """Create a lot if needed; with `slots`, give it exactly slots 1..slots
+
+    Shrinking only removes slots that are free. Returns the lot's slot count.
+    """
+    if not valid_lot_id(lot_id):
+        raise ValueError(f"Invalid lot id {lot_id!r}")
+    cur.execute("INSERT OR IGNORE INTO lots (lot_id, name) VALUES (?, ?)",
+                (lot_id, name or lot_id))
+    if name:
+        cur.execute("UPDATE lots SET name = ? WHERE lot_id = ?", (name, lot_id))
+    if slots is not None:
+        cur.executemany("INSERT OR IGNORE INTO slots (lot_id, slot_id, status) VALUES (?, ?, 'free')",
+                        [(lot_id, i) for i in range(1, slots + 1)])
+        cur.execute('''
+            DELETE FROM slots
+            WHERE lot_id = ? AND slot_id > ? AND COALESCE(status, 'free') = 'free'
+        ''', (lot_id, slots))
+    cur.execute("SELECT capacity FROM lots WHERE lot_id = ?", (lot_id,))
+    return cur.fetchone()[0]
+
+
+def summary(cur, now=None):
+    """Every lot with its capacity, occupancy and live slot reservations"""
+    cur.execute('''
+        SELECT lot_id, name, capacity, occupied, reserved,
+               capacity - occupied - reserved AS free
+        FROM (
+            SELECT lot_id, name, capacity, occupied,
+                   (SELECT COUNT(*) FROM slots
+                    WHERE slots.lot_id = lots.lot_id AND status = 'free'
+                      AND reserved_until > ?) AS reserved
+            FROM lots
+        )
+        ORDER BY lot_id
+    ''', (timestamps.now() if now is None else now,))
+    return cur.fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create, resize or list parking lots")
+    parser.add_argument('lot_id', nargs='?', help="lot to create or change; omit to list lots")
+    parser.add_argument('--name', help="display name")
+    parser.add_argument('--slots', type=int, help="number of slots (numbered from 1)")
+    args = parser.parse_args()
+
+    conn = db.open_connection()
+    try:
+        migrations.migrate(conn)
+        if args.lot_id:
+            with db.transaction(conn):
+                capacity = ensure_lot(conn.cursor(), args.lot_id, args.name, args.slots)
+            print(f"Lot {args.lot_id} has {capacity} slots")
+        for lot in summary(conn.cursor()):
+            print(f"{lot['lot_id']:<16} {lot['name']:<24} "
+                  f"{lot['occupied']}/{lot['capacity']} occupied, {lot['reserved']} reserved")
+    finally:
+        conn.close()
@@ -0,0 +1,248 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lightweight Prometheus-style instrumentation shared by the web app and the
+# MQTT handler. Metrics live in this process; app.py serves them on /metrics
+# and the MQTT handler on its own small HTTP port. Recording a sample is a
+# bisect and two additions under a lock. Set PARKING_METRICS=0 to turn
+# recording off entirely.
+
+ENABLED = os.environ.get('PARKING_METRICS', '1') != '0'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; spans sub-millisecond SQLite calls up to slow page renders
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_label_text(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Gauge(_Metric):
+    """A gauge whose values are read from `callback` at scrape time
+
+    The callback returns a number, or a dict of label tuple -> number.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self._callbacks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def render(self):
+        lines = self._header()
+        for callback in self._callbacks:
+            try:
+                values = callback()
+            except Exception:
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in sorted(values.items()):
+                lines.append(f'{self.name}{_label_text(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, seconds, *labels):
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # per-bucket counts (last one is +Inf), then sum
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            series = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self._series.items())
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                label_text = _label_text(self.labelnames + ('le',), labels + (le,))
+                lines.append(f'{self.name}_bucket{label_text} {cumulative}')
+            label_text = _label_text(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {total}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by both processes
+
+http_request_seconds = Histogram(
+    'parking_http_request_seconds', 'Flask request latency',
+    ('route', 'method', 'status'))
+mqtt_event_seconds = Histogram(
+    'parking_mqtt_event_seconds', 'MQTT message processing time',
+    ('topic', 'event'))
+gate_reply_seconds = Histogram(
+    'parking_gate_reply_seconds', 'Time from RFID message receipt to gate reply publish',
+    ('gate',))
+db_seconds = Histogram(
+    'parking_db_seconds', 'SQLite time spent per request or MQTT event',
+    ('source',))
+db_lock_wait_seconds = Histogram(
+    'parking_db_lock_wait_seconds', 'Time spent waiting for the SQLite write lock per request or MQTT event',
+    ('source',))
+gate_decisions = Counter(
+    'parking_gate_decisions_total', 'Gate decisions by outcome',
+    ('gate', 'outcome'))
+slot_reservations = Counter(
+    'parking_slot_reservations_total', 'Slot reservations at entry by outcome',
+    ('outcome',))
+rfid_cache_lookups = Counter(
+    'parking_rfid_cache_lookups_total', 'RFID user lookups at the gate',
+    ('result',))
+queue_depth = Gauge(
+    'parking_queue_depth', 'Items waiting in in-process queues',
+    ('queue',))
+
+
+# Per-thread accounting of database time for the request or event that the
+# thread is currently handling. db.py feeds it; callers open a scope with
+# track_db() and read the totals when it closes.
+
+_local = threading.local()
+
+
+def add_db_time(seconds):
+    if ENABLED and getattr(_local, 'active', False):
+        _local.db += seconds
+
+
+def add_lock_wait(seconds):
+    if ENABLED and getattr(_local, 'active', False):
+        _local.lock_wait += seconds
+
+
+def begin_db_scope():
+    _local.active = True
+    _local.db = 0.0
+    _local.lock_wait = 0.0
+
+
+def end_db_scope(source):
+    if not getattr(_local, 'active', False):
+        return
+    _local.active = False
+    db_seconds.observe(_local.db, source)
+    db_lock_wait_seconds.observe(_local.lock_wait, source)
+
+
+@contextmanager
+def track_db(source):
+    """Record the DB and lock-wait time spent inside the with-block"""
+    begin_db_scope()
+    try:
+        yield
+    finally:
+        end_db_scope(source)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve /metrics from a background thread (for processes without Flask)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,480 @@
+import os
+import time
+
+import db
+
+# Schema migrations, applied in order. The database records the last version it
+# has seen in PRAGMA user_version, so startup on an up-to-date database is a
+# single pragma read. Never edit a migration that has shipped; add a new one.
+
+
+def _initial_schema(cur):
+    # IF NOT EXISTS so databases created before migrations existed are adopted
+    # as version 1 without touching their data.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user (
+            rfid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            role TEXT NOT NULL,
+            amount REAL DEFAULT 0.0
+        )
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rfid TEXT NOT NULL,
+            in_time TEXT NOT NULL,
+            out_time TEXT,
+            duration TEXT,
+            amount REAL,
+            payment_status TEXT DEFAULT 'unpaid',
+            FOREIGN KEY (rfid) REFERENCES user (rfid)
+        )
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS slots (
+            slot_id INTEGER PRIMARY KEY,
+            status TEXT DEFAULT 'free'
+        )
+    ''')
+
+    # Default users
+    cur.execute("INSERT OR IGNORE INTO user (rfid, name, role) VALUES (?, ?, ?)",
+                ('10', 'Owner', 'owner'))
+    cur.execute("INSERT OR IGNORE INTO user (rfid, name, role) VALUES (?, ?, ?)",
+                ('1', 'User', 'user'))
+
+    # 8 slots
+    cur.executemany("INSERT OR IGNORE INTO slots (slot_id, status) VALUES (?, 'free')",
+                    [(i,) for i in range(1, 9)])
+
+
+def _log_indexes(cur):
+    # Exit lookup: the open session for a card. Partial, so it only ever holds
+    # the cars currently parked.
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_logs_open_rfid
+        ON logs (rfid, in_time DESC) WHERE out_time IS NULL
+    ''')
+    # Per-user history
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_logs_rfid_in_time
+        ON logs (rfid, in_time DESC, id DESC)
+    ''')
+    # Owner dashboard, newest first
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_logs_in_time
+        ON logs (in_time DESC, id DESC)
+    ''')
+    # Occupancy count
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_slots_status ON slots (status)')
+
+
+# Rows copied per transaction by online migrations, and the pause between
+# chunks that lets gate traffic take the write lock
+ONLINE_CHUNK_SIZE = 5000
+ONLINE_CHUNK_PAUSE = 0.01
+
+# Local-time TEXT -> UTC epoch seconds, evaluated by SQLite on the machine that
+# wrote the text. Unparseable values become 0 rather than failing the copy.
+_EPOCH = "CAST(strftime('%s', {0}, 'utc') AS INTEGER)"
+
+
+def _log_copy_select(prefix=''):
+    """Columns of a logs row converted to the epoch layout, e.g. prefix='new.'"""
+    in_epoch = _EPOCH.format(f'{prefix}in_time')
+    out_epoch = _EPOCH.format(f'{prefix}out_time')
+    return f'''
+        {prefix}id, {prefix}rfid, COALESCE({in_epoch}, 0), {out_epoch},
+        CASE WHEN {prefix}out_time IS NOT NULL THEN {out_epoch} - {in_epoch} END,
+        {prefix}amount, {prefix}payment_status
+    '''
+
+
+def _epoch_timestamps(conn):
+    """Store in_time/out_time as UTC epoch seconds and duration in seconds
+
+    Done online: a new table is filled in small chunks while triggers mirror
+    any writes made to the old one in the meantime, then the two are swapped
+    in one short transaction. Readers and writers on the old table are only
+    ever blocked for one chunk. Safe to re-run if interrupted.
+    """
+    with db.transaction(conn):
+        # Another process may have finished it while we waited for the lock
+        if current_version(conn) >= 3:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS logs_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rfid TEXT NOT NULL,
+                in_time INTEGER NOT NULL,
+                out_time INTEGER,
+                duration INTEGER,
+                amount REAL,
+                payment_status TEXT DEFAULT 'unpaid',
+                FOREIGN KEY (rfid) REFERENCES user (rfid)
+            )
+        ''')
+        # Built up front so the swap doesn't have to index the whole table
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_logs_open_session
+            ON logs_new (rfid, in_time DESC) WHERE out_time IS NULL
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_logs_rfid_history
+            ON logs_new (rfid, in_time DESC, id DESC)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_logs_recent
+            ON logs_new (in_time DESC, id DESC)
+        ''')
+        for event in ('INSERT', 'UPDATE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS logs_mirror_{event.lower()}
+                AFTER {event} ON logs BEGIN
+                    INSERT OR REPLACE INTO logs_new
+                    SELECT {_log_copy_select('new.')};
+                END
+            ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS logs_mirror_delete
+            AFTER DELETE ON logs BEGIN
+                DELETE FROM logs_new WHERE id = old.id;
+            END
+        ''')
+        # Rows written after this point are mirrored by the triggers, so the
+        # copy only has to reach the ids that exist now
+        max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0]
+
+    last_id = 0
+    copied = 0
+    while last_id < max_id:
+        with db.transaction(conn):
+            if current_version(conn) >= 3:
+                return
+            row = conn.execute('''
+                SELECT MAX(id), COUNT(*) FROM (
+                    SELECT id FROM logs WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+                )
+            ''', (last_id, max_id, ONLINE_CHUNK_SIZE)).fetchone()
+            if row[0] is None:
+                break
+            conn.execute(f'''
+                INSERT OR REPLACE INTO logs_new
+                SELECT {_log_copy_select()} FROM logs WHERE id > ? AND id <= ?
+            ''', (last_id, row[0]))
+        last_id = row[0]
+        copied += row[1]
+        if copied % (ONLINE_CHUNK_SIZE * 100) == 0:
+            print(f"Converted {copied} logs to epoch timestamps")
+        time.sleep(ONLINE_CHUNK_PAUSE)
+
+    with db.transaction(conn):
+        if current_version(conn) >= 3:
+            return
+        conn.execute('DROP TRIGGER IF EXISTS logs_mirror_insert')
+        conn.execute('DROP TRIGGER IF EXISTS logs_mirror_update')
+        conn.execute('DROP TRIGGER IF EXISTS logs_mirror_delete')
+        conn.execute('DROP TABLE logs')
+        conn.execute('ALTER TABLE logs_new RENAME TO logs')
+        conn.execute('PRAGMA user_version = 3')
+
+
+# Migrations marked online manage their own transactions and must set
+# user_version themselves in their final one.
+_epoch_timestamps.online = True
+
+
+def _user_totals(cur):
+    """Running billing totals per user, backfilled from the logs"""
+    cur.execute('ALTER TABLE user ADD COLUMN outstanding REAL DEFAULT 0.0')
+    cur.execute('ALTER TABLE user ADD COLUMN session_count INTEGER NOT NULL DEFAULT 0')
+    cur.execute('ALTER TABLE user ADD COLUMN last_visit INTEGER')
+    # user.amount becomes the total paid; it was only ever set by sample data
+    cur.execute('''
+        UPDATE user SET
+            amount = (SELECT COALESCE(SUM(amount), 0) FROM logs
+                      WHERE logs.rfid = user.rfid AND out_time IS NOT NULL
+                        AND payment_status = 'paid'),
+            outstanding = (SELECT COALESCE(SUM(amount), 0) FROM logs
+                           WHERE logs.rfid = user.rfid AND out_time IS NOT NULL
+                             AND COALESCE(payment_status, 'unpaid') = 'unpaid'),
+            session_count = (SELECT COUNT(*) FROM logs
+                             WHERE logs.rfid = user.rfid AND out_time IS NOT NULL),
+            last_visit = (SELECT MAX(out_time) FROM logs WHERE logs.rfid = user.rfid)
+    ''')
+
+
+def _user_generation(cur):
+    """Counter bumped on every user change, for processes that cache users"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS cache_generation (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute("INSERT OR IGNORE INTO cache_generation (name, value) VALUES ('user', 0)")
+    # Billing totals change on every exit and don't affect gate decisions, so
+    # only the columns a cache holds count as a change
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'),
+                        ('update', 'UPDATE OF rfid, name, role')):
+        cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS user_generation_{name}
+            AFTER {event} ON user BEGIN
+                UPDATE cache_generation SET value = value + 1 WHERE name = 'user';
+            END
+        ''')
+
+
+def _lots(cur):
+    """Lots as their own table; slots keyed by (lot_id, slot_id)"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS lots (
+            lot_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            capacity INTEGER NOT NULL DEFAULT 0,
+            occupied INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Existing slots become the default lot
+    cur.execute("INSERT OR IGNORE INTO lots (lot_id, name) VALUES ('main', 'Main')")
+    cur.execute('''
+        CREATE TABLE slots_new (
+            lot_id TEXT NOT NULL REFERENCES lots (lot_id),
+            slot_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'free',
+            PRIMARY KEY (lot_id, slot_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute("INSERT INTO slots_new (lot_id, slot_id, status) SELECT 'main', slot_id, status FROM slots")
+    cur.execute('DROP TABLE slots')
+    cur.execute('ALTER TABLE slots_new RENAME TO slots')
+    # Dropped with the old table; per lot now, to match the new key
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_slots_status ON slots (lot_id, status)')
+    cur.execute('''
+        UPDATE lots SET
+            capacity = (SELECT COUNT(*) FROM slots WHERE slots.lot_id = lots.lot_id),
+            occupied = (SELECT COUNT(*) FROM slots
+                        WHERE slots.lot_id = lots.lot_id AND status = 'occupied')
+    ''')
+
+    # Keep the per-lot counters current so summaries never count slots
+    cur.execute('''
+        CREATE TRIGGER slots_count_insert AFTER INSERT ON slots BEGIN
+            UPDATE lots SET capacity = capacity + 1,
+                            occupied = occupied + (new.status IS 'occupied')
+            WHERE lot_id = new.lot_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER slots_count_delete AFTER DELETE ON slots BEGIN
+            UPDATE lots SET capacity = capacity - 1,
+                            occupied = occupied - (old.status IS 'occupied')
+            WHERE lot_id = old.lot_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER slots_count_update AFTER UPDATE OF status ON slots
+        WHEN old.status IS NOT new.status BEGIN
+            UPDATE lots SET occupied = occupied + (new.status IS 'occupied')
+                                                - (old.status IS 'occupied')
+            WHERE lot_id = new.lot_id;
+        END
+    ''')
+
+    # Which lot a session was at. Every session so far was at the default
+    # lot; the column default covers them without rewriting the table
+    cur.execute("ALTER TABLE logs ADD COLUMN lot_id TEXT DEFAULT 'main'")
+
+
+def _gate_messages(cur):
+    """Last gate message acted on per card, for dropping MQTT redeliveries"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS gate_messages (
+            rfid TEXT PRIMARY KEY,
+            message TEXT NOT NULL,
+            seen_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _analytics(cur):
+    """Slot history and time-series rollups (see analytics.py)"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS slot_events (
+            id INTEGER PRIMARY KEY,
+            lot_id TEXT NOT NULL,
+            slot_id INTEGER NOT NULL,
+            previous TEXT,
+            status TEXT,
+            at INTEGER NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_slot_events_slot ON slot_events (lot_id, slot_id, at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_slot_events_at ON slot_events (at)')
+    # Rollups are rebuilt by exit time as well as entry time
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_logs_out_time
+        ON logs (out_time) WHERE out_time IS NOT NULL
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS lot_rollups (
+            granularity INTEGER NOT NULL,
+            lot_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            entries INTEGER NOT NULL DEFAULT 0,
+            exits INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            dwell_seconds INTEGER NOT NULL DEFAULT 0,
+            dwell_15m INTEGER NOT NULL DEFAULT 0,
+            dwell_1h INTEGER NOT NULL DEFAULT 0,
+            dwell_3h INTEGER NOT NULL DEFAULT 0,
+            dwell_6h INTEGER NOT NULL DEFAULT 0,
+            dwell_24h INTEGER NOT NULL DEFAULT 0,
+            dwell_over_24h INTEGER NOT NULL DEFAULT 0,
+            occupancy_change INTEGER NOT NULL DEFAULT 0,
+            occupied_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, lot_id, bucket)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS slot_rollups (
+            granularity INTEGER NOT NULL,
+            lot_id TEXT NOT NULL,
+            slot_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            changes INTEGER NOT NULL DEFAULT 0,
+            occupancy_change INTEGER NOT NULL DEFAULT 0,
+            occupied_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, lot_id, slot_id, bucket)
+        ) WITHOUT ROWID
+    ''')
+
+    # Slots occupied now start the history, so occupancy never counts below
+    # zero. Written out here rather than through analytics.py, so later
+    # changes there can't change what this migration does. Buckets are
+    # aligned to local time the way analytics.bucket_start() aligns them.
+    now = int(time.time())
+    offset = int(os.environ.get('PARKING_UTC_OFFSET_MINUTES', time.localtime().tm_gmtoff // 60)) * 60
+    cur.execute('''
+        INSERT INTO slot_events (lot_id, slot_id, previous, status, at)
+        SELECT lot_id, slot_id, NULL, status, ? FROM slots WHERE status = 'occupied'
+    ''', (now,))
+    for size in (60, 3600, 86400):
+        bucket = (now + offset) // size * size - offset
+        # Slot-seconds each occupied slot adds up to by the bucket's end
+        seconds = bucket + size - now
+        cur.execute('''
+            INSERT INTO slot_rollups
+                (granularity, lot_id, slot_id, bucket, changes, occupancy_change, occupied_seconds)
+            SELECT ?, lot_id, slot_id, ?, 1, 1, ? FROM slots WHERE status = 'occupied'
+        ''', (size, bucket, seconds))
+        cur.execute('''
+            INSERT INTO lot_rollups (granularity, lot_id, bucket, occupancy_change, occupied_seconds)
+            SELECT ?, lot_id, ?, COUNT(*), COUNT(*) * ? FROM slots
+            WHERE status = 'occupied' GROUP BY lot_id
+        ''', (size, bucket, seconds))
+
+
+def _reservations(cur):
+    """Slot reservations made at entry (see allocation.py)"""
+    cur.execute('ALTER TABLE slots ADD COLUMN reserved_by TEXT')
+    # Epoch seconds the reservation lasts until; 0 when the slot isn't reserved
+    cur.execute('ALTER TABLE slots ADD COLUMN reserved_until INTEGER NOT NULL DEFAULT 0')
+    cur.execute("UPDATE slots SET status = 'free' WHERE status IS NULL")
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_slots_free
+        ON slots (lot_id, reserved_until) WHERE status = 'free'
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_slots_reserved
+        ON slots (reserved_by) WHERE reserved_by IS NOT NULL
+    ''')
+
+
+def _gate_replies(cur):
+    """The reply sent for each card's last gate message, repeated to a redelivery"""
+    cur.execute('ALTER TABLE gate_messages ADD COLUMN reply TEXT')
+
+
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'indexes for exit lookup, dashboard and history', _log_indexes),
+    (3, 'epoch timestamps and integer durations in logs', _epoch_timestamps),
+    (4, 'per-user billing totals', _user_totals),
+    (5, 'user change counter for RFID caches', _user_generation),
+    (6, 'parking lots with per-lot slots and counters', _lots),
+    (7, 'last gate message per card', _gate_messages),
+    (8, 'slot history and analytics rollups', _analytics),
+    (9, 'slot reservations', _reservations),
+    (10, 'gate replies for redelivered messages', _gate_replies),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn=None):
+    """Bring the database up to LATEST_VERSION; safe to call on every start"""
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+
+    try:
+        if current_version(conn) >= LATEST_VERSION:
+            return LATEST_VERSION
+
+        for version, description, apply in MIGRATIONS:
+            if getattr(apply, 'online', False):
+                if current_version(conn) >= version:
+                    continue
+                apply(conn)
+                print(f"Applied migration {version}: {description}")
+                continue
+
+            # Re-check under the write lock in case another process (web vs
+            # MQTT handler) is migrating at the same moment.
+            with db.transaction(conn):
+                if current_version(conn) >= version:
+                    continue
+                apply(conn.cursor())
+                conn.execute(f'PRAGMA user_version = {version}')
+            print(f"Applied migration {version}: {description}")
+
+        db.create_views(conn)
+        return current_version(conn)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def reset(conn=None):
+    """Drop every table and rebuild from scratch. Destroys all data."""
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+
+    try:
+        with db.transaction(conn):
+            conn.execute('DROP VIEW IF EXISTS temp.all_logs')
+            conn.execute('DROP TABLE IF EXISTS logs')
+            conn.execute('DROP TABLE IF EXISTS logs_new')
+            conn.execute('DROP TABLE IF EXISTS user')
+            conn.execute('DROP TABLE IF EXISTS slots')
+            conn.execute('DROP TABLE IF EXISTS lots')
+            conn.execute('DROP TABLE IF EXISTS cache_generation')
+            conn.execute('DROP TABLE IF EXISTS gate_messages')
+            conn.execute('DROP TABLE IF EXISTS slot_events')
+            conn.execute('DROP TABLE IF EXISTS lot_rollups')
+            conn.execute('DROP TABLE IF EXISTS slot_rollups')
+            conn.execute('DELETE FROM archive.logs')
+            conn.execute('PRAGMA user_version = 0')
+        return migrate(conn)
+    finally:
+        if own_conn:
+            conn.close()
@@ -1,142 +1,363 @@
 import paho.mqtt.client as mqtt
-import sqlite3
-from datetime import datetime
-import math
+import argparse
 import os
+import signal
+import subprocess
+import sys
 import time
+import zlib
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
-# Ensure database directory exists
-if not os.path.exists('database'):
-    os.makedirs('database')
+import allocation
+import analytics
+import db
+import dedupe
+import events
+import gates
+import lanes
+import lots
+import metrics
+import migrations
+import occupancy
+import profiler
+import rfid_cache
+import slot_protocol
+import timestamps
+import write_queue
 
-def get_db_connection():
-    conn = sqlite3.connect('database/db.sqlite3')
-    conn.row_factory = sqlite3.Row
-    return conn
+MQTT_HOST = os.environ.get('PARKING_MQTT_HOST', '192.168.154.42')
+MQTT_PORT = int(os.environ.get('PARKING_MQTT_PORT', '1883'))
 
-def format_duration(seconds):
-    """Convert seconds to hours and minutes format"""
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
-    
-    if hours == 0:
-        if minutes == 0:
-            return f"{seconds} second{'s' if seconds != 1 else ''}"
-        return f"{minutes} minute{'s' if minutes != 1 else ''} {seconds} second{'s' if seconds != 1 else ''}"
-    return f"{hours} hour{'s' if hours != 1 else ''} {minutes} minute{'s' if minutes != 1 else ''}"
-
-def calculate_parking_charge(seconds):
-    """Calculate parking charge based on duration in seconds"""
-    hours = seconds / 3600
-    # First hour or part thereof: ₹50
-    # Each additional hour or part thereof: ₹50
-    if hours <= 1:
-        return 50
-    # Round up to nearest hour
-    rounded_hours = math.ceil(hours)
-    return 50 + ((rounded_hours - 1) * 50)
+# Several handler processes can share the load (python mqtt_handler.py
+# --workers N). Sensor telemetry is spread over them by the broker through a
+# shared subscription. Every worker receives every card read but acts only on
+# the cards it owns, so one card's entry and exit are always handled, in
+# order, by the same worker.
+SHARE_GROUP = os.environ.get('PARKING_SHARE_GROUP', 'parking')
+# How long the broker keeps a stopped worker's session, so QoS 1 messages it
+# had not acknowledged are delivered again when it comes back
+SESSION_EXPIRY = int(os.environ.get('PARKING_MQTT_SESSION_EXPIRY', '300'))
+
+# This process's place among the workers; set by main()
+worker_index = 0
+worker_count = 1
+# Acknowledge messages only once what they caused is committed (set by main())
+manual_ack = False
+
+def subscriptions():
+    if worker_count == 1:
+        return [("parking/#", 1)]
+    share = f"$share/{SHARE_GROUP}/"
+    return [(share + "parking/slots", 1), (share + "parking/+/slots", 1),
+            ("parking/rfid", 1), ("parking/+/rfid", 1)]
+
+def card_of(payload):
+    """The card in an 'entry:<rfid>' or 'exit:<rfid>' payload (bytes)"""
+    parts = payload.split(b":")
+    return parts[1] if len(parts) > 1 else payload
+
+def owns_card(card):
+    return zlib.crc32(card) % worker_count == worker_index
 
 def on_connect(client, userdata, flags, reason_code, properties):
     print("Connected to MQTT broker")
-    client.subscribe("parking/#")
+    client.subscribe(subscriptions())
+
+def persist_slot(cur, lot_id, slot_num, status, at):
+    cur.execute('SELECT status FROM slots WHERE lot_id = ? AND slot_id = ?', (lot_id, slot_num))
+    row = cur.fetchone()
+    cur.execute('''
+        UPDATE slots 
+        SET status = ? 
+        WHERE lot_id = ? AND slot_id = ? AND status IS NOT ?
+    ''', (status, lot_id, slot_num, status))
+    changed = cur.rowcount
+    if changed:
+        analytics.record_slot(cur, lot_id, slot_num, row[0] if row else None, status, at)
+        # A car in the slot confirms its reservation
+        if status != 'free':
+            allocation.confirm(cur, lot_id, slot_num)
+    # Workers write every reading they get (see process_message), so only
+    # the database knows whether it was a change
+    if worker_count > 1 and changed:
+        events.publish('slot', lot_id=lot_id, slot_id=slot_num, status=status)
+        print(f"Slot {slot_num} in lot {lot_id} changed to {status}")
+
+def persist_entry(cur, rfid, in_time, lot_id, message=None, reply=None):
+    gates.open_session(cur, rfid, lot_id, in_time)
+    if message:
+        dedupe.persist(cur, rfid, message, in_time, reply)
+
+def persist_exit(cur, rfid, out_time, message=None, reply=None):
+    if message:
+        dedupe.persist(cur, rfid, message, out_time, reply)
+    # Close the open parking session
+    closed = gates.close_session(cur, rfid, out_time)
+    if not closed:
+        print(f"No open parking session left to close for RFID: {rfid}")
+        return
+    print(f"Updated exit log for RFID: {rfid}")
+    print(f"Duration: {timestamps.format_duration(closed.duration)}")
+    print(f"Amount: ₹{closed.amount}")
+
+# Database writes are batched on a background thread; on_message only reads
+# what it needs to answer the gate, reserves a slot for an entry, and queues
+# the rest.
+writer = write_queue.WriteBehindQueue(
+    handlers={
+        'slot': persist_slot,
+        'entry': persist_entry,
+        'exit': persist_exit,
+    },
+    coalesce=('slot',),
+)
+
+def session_open(cur, rfid):
+    """Whether the card is parked, counting entries and exits still in the write queue"""
+    open_sessions = (1 if gates.has_open_session(cur, rfid) else 0) \
+        + writer.pending('entry', rfid) - writer.pending('exit', rfid)
+    return open_sessions > 0
+
+# Slot state per lot as the sensors report it
+slots = occupancy.LotOccupancy()
+
+# Free-slot hints per lot for reserving a slot at entry; the reservation
+# itself is made in the database, so every worker sees it
+allocator = allocation.Allocator()
+
+# How often owner overrides made through the web app are picked up
+RESYNC_INTERVAL = 30
+
+# Gate decisions and sensor telemetry are processed in separate lanes so a
+# driver at the gate never waits behind a burst of slot updates.
+gate_lane = lanes.Lane(
+    'gate',
+    workers=int(os.environ.get('PARKING_GATE_WORKERS', '2')),
+    maxsize=int(os.environ.get('PARKING_GATE_QUEUE', '1000')),
+    # Wait rather than drop a driver's card read
+    block_timeout=1.0,
+)
+telemetry_lane = lanes.Lane(
+    'telemetry',
+    workers=int(os.environ.get('PARKING_TELEMETRY_WORKERS', '1')),
+    maxsize=int(os.environ.get('PARKING_TELEMETRY_QUEUE', '10000')),
+)
+
+# Users by RFID, plus whether each card is parked, so a swipe normally
+# needs no query at all
+users = rfid_cache.RfidCache()
+
+# Last card read acted on per card, to drop redelivered messages
+recent = dedupe.GateDedupe()
+
+# Time from an RFID message arriving to its gate reply being published
+gate_latency = lanes.LatencyRecorder()
+
+def setup():
+    """Prepare the database, slot state and worker threads for on_message"""
+    migrations.migrate()
+    with db.connection() as conn:
+        slots.load(conn)
+        recent.load(conn, timestamps.now())
+    writer.start()
+    gate_lane.start()
+    telemetry_lane.start()
+
+def shutdown():
+    gate_lane.stop()
+    telemetry_lane.stop()
+    writer.stop()
+
+metrics.queue_depth.add_callback(lambda: {
+    ('write',): writer.stats()['depth'],
+    ('gate_lane',): gate_lane.depth(),
+    ('telemetry_lane',): telemetry_lane.depth(),
+})
+metrics.Gauge('parking_write_queue_stats', 'Write-behind queue counters', ('counter',),
+              callback=lambda: {(name,): value for name, value in writer.stats().items()})
+
+METRICS_PORT = int(os.environ.get('PARKING_METRICS_PORT', '9105'))
+
+def publish_gate(client, decision, received, topic="parking/gates/status"):
+    client.publish(topic, decision)
+    # "entry:open:<slot>" counts as an open
+    gate, outcome = decision.split(":")[:2]
+    metrics.gate_decisions.inc(gate, outcome)
+    if received is not None:
+        elapsed = time.perf_counter() - received
+        gate_latency.observe(elapsed)
+        metrics.gate_reply_seconds.observe(elapsed, gate)
 
 def on_message(client, userdata, msg):
+    """paho callback: hand the message to its lane and return immediately"""
+    received = time.perf_counter()
+    lot_id, kind = lots.parse_topic(msg.topic)
+    if kind == "rfid":
+        # Key by card so entry and exit for one RFID stay in order
+        key = card_of(msg.payload)
+        if worker_count > 1 and not owns_card(key):
+            ack(client, msg)
+            return
+        lane = gate_lane
+    elif slot_protocol.is_compact(msg.payload):
+        # A compact message covers many slots; keep a lot's in order
+        key = (lot_id, None)
+        lane = telemetry_lane
+    else:
+        # Key by lot and slot so each sensor's readings stay in order
+        key = (lot_id, msg.payload.split(b":", 1)[0])
+        lane = telemetry_lane
+    # Drops are counted in the lane stats printed by main()
+    if not lane.submit(key, handle_message, client, userdata, msg, received):
+        ack(client, msg)
+
+def ack(client, msg):
+    if manual_ack and msg.qos > 0:
+        client.ack(msg.mid, msg.qos)
+
+def handle_message(client, userdata, msg, received=None):
+    """Process one message, recording its latency and DB time"""
+    start = time.perf_counter()
+    with metrics.track_db('mqtt'), profiler.scope('mqtt'):
+        process_message(client, userdata, msg, received)
+    if manual_ack:
+        # After a crash before this commit the broker delivers it again
+        writer.after_commit(lambda: ack(client, msg))
+    # Labels only take known values, so a client publishing junk payloads or
+    # topics can't create a new series with each message
+    lot_id, kind = lots.parse_topic(msg.topic)
+    if kind == "rfid":
+        event = msg.payload.split(b":", 1)[0].decode(errors='replace')
+        if event not in ('entry', 'exit'):
+            event = 'other'
+    elif kind == "slots":
+        event = 'slots' if slot_protocol.is_compact(msg.payload) else 'slot'
+    else:
+        event = 'other'
+    topic = msg.topic if slots.get(lot_id) is not None else 'other'
+    metrics.mqtt_event_seconds.observe(time.perf_counter() - start, topic, event)
+
+def process_message(client, userdata, msg, received=None):
     topic = msg.topic
-    payload = msg.payload.decode()
+    if slot_protocol.is_compact(msg.payload):
+        payload = f"<{len(msg.payload)} byte slot map>"
+    else:
+        payload = msg.payload.decode(errors='replace')
     print(f"Received message: {topic} - {payload}")
     
-    conn = get_db_connection()
+    # parking/<lot>/slots and parking/<lot>/rfid; the original parking/slots
+    # and parking/rfid topics belong to the default lot
+    lot_id, kind = lots.parse_topic(topic)
+    lot = slots.get(lot_id)
+    # Answer on the topic family the request came in on
+    reply_topic = lots.gate_topic(lot_id, legacy=topic == "parking/rfid")
+
+    conn = db.acquire()
     cur = conn.cursor()
     
     try:
-        if topic == "parking/slots":
-            # Handle slot updates
-            slot_num, status = payload.split(":")
-            # Validate slot number
+        if kind == "slots":
+            now = timestamps.now()
+            if lot is None:
+                print(f"Unknown lot: {lot_id}")
+                return
+            # One sensor ("3:occupied") or a compact slot map of many
             try:
-                slot_num = int(slot_num)
-                if slot_num < 1 or slot_num > 8:
-                    print(f"Invalid slot number: {slot_num}. Valid slots are: 1-8")
-                    return
-            except ValueError:
-                print(f"Invalid slot number format: {slot_num}")
+                readings = slot_protocol.decode(msg.payload)
+            except ValueError as e:
+                print(f"Invalid slot message: {str(e)}")
                 return
-                
-            cur.execute('''
-                UPDATE slots 
-                SET status = ? 
-                WHERE slot_id = ?
-            ''', (status, slot_num))
-            print(f"Updated slot {slot_num} status to {status}")
+            # Validate slot numbers
+            invalid = [slot_num for slot_num, _ in readings if not lot.exists(slot_num)]
+            if invalid:
+                print(f"Invalid slot number(s): {invalid[:10]} for lot {lot_id} ({lot.capacity} slots)")
+                readings = [reading for reading in readings if lot.exists(reading[0])]
+
+            if worker_count > 1:
+                # Other workers get these sensors' other readings, so this
+                # one can't tell a transition from a repeat
+                for slot_num, status in readings:
+                    writer.put('slot', (lot_id, slot_num), lot_id, slot_num, status, now)
+                return
+            # Controllers republish their full state periodically; only
+            # transitions are written
+            for slot_num in lot.update_many(readings):
+                status = lot.status(slot_num)
+                allocator.slot_changed(lot_id, slot_num, status)
+                writer.put('slot', (lot_id, slot_num), lot_id, slot_num, status, now)
+                events.publish('slot', lot_id=lot_id, slot_id=slot_num, status=status)
+                print(f"Slot {slot_num} in lot {lot_id} changed to {status}")
             
-        elif topic == "parking/rfid":
+        elif kind == "rfid":
             # Handle RFID events
+            now = timestamps.now()
+            if lot is None:
+                print(f"Unknown lot: {lot_id}")
+                gate = payload.split(":")[0]
+                publish_gate(client, f"{gate}:unauthorized", received, reply_topic)
+                return
+
+            # A redelivered read gets its gate opened again and changes nothing.
+            # It is only a redelivery if the card is still where that read put
+            # it: the card may have left or come back through /rfid_auth or
+            # the gate API since, which this process doesn't see
+            message = dedupe.message_key(lot_id, payload, getattr(msg, 'properties', None))
+            rfid = card_of(msg.payload).decode()
+            if recent.is_duplicate(rfid, message, now) \
+                    and session_open(cur, rfid) == payload.startswith("entry:"):
+                print(f"Duplicate message for RFID {rfid}, already handled")
+                reply = recent.reply(rfid) or f"{payload.split(':')[0]}:open"
+                publish_gate(client, reply, received, reply_topic)
+                return
+
             if payload.startswith("entry:"):
                 rfid = payload.split(":")[1]
                 # Check if user exists
-                cur.execute("SELECT * FROM user WHERE rfid = ?", (rfid,))
-                user = cur.fetchone()
-                cur.execute("SELECT COUNT(*) AS full_slots FROM slots WHERE status = 'occupied'")
-                full_slots = cur.fetchone()['full_slots']
-                total_slots = 8
-                if full_slots == total_slots:
-                    print("All slots are occupied. No entry allowed.")
-                    client.publish("parking/gates/status", "entry:full")
-                    return
-                    
-                elif user:
-                    cur.execute('''
-                        INSERT INTO logs (rfid, in_time, payment_status)
-                        VALUES (?, datetime('now', 'localtime'), 'unpaid')
-                    ''', (rfid,))
-                    print(f"Created entry log for RFID: {rfid}")
-                    # Publish gate open command
-                    client.publish("parking/gates/status", "entry:open")
+                user = users.lookup(conn, rfid)
+                if user:
+                    # Reserve the slot the driver is sent to before the gate
+                    # opens, so concurrent entries can't overfill the lot
+                    try:
+                        with db.transaction(conn):
+                            slot_id = allocator.reserve(cur, lot_id, rfid, now)
+                    except allocation.Full:
+                        print(f"All slots in lot {lot_id} are occupied or reserved. No entry allowed.")
+                        publish_gate(client, "entry:full", received, reply_topic)
+                        return
+
+                    # Queue the entry, then open the gate. The write waits for
+                    # room in a full queue: a late reply beats a car inside
+                    # with no session
+                    reply = f"entry:open:{slot_id}" if slot_id else "entry:open"
+                    writer.put('entry', rfid, rfid, now, lot_id, message, reply, wait=True)
+                    publish_gate(client, reply, received, reply_topic)
+                    recent.record(rfid, message, now, reply)
+                    events.publish('entry', lot_id=lot_id, rfid=rfid, name=user.name, slot_id=slot_id)
+                    print(f"Queued entry log for RFID: {rfid}, slot {slot_id}")
                 else:
                     print(f"User with RFID {rfid} not found. Please register first.")
-                    client.publish("parking/gates/status", "entry:unauthorized")
+                    publish_gate(client, "entry:unauthorized", received, reply_topic)
                     
             elif payload.startswith("exit:"):
                 rfid = payload.split(":")[1]
-                # Get the latest unpaid log
-                cur.execute('''
-                    SELECT * FROM logs 
-                    WHERE rfid = ? AND payment_status = 'unpaid'
-                    ORDER BY in_time DESC LIMIT 1
-                ''', (rfid,))
-                log = cur.fetchone()
-                
-                if log:
-                    # Calculate duration and amount
-                    entry_time = datetime.strptime(log['in_time'], "%Y-%m-%d %H:%M:%S")
-                    exit_time = datetime.now()
-                    duration_seconds = int((exit_time - entry_time).total_seconds())
-                    amount = calculate_parking_charge(duration_seconds)
-                    formatted_duration = format_duration(duration_seconds)
-                    
-                    cur.execute('''
-                        UPDATE logs 
-                        SET out_time = datetime('now', 'localtime'),
-                            duration = ?,
-                            amount = ?
-                        WHERE id = ?
-                    ''', (formatted_duration, amount, log['id']))
-                    print(f"Updated exit log for RFID: {rfid}")
-                    print(f"Duration: {formatted_duration}")
-                    print(f"Amount: ₹{amount}")
-                    # Publish gate open command
-                    client.publish("parking/gates/status", "exit:open")
+                # Always asked of the logs: the card may have left through
+                # /rfid_auth or the gate API, which this process doesn't see
+                if session_open(cur, rfid):
+                    # Queue the exit, waiting for room like an entry, then
+                    # open the gate
+                    writer.put('exit', rfid, rfid, now, message, "exit:open", wait=True)
+                    publish_gate(client, "exit:open", received, reply_topic)
+                    recent.record(rfid, message, now, "exit:open")
+                    events.publish('exit', lot_id=lot_id, rfid=rfid)
+                    print(f"Queued exit log for RFID: {rfid}")
                 else:
                     print(f"No active parking session found for RFID: {rfid}")
-                    client.publish("parking/gates/status", "exit:unauthorized")
-        
-        conn.commit()
+                    publish_gate(client, "exit:unauthorized", received, reply_topic)
     except Exception as e:
         print(f"Error processing message: {str(e)}")
-        conn.rollback()
     finally:
-        conn.close()
+        db.release(conn)
 
 def on_disconnect(client, userdata, flags, reason_code, properties):
     print("Disconnected from MQTT broker")
@@ -146,25 +367,95 @@ def on_disconnect(client, userdata, flags, reason_code, properties):
     except Exception as e:
         print(f"Reconnection failed: {str(e)}")
 
-# Create MQTT client with MQTTv5
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
+def start_workers(count):
+    """Run `count` handler processes and wait for them"""
+    # In their own sessions, so a Ctrl+C reaches them once, from here
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                 '--workers', str(count), '--worker-index', str(i)],
+                                start_new_session=True)
+               for i in range(count)]
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.send_signal(signal.SIGINT)
+        for worker in workers:
+            worker.wait()
+
+def main():
+    global worker_index, worker_count, manual_ack
+    parser = argparse.ArgumentParser(description="Parking MQTT handler")
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('PARKING_HANDLER_WORKERS', '1')),
+                        help="handler processes sharing the MQTT traffic (default 1)")
+    parser.add_argument('--worker-index', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.worker_index is None:
+        migrations.migrate()
+        start_workers(args.workers)
+        return
+    worker_index, worker_count = args.worker_index or 0, args.workers
+    manual_ack = True
+
+    setup()
+    metrics.start_http_server(METRICS_PORT + worker_index)
+
+    # MQTT v5 with a persistent session, so messages not yet acknowledged
+    # survive a restart
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                         client_id=f"parking-handler-{SHARE_GROUP}-{worker_index}",
+                         protocol=mqtt.MQTTv5)
+    client.manual_ack_set(True)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
 
-# Connect to broker
-client.connect("192.168.154.42", 1883, 60)  # Using localhost
+    # Connect to broker
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = SESSION_EXPIRY
+    client.connect(MQTT_HOST, MQTT_PORT, 60, clean_start=False, properties=properties)
 
-# Start the loop
-client.loop_start()
+    # Start the loop
+    client.loop_start()
 
-print("MQTT Handler is running...")
+    print(f"MQTT Handler is running (worker {worker_index + 1} of {worker_count})...")
+
+    try:
+        last_stats = last_resync = time.monotonic()
+        while True:
+            # Keep the script running
+            time.sleep(1)
+            if time.monotonic() - last_stats >= 60:
+                last_stats = time.monotonic()
+                print(f"Write queue: {writer.stats()}")
+                print(f"Lanes: gate {gate_lane.stats()}, telemetry {telemetry_lane.stats()}")
+                print(f"Gate latency (ms): {gate_latency.percentiles(50, 99)}")
+            if time.monotonic() - last_resync >= RESYNC_INTERVAL:
+                last_resync = time.monotonic()
+                with db.connection() as conn:
+                    with db.transaction(conn):
+                        allocation.expire(conn.cursor(), timestamps.now())
+                    changed = slots.resync(conn)
+                    for lot_id, slot_num in changed:
+                        allocator.slot_changed(lot_id, slot_num, slots.get(lot_id).status(slot_num))
+                    # Workers publish slot changes as they write them
+                    if worker_count > 1:
+                        changed = []
+                    for lot_id, slot_num in changed:
+                        status = slots.get(lot_id).status(slot_num)
+                        print(f"Slot {slot_num} in lot {lot_id} changed to {status} outside the handler")
+                        events.publish('slot', lot_id=lot_id, slot_id=slot_num, status=status)
+    except KeyboardInterrupt:
+        print("\nStopping MQTT Handler...")
+        # Flush queued writes first so their messages are acknowledged
+        shutdown()
+        client.disconnect()
+        client.loop_stop()
+        db.close_all()
+        if profiler.ENABLED:
+            print("Statements by total time:")
+            profiler.print_report()
 
-try:
-    while True:
-        # Keep the script running
-        time.sleep(1)
-except KeyboardInterrupt:
-    print("\nStopping MQTT Handler...")
-    client.loop_stop()
-    client.disconnect() 
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import threading
+import time
+
+# In-memory slot occupancy for the MQTT handler, one SlotOccupancy per lot.
+# Loaded from the slots table on start, then kept current from sensor
+# messages, so "is the lot full?" is a counter comparison and only real status
+# transitions reach the database. Slot ids index a bytearray, so a lot with
+# thousands of slots costs no more per update than one with eight.
+
+FREE = 'free'
+OCCUPIED = 'occupied'
+
+# Seconds an in-memory change is trusted over the database during resync,
+# long enough for the write-behind queue to have persisted it.
+RESYNC_GRACE = 5.0
+
+
+class SlotOccupancy:
+    """Status of every slot in a lot, with running free/occupied counts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = []           # status names; index is the status code
+        self._codes = {}              # status name -> code
+        self._slots = bytearray()     # slot_id -> status code (0 unused)
+        self._known = bytearray()     # slot_id -> 1 if the slot exists
+        self._changed_at = {}
+        self.capacity = 0
+        self.occupied = 0
+        self.free = 0
+        self._code(FREE)
+
+    def _code(self, status):
+        code = self._codes.get(status)
+        if code is None:
+            code = len(self._statuses)
+            self._statuses.append(status)
+            self._codes[status] = code
+        return code
+
+    def _grow(self, slot_id):
+        if slot_id >= len(self._slots):
+            extra = slot_id + 1 - len(self._slots)
+            self._slots.extend(bytes(extra))
+            self._known.extend(bytes(extra))
+
+    def _set(self, slot_id, status):
+        code = self._code(status)
+        self._grow(slot_id)
+        if not self._known[slot_id]:
+            self._known[slot_id] = 1
+            self.capacity += 1
+            old = None
+        else:
+            old = self._statuses[self._slots[slot_id]]
+            if old == status:
+                return False
+            self._adjust(old, -1)
+        self._slots[slot_id] = code
+        self._adjust(status, 1)
+        return old is not None
+
+    def _adjust(self, status, delta):
+        if status == OCCUPIED:
+            self.occupied += delta
+        elif status == FREE:
+            self.free += delta
+
+    def load(self, rows):
+        """Replace the state with (slot_id, status) rows from the slots table"""
+        with self._lock:
+            self._slots = bytearray()
+            self._known = bytearray()
+            self._changed_at = {}
+            self.capacity = self.occupied = self.free = 0
+            for slot_id, status in rows:
+                self._set(slot_id, status or FREE)
+        return self
+
+    def resync(self, rows):
+        """Pick up changes made outside the handler, e.g. owner overrides
+
+        Slots the handler changed itself within RESYNC_GRACE seconds are left
+        alone, since their write may still be waiting in the queue.
+        """
+        now = time.monotonic()
+        changed = []
+        with self._lock:
+            for slot_id, status in rows:
+                if now - self._changed_at.get(slot_id, 0) < RESYNC_GRACE:
+                    continue
+                if self.status(slot_id) != (status or FREE):
+                    self._set(slot_id, status or FREE)
+                    changed.append(slot_id)
+        return changed
+
+    def exists(self, slot_id):
+        return 0 <= slot_id < len(self._known) and self._known[slot_id] == 1
+
+    def status(self, slot_id):
+        if not self.exists(slot_id):
+            return None
+        return self._statuses[self._slots[slot_id]]
+
+    def update(self, slot_id, status):
+        """Record a sensor reading; returns True only if the status changed"""
+        if not self.exists(slot_id):
+            raise KeyError(slot_id)
+        with self._lock:
+            changed = self._set(slot_id, status)
+            if changed:
+                self._changed_at[slot_id] = time.monotonic()
+            return changed
+
+    def update_many(self, readings):
+        """Record [(slot_id, status)] readings; returns the slot ids that changed"""
+        for slot_id, _ in readings:
+            if not self.exists(slot_id):
+                raise KeyError(slot_id)
+        changed = []
+        with self._lock:
+            now = time.monotonic()
+            for slot_id, status in readings:
+                if self._statuses[self._slots[slot_id]] != status and self._set(slot_id, status):
+                    self._changed_at[slot_id] = now
+                    changed.append(slot_id)
+        return changed
+
+    def is_full(self):
+        return self.capacity > 0 and self.occupied >= self.capacity
+
+    def counts(self):
+        return {'capacity': self.capacity, 'occupied': self.occupied, 'free': self.free}
+
+
+class LotOccupancy:
+    """A SlotOccupancy for every lot"""
+
+    def __init__(self):
+        self._lots = {}
+
+    def _rows_by_lot(self, conn):
+        by_lot = {row[0]: [] for row in conn.execute("SELECT lot_id FROM lots")}
+        for lot_id, slot_id, status in conn.execute("SELECT lot_id, slot_id, status FROM slots"):
+            by_lot.setdefault(lot_id, []).append((slot_id, status))
+        return by_lot
+
+    def load(self, conn):
+        self._lots = {lot_id: SlotOccupancy().load(rows)
+                      for lot_id, rows in self._rows_by_lot(conn).items()}
+        return self
+
+    def resync(self, conn):
+        """Pick up outside changes in every lot; returns [(lot_id, slot_id)] changed
+
+        Lots created since the last load or resync are added.
+        """
+        changed = []
+        lots = dict(self._lots)
+        for lot_id, rows in self._rows_by_lot(conn).items():
+            if lot_id not in lots:
+                lots[lot_id] = SlotOccupancy().load(rows)
+                continue
+            changed.extend((lot_id, slot_id) for slot_id in lots[lot_id].resync(rows))
+        self._lots = lots
+        return changed
+
+    def get(self, lot_id):
+        """The lot's SlotOccupancy, or None for an unknown lot"""
+        return self._lots.get(lot_id)
+
+    def counts(self):
+        return {lot_id: lot.counts() for lot_id, lot in self._lots.items()}
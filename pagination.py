@@ -0,0 +1,82 @@
+import base64
+import json
+
+# Keyset (cursor) pagination. A page is fetched with "WHERE key < last key
+# seen ORDER BY key DESC LIMIT n", which walks an index from where the previous
+# page stopped, so page 1000 costs the same as page 1. The cursor handed to
+# clients is the opaque, URL-safe encoding of that last key.
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    if not isinstance(key, list):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    return key
+
+
+def page_size(value):
+    """Parse a ?limit= argument, clamped to MAX_PAGE_SIZE"""
+    try:
+        size = int(value) if value else DEFAULT_PAGE_SIZE
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def fetch_page(cur, sql, params, key_columns, cursor, limit, where='WHERE'):
+    """Run one page of a keyset query
+
+    `sql` is the query up to (but not including) its ordering; it gets
+    "<where> (key...) < (?...)" appended when a cursor is given, then
+    "ORDER BY key DESC LIMIT n". Pass where='AND' when `sql` already has a
+    WHERE clause. Returns (rows, next_cursor); next_cursor is None on the
+    last page.
+    """
+    key = decode_cursor(cursor)
+    params = list(params)
+    columns = ', '.join(key_columns)
+
+    if key is not None:
+        if len(key) != len(key_columns):
+            raise InvalidCursor(f"Invalid cursor: {cursor}")
+        placeholders = ', '.join('?' for _ in key_columns)
+        sql += f" {where} ({columns}) < ({placeholders})"
+        params.extend(key)
+
+    order = ', '.join(f"{column} DESC" for column in key_columns)
+    # One extra row tells us whether there is a next page
+    sql += f" ORDER BY {order} LIMIT ?"
+    params.append(limit + 1)
+
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[_key_name(column)] for column in key_columns)
+    return rows, next_cursor
+
+
+def _key_name(column):
+    # "logs.in_time" is returned by sqlite3.Row as "in_time"
+    return column.rsplit('.', 1)[-1]
@@ -85,22 +85,124 @@ void callback(char* topic, byte* payload, unsigned int length) {
   }
 }
 
-// Function to publish IR sensor statuses
-void updateSlotStatus() {
-  for (int i = 1; i <= 4; i++) {
-    int sensorState = 0;
-    switch (i) {
-      case 1: sensorState = digitalRead(IR_SENSOR_1); break;
-      case 2: sensorState = digitalRead(IR_SENSOR_2); break;
-      case 3: sensorState = digitalRead(IR_SENSOR_3); break;
-      case 4: sensorState = digitalRead(IR_SENSOR_4); break;
+// Slot status protocol. Compact messages (slot_protocol.py on the server)
+// report many sensors in one binary payload: the sensors that changed as
+// soon as they change, and every sensor as a heartbeat. Set to 0 to go back
+// to one "3:occupied" text message per sensor.
+#define COMPACT_SLOT_STATUS 1
+
+const int SENSOR_COUNT = 4;
+const int SENSOR_PINS[SENSOR_COUNT] = {IR_SENSOR_1, IR_SENSOR_2, IR_SENSOR_3, IR_SENSOR_4};
+// Slot number each sensor reports
+const uint16_t SLOT_IDS[SENSOR_COUNT] = {1, 2, 5, 6};
+
+const unsigned long sensorPollInterval = 500;   // ms between sensor reads
+const unsigned long heartbeatInterval = 9000;   // ms between full-state messages
+
+const uint8_t PROTOCOL_VERSION = 1;
+const uint8_t ENCODING_BITMAP = 0;
+const uint8_t ENCODING_LIST = 1;
+
+bool slotOccupied[SENSOR_COUNT];
+bool slotStateKnown = false;
+
+bool readSensor(int i) {
+  return digitalRead(SENSOR_PINS[i]) == LOW;
+}
+
+// True when the sensors cover consecutive slot numbers, so the heartbeat can
+// be a bitmap
+bool slotsContiguous() {
+  for (int i = 1; i < SENSOR_COUNT; i++) {
+    if (SLOT_IDS[i] != SLOT_IDS[0] + i) {
+      return false;
     }
-    String status = (sensorState == LOW) ? "occupied" : "free";
-    String message = (i <= 2) ? String(i) + ":" + status : String(i + 2) + ":" + status;
+  }
+  return true;
+}
+
+bool publishSlotBitmap() {
+  uint8_t payload[6 + (SENSOR_COUNT + 7) / 8] = {0};
+  payload[0] = PROTOCOL_VERSION;
+  payload[1] = ENCODING_BITMAP;
+  payload[2] = SLOT_IDS[0] >> 8;
+  payload[3] = SLOT_IDS[0] & 0xFF;
+  payload[4] = SENSOR_COUNT >> 8;
+  payload[5] = SENSOR_COUNT & 0xFF;
+  for (int i = 0; i < SENSOR_COUNT; i++) {
+    if (slotOccupied[i]) {
+      payload[6 + i / 8] |= 1 << (i % 8);
+    }
+  }
+  return client.publish("parking/slots", payload, sizeof(payload));
+}
+
+// Publish the sensors flagged in `include` as a list
+bool publishSlotList(const bool include[]) {
+  uint8_t payload[4 + 2 * SENSOR_COUNT];
+  uint16_t count = 0;
+  for (int i = 0; i < SENSOR_COUNT; i++) {
+    if (include[i]) {
+      uint16_t entry = SLOT_IDS[i] | (slotOccupied[i] ? 0x8000 : 0);
+      payload[4 + 2 * count] = entry >> 8;
+      payload[5 + 2 * count] = entry & 0xFF;
+      count++;
+    }
+  }
+  if (count == 0) {
+    return true;
+  }
+  payload[0] = PROTOCOL_VERSION;
+  payload[1] = ENCODING_LIST;
+  payload[2] = count >> 8;
+  payload[3] = count & 0xFF;
+  return client.publish("parking/slots", payload, 4 + 2 * count);
+}
+
+// Every sensor's current state
+void publishSlotHeartbeat() {
+  bool ok;
+  if (slotsContiguous()) {
+    ok = publishSlotBitmap();
+  } else {
+    bool all[SENSOR_COUNT];
+    for (int i = 0; i < SENSOR_COUNT; i++) {
+      all[i] = true;
+    }
+    ok = publishSlotList(all);
+  }
+  Serial.println(ok ? "Slot heartbeat sent to MQTT" : "Failed to publish slot heartbeat");
+}
+
+// Read the sensors; publish whichever changed since the last read
+void publishSlotChanges() {
+  bool changed[SENSOR_COUNT];
+  bool any = false;
+  for (int i = 0; i < SENSOR_COUNT; i++) {
+    bool occupied = readSensor(i);
+    changed[i] = !slotStateKnown || occupied != slotOccupied[i];
+    slotOccupied[i] = occupied;
+    any = any || changed[i];
+  }
+  slotStateKnown = true;
+  if (any) {
+    if (publishSlotList(changed)) {
+      Serial.println("Slot changes sent to MQTT");
+    } else {
+      Serial.println("Failed to publish slot changes");
+    }
+  }
+}
+
+// Function to publish IR sensor statuses, one text message per sensor
+void updateSlotStatus() {
+  for (int i = 0; i < SENSOR_COUNT; i++) {
+    String status = readSensor(i) ? "occupied" : "free";
+    String message = String(SLOT_IDS[i]) + ":" + status;
     if (client.publish("parking/slots", message.c_str())) {
-      Serial.println("Slot " + String(i) + " status sent to MQTT: " + message);
+      Serial.println("Slot " + String(i + 1) + " status sent to MQTT: " + message);
     } else {
-      Serial.println("Failed to publish slot status for slot " + String(i));
+      Serial.println("Failed to publish slot status for slot " + String(i + 1));
     }
   }
 }
@@ -167,6 +269,19 @@ void loop() {
     rfidExit.PCD_StopCrypto1();
   }
 
+#if COMPACT_SLOT_STATUS
+  // Send slot changes as they happen, and the full state every 9 seconds
+  static unsigned long lastPollTime = 0;
+  static unsigned long lastHeartbeatTime = 0;
+  if (millis() - lastPollTime >= sensorPollInterval) {
+    lastPollTime = millis();
+    publishSlotChanges();
+  }
+  if (millis() - lastHeartbeatTime >= heartbeatInterval) {
+    lastHeartbeatTime = millis();
+    publishSlotHeartbeat();
+  }
+#else
   // Update IR sensor statuses every 9 seconds
   static unsigned long lastUpdateTime = 0;
   const unsigned long updateInterval = 9000;
@@ -174,4 +289,5 @@ void loop() {
     lastUpdateTime = millis();
     updateSlotStatus();
   }
+#endif
 }
@@ -0,0 +1,248 @@
+"""Opt-in SQL profiling for the db layer
+
+Set PARKING_PROFILE=1 and every statement run through a db.py connection is
+recorded with its wall time (execute plus fetches), rows returned or
+changed, SQLite VM steps (counted by a progress handler), statements run by
+triggers (seen by the trace callback) and the line of our code that ran it.
+
+* Statements slower than PARKING_SLOW_QUERY_MS (default 50) are printed
+  with the parts of their plan that scan a table or sort.
+* The same SQL run from the same line PARKING_REPEAT_THRESHOLD (default 10)
+  or more times in one web request, MQTT message or gate API batch is
+  printed when the scope ends, as a likely N+1 query.
+* Totals per statement are kept for report(). app.py serves them at
+  /debug/queries and mqtt_handler.py prints them when it stops.
+
+Each statement costs a stack walk and a few dict updates, so this is for
+development and load tests rather than production. query_plans.py uses the
+same hooks to check the plans of the hot queries.
+"""
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('PARKING_PROFILE') == '1'
+SLOW_MS = float(os.environ.get('PARKING_SLOW_QUERY_MS', '50'))
+REPEAT_THRESHOLD = int(os.environ.get('PARKING_REPEAT_THRESHOLD', '10'))
+
+# VM instructions between progress handler calls
+PROGRESS_INTERVAL = 1000
+
+# Files skipped when looking for the line that ran a statement
+_INTERNAL = {'db.py', 'profiler.py', 'pagination.py', 'contextlib.py'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+
+
+class Statement:
+    """One run of a statement, filled in as it executes and its rows are fetched"""
+    __slots__ = ('sql', 'params', 'site', 'conn', 'seconds', 'rows', 'steps',
+                 'triggers', 'logged')
+
+    def __init__(self, sql, params, site, conn):
+        self.sql = sql
+        self.params = params
+        self.site = site
+        self.conn = conn
+        self.seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+        # The statement's own trace is not a trigger
+        self.triggers = -1
+        self.logged = False
+
+
+def _state():
+    state = _local.__dict__
+    if not state:
+        state.update(current=None, steps=0, scope=None, captured=None, explaining=False)
+    return state
+
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in _INTERNAL:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def install(conn):
+    """Add the progress handler and trace callback to a new connection"""
+    conn.set_progress_handler(_progress, PROGRESS_INTERVAL)
+    conn.set_trace_callback(_trace)
+
+
+def _progress():
+    _state()['steps'] += PROGRESS_INTERVAL
+    return 0
+
+
+def _trace(sql):
+    # sqlite3 traces a statement once, then once more for each trigger program
+    # and each statement in it, all with the statement's own SQL
+    stmt = _state()['current']
+    if stmt is not None:
+        stmt.triggers += 1
+
+
+def mark():
+    """(time, steps) now, for measuring a fetch"""
+    return time.perf_counter(), _state()['steps']
+
+
+def begin(cursor, sql, params, many=False):
+    """Start recording a statement; called by db.ProfiledCursor
+
+    For executemany() params is the list of rows, and the first one is kept
+    for explaining the statement.
+    """
+    state = _state()
+    if state['explaining']:
+        return None
+    if many:
+        params = params[0] if params else None
+    if state['captured'] is not None:
+        state['captured'].append((sql, params))
+    stmt = Statement(' '.join(sql.split()), params, _call_site(), cursor.connection)
+    state['current'] = stmt
+    if state['scope'] is not None:
+        key = (stmt.sql, stmt.site)
+        state['scope'][key] = state['scope'].get(key, 0) + 1
+    with _lock:
+        entry = _stats.get(stmt.sql)
+        if entry is None:
+            entry = _stats[stmt.sql] = {'sql': stmt.sql, 'calls': 0, 'seconds': 0.0, 'max_ms': 0.0,
+                                        'rows': 0, 'steps': 0, 'triggers': 0, 'repeats': 0,
+                                        'sites': {}}
+        entry['calls'] += 1
+        entry['sites'][stmt.site] = entry['sites'].get(stmt.site, 0) + 1
+    return stmt
+
+
+def end(stmt, cursor, started):
+    """Finish the execute part of a statement; started is mark() from before it"""
+    if stmt is None:
+        return None
+    rows = cursor.rowcount if cursor.rowcount > 0 else 0
+    _add(stmt, started, rows)
+    _state()['current'] = None
+    return stmt
+
+
+def fetched(stmt, started, rows):
+    """Add a fetch of `rows` rows to the statement that produced them"""
+    if stmt is not None:
+        _add(stmt, started, rows)
+
+
+def _add(stmt, started, rows):
+    seconds = time.perf_counter() - started[0]
+    steps = _state()['steps'] - started[1]
+    stmt.seconds += seconds
+    stmt.rows += rows
+    stmt.steps += steps
+    with _lock:
+        entry = _stats[stmt.sql]
+        entry['seconds'] += seconds
+        entry['rows'] += rows
+        entry['steps'] += steps
+        entry['triggers'] += max(0, stmt.triggers)
+        entry['max_ms'] = max(entry['max_ms'], stmt.seconds * 1000)
+    stmt.triggers = 0
+    if not stmt.logged and stmt.seconds * 1000 >= SLOW_MS:
+        stmt.logged = True
+        _log_slow(stmt)
+
+
+def plan(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN lines for a statement, without recording the EXPLAIN itself"""
+    state = _state()
+    state['explaining'] = True
+    try:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    finally:
+        state['explaining'] = False
+
+
+def problems(plan_lines):
+    """The plan lines that read a whole table or sort rows for ORDER BY"""
+    return [line for line in plan_lines
+            if (line.startswith('SCAN ') and ' USING ' not in line
+                and not line.startswith('SCAN CONSTANT ROW'))
+            or line.startswith('USE TEMP B-TREE FOR ORDER BY')]
+
+
+def _log_slow(stmt):
+    print(f"Slow query: {stmt.seconds * 1000:.1f} ms, {stmt.rows} rows, {stmt.steps} steps "
+          f"at {stmt.site}: {stmt.sql[:500]}")
+    if stmt.params is not None:
+        try:
+            for line in problems(plan(stmt.conn, stmt.sql, stmt.params)):
+                print(f"    plan: {line}")
+        except Exception as e:
+            print(f"    plan unavailable: {str(e)}")
+
+
+def begin_scope():
+    """Start counting repeated statements, e.g. at the start of a request"""
+    if ENABLED:
+        _state()['scope'] = {}
+
+
+def end_scope(name):
+    """Report statements repeated REPEAT_THRESHOLD times or more since begin_scope()"""
+    if not ENABLED:
+        return
+    state = _state()
+    scope, state['scope'] = state['scope'], None
+    for (sql, site), count in (scope or {}).items():
+        if count >= REPEAT_THRESHOLD:
+            with _lock:
+                _stats[sql]['repeats'] += 1
+            print(f"Repeated query in {name}: {count}x at {site}: {sql[:500]}")
+
+
+@contextmanager
+def scope(name):
+    begin_scope()
+    try:
+        yield
+    finally:
+        end_scope(name)
+
+
+@contextmanager
+def capture():
+    """Collect the (sql, params) of every statement this thread runs in the block"""
+    state = _state()
+    state['captured'] = captured = []
+    try:
+        yield captured
+    finally:
+        state['captured'] = None
+
+
+def report(limit=20):
+    """The `limit` statements with the most total time, slowest first"""
+    with _lock:
+        entries = sorted(_stats.values(), key=lambda entry: entry['seconds'], reverse=True)[:limit]
+        return [dict(entry, seconds=round(entry['seconds'], 6), max_ms=round(entry['max_ms'], 3),
+                     mean_ms=round(entry['seconds'] * 1000 / entry['calls'], 3),
+                     sites=dict(entry['sites'])) for entry in entries]
+
+
+def print_report(limit=20):
+    for entry in report(limit):
+        print(f"{entry['seconds']:9.3f} s {entry['calls']:7} calls {entry['mean_ms']:8.3f} ms avg "
+              f"{entry['rows']:9} rows {entry['steps']:11} steps  {entry['sql'][:120]}")
+
+
+def reset():
+    with _lock:
+        _stats.clear()
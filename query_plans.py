@@ -0,0 +1,157 @@
+"""EXPLAIN QUERY PLAN checks for the hot queries
+
+Runs the code behind each hot path (the exit lookup, the dashboard log
+page, a user's history pages, slot reservation and the lot occupancy
+counts), captures the statements it executes and fails if any of their
+plans reads a whole table or sorts rows for ORDER BY instead of walking an
+index. Writes are rolled
+back. By default it runs against a scratch database with a few rows. Pass
+--db to check a real one, whose ANALYZE statistics can change plans.
+
+    python query_plans.py              # exits 1 if a hot query lost its index
+    python query_plans.py --db database/db.sqlite3 --verbose
+
+benchmarks/suite.py runs the same check on each database it benchmarks and
+fails if any hot path lost its index.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import allocation
+import billing
+import db
+import gates
+import lots
+import migrations
+import profiler
+import timestamps
+
+# Tables small enough that reading all of them is fine
+SMALL_TABLES = ('lots',)
+
+
+def seed(conn, cards=3, sessions=60):
+    """A lot, a few users and enough logs for a second page of each list"""
+    now = timestamps.now()
+    with db.transaction(conn):
+        cur = conn.cursor()
+        lots.ensure_lot(cur, lots.DEFAULT_LOT, slots=8)
+        for i in range(cards):
+            rfid = f'PLAN{i}'
+            cur.execute("INSERT INTO user (rfid, name, role) VALUES (?, ?, 'user')", (rfid, f'Plan user {i}'))
+            for j in range(sessions):
+                in_time = now - (j + 1) * 7200
+                cur.execute('''
+                    INSERT INTO logs (rfid, in_time, out_time, duration, amount, payment_status, lot_id)
+                    VALUES (?, ?, ?, 3600, 50, ?, ?)
+                ''', (rfid, in_time, in_time + 3600, 'paid' if j % 2 else 'unpaid', lots.DEFAULT_LOT))
+            gates.open_session(cur, rfid, lots.DEFAULT_LOT, now)
+
+
+def _pages(fetch):
+    """The first two pages of a paginated list"""
+    items, next_cursor = fetch(None)
+    if next_cursor:
+        fetch(next_cursor)
+
+
+def hot_paths(conn, rfid):
+    """[(name, function of a cursor)] for every hot path"""
+    import app
+
+    def rolled_back(run):
+        def path(cur):
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                run(cur)
+            finally:
+                conn.rollback()
+        return path
+
+    def exit_lookup(cur):
+        gates.has_open_session(cur, rfid)
+        rolled_back(lambda cur: gates.close_session(cur, rfid, timestamps.now()))(cur)
+
+    def reservation(cur):
+        # A fresh allocator has no free-slot hints, so it loads them too
+        allocation.Allocator().reserve(cur, lots.DEFAULT_LOT, rfid, timestamps.now())
+        allocation.confirm(cur, lots.DEFAULT_LOT, 1)
+
+    return [
+        ('exit lookup', exit_lookup),
+        ('dashboard logs', lambda cur: _pages(lambda cursor: app.owner_logs_page(cur, cursor))),
+        ('user history (unpaid)',
+         lambda cur: _pages(lambda cursor: app.user_history_page(cur, rfid, 'unpaid', cursor))),
+        ('user history (paid)',
+         lambda cur: _pages(lambda cursor: app.user_history_page(cur, rfid, 'paid', cursor))),
+        ('user totals', lambda cur: billing.totals(cur, rfid)),
+        ('slot reservation', rolled_back(reservation)),
+        ('occupancy count', lots.summary),
+        ('card lookup', lambda cur: (app.users.invalidate(rfid), app.users.lookup(conn, rfid))),
+    ]
+
+
+def explainable(sql):
+    return sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def check(conn, rfid, verbose=False):
+    """Names of the hot paths with a bad plan, printing each problem"""
+    failed = []
+    for name, run in hot_paths(conn, rfid):
+        with profiler.capture() as statements:
+            run(conn.cursor())
+        seen = set()
+        for sql, params in statements:
+            if not explainable(sql) or params is None or sql in seen:
+                continue
+            seen.add(sql)
+            plan = profiler.plan(conn, sql, params)
+            bad = [line for line in profiler.problems(plan)
+                   if not any(line == f'SCAN {table}' for table in SMALL_TABLES)]
+            if verbose or bad:
+                print(f"{name}: {' '.join(sql.split())[:200]}")
+                for line in plan:
+                    print(f"    {'!! ' if line in bad else ''}{line}")
+            if bad and name not in failed:
+                failed.append(name)
+        if not statements:
+            print(f"{name}: ran no statements")
+            failed.append(name)
+    return failed
+
+
+def check_database(path=None, rfid=None, verbose=False):
+    """check() on the database at path, or on a seeded scratch one; returns failed paths"""
+    # Statements are captured through the profiling cursor
+    enabled, profiler.ENABLED = profiler.ENABLED, True
+    scratch = not path
+    path = path or os.path.join(tempfile.mkdtemp(prefix='query-plans-'), 'db.sqlite3')
+    db.configure(path)
+    conn = db.open_connection(path)
+    try:
+        migrations.migrate(conn)
+        if scratch:
+            seed(conn)
+        rfid = rfid or conn.execute(
+            "SELECT rfid FROM logs ORDER BY in_time DESC LIMIT 1").fetchone()[0]
+        return check(conn, rfid, verbose)
+    finally:
+        conn.close()
+        db.close_all()
+        profiler.ENABLED = enabled
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the query plans of the hot paths")
+    parser.add_argument('--db', help="database to check (default: a scratch one with sample rows)")
+    parser.add_argument('--rfid', help="card to look up (default: the latest card in the logs)")
+    parser.add_argument('--verbose', action='store_true', help="print every plan, not just bad ones")
+    args = parser.parse_args()
+
+    failed = check_database(args.db, args.rfid, args.verbose)
+    print(f"{len(failed)} hot path(s) not using an index" + (f": {', '.join(failed)}" if failed else ""))
+    if failed:
+        sys.exit(1)
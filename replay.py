@@ -0,0 +1,268 @@
+"""Record parking/# MQTT traffic and replay it against the handler
+
+Recording:
+
+    python replay.py record morning.pkr --host 192.168.154.42
+
+Replay in-process (no broker; messages go straight to mqtt_handler):
+
+    python replay.py replay morning.pkr --speed 10
+    python replay.py replay morning.pkr --speed 0        # as fast as possible
+
+An in-process replay writes logs, billing totals and rollups like the real
+handler, so by default it runs against a scratch copy of PARKING_DB, never
+the database itself. --db picks the database to replay into instead.
+
+Replay against a broker that a running mqtt_handler is subscribed to:
+
+    python replay.py replay morning.pkr --broker localhost --speed 1
+"""
+import argparse
+import contextlib
+import gzip
+import io
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+MAGIC = b'PKRC1\n'
+# milliseconds since recording start, topic length, payload length
+RECORD = struct.Struct('<IHH')
+
+GATE_TOPIC = 'parking/gates/status'
+# Replies for every lot: parking/<lot>/gates/status
+LOT_GATE_TOPICS = 'parking/+/gates/status'
+
+
+def is_gate_reply(topic):
+    return topic.endswith('/gates/status')
+
+
+class Recorder:
+    """Appends timestamped messages to a gzip-compressed capture file"""
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wb')
+        self._file.write(MAGIC)
+        self._start = None
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def write(self, topic, payload, now=None):
+        now = time.monotonic() if now is None else now
+        topic = topic.encode()
+        with self._lock:
+            if self._start is None:
+                self._start = now
+            offset = int((now - self._start) * 1000)
+            self._file.write(RECORD.pack(offset, len(topic), len(payload)))
+            self._file.write(topic)
+            self._file.write(payload)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """Yield (offset_seconds, topic, payload) from a capture file"""
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a parking capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            offset, topic_len, payload_len = RECORD.unpack(header)
+            topic = f.read(topic_len).decode()
+            payload = f.read(payload_len)
+            yield offset / 1000, topic, payload
+
+
+def record(path, host, port, duration=None):
+    import paho.mqtt.client as mqtt
+
+    recorder = Recorder(path)
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        print(f"Recording parking/# to {path}")
+        client.subscribe("parking/#")
+
+    def on_message(client, userdata, msg):
+        recorder.write(msg.topic, msg.payload)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    client.loop_start()
+
+    started = time.monotonic()
+    try:
+        while duration is None or time.monotonic() - started < duration:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        recorder.close()
+    print(f"Recorded {recorder.count} messages")
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class StubClient:
+    """Stands in for the paho client when the handler is driven in-process"""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload):
+        self.published += 1
+
+
+def _paced(messages, speed):
+    """Yield messages on the capture's schedule, sped up `speed` times (0 = no waiting)"""
+    start = time.perf_counter()
+    for offset, topic, payload in messages:
+        if speed:
+            delay = start + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield topic, payload
+
+
+def scratch_copy():
+    """Copy the configured database to a temporary file; returns its path"""
+    import db
+
+    work = os.path.join(tempfile.mkdtemp(prefix='replay-'), 'db.sqlite3')
+    if os.path.exists(db.DB_PATH):
+        # The backup API takes a consistent copy even while the handler writes
+        source = sqlite3.connect(db.DB_PATH)
+        target = sqlite3.connect(work)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    return work
+
+
+def replay_in_process(path, speed, db_path=None):
+    """Run a capture through mqtt_handler against db_path (default: a scratch copy)"""
+    import db
+
+    db.configure(db_path or scratch_copy())
+    import mqtt_handler
+
+    messages = [m for m in read_capture(path) if not is_gate_reply(m[1])]
+    client = StubClient()
+    with contextlib.redirect_stdout(io.StringIO()):
+        mqtt_handler.setup()
+        start = time.perf_counter()
+        for topic, payload in _paced(messages, speed):
+            mqtt_handler.on_message(client, None, Message(topic, payload))
+        # Wait for the lanes to finish what they were given
+        mqtt_handler.shutdown()
+        elapsed = time.perf_counter() - start
+
+    return {
+        'messages': len(messages),
+        'seconds': round(elapsed, 3),
+        'events_per_second': round(len(messages) / elapsed, 1) if elapsed else None,
+        'gate_replies': client.published,
+        'gate_latency_ms': mqtt_handler.gate_latency.percentiles(50, 99),
+        'lanes': {'gate': mqtt_handler.gate_lane.stats(),
+                  'telemetry': mqtt_handler.telemetry_lane.stats()},
+        'writer': mqtt_handler.writer.stats(),
+    }
+
+
+def replay_to_broker(path, host, port, speed, settle=2.0):
+    import paho.mqtt.client as mqtt
+    import lanes
+
+    messages = [m for m in read_capture(path) if not is_gate_reply(m[1])]
+    latency = lanes.LatencyRecorder(size=len(messages) or 1)
+    # The handler answers RFID reads in order, so match replies first-in first-out
+    waiting = []
+    lock = threading.Lock()
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe([(GATE_TOPIC, 0), (LOT_GATE_TOPICS, 0)])
+
+    def on_message(client, userdata, msg):
+        with lock:
+            if waiting:
+                latency.since(waiting.pop(0))
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    client.loop_start()
+    time.sleep(0.5)
+
+    start = time.perf_counter()
+    for topic, payload in _paced(messages, speed):
+        if topic.endswith('/rfid'):
+            with lock:
+                waiting.append(time.perf_counter())
+        client.publish(topic, payload)
+    sent = time.perf_counter() - start
+
+    # Give the handler time to answer the last gate reads
+    deadline = time.monotonic() + settle
+    while waiting and time.monotonic() < deadline:
+        time.sleep(0.05)
+    client.loop_stop()
+    client.disconnect()
+
+    return {
+        'messages': len(messages),
+        'seconds': round(sent, 3),
+        'events_per_second': round(len(messages) / sent, 1) if sent else None,
+        'gate_latency_ms': latency.percentiles(50, 99),
+        'unanswered_gate_reads': len(waiting),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay parking MQTT traffic")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record', help="capture parking/# from a broker")
+    rec.add_argument('path')
+    rec.add_argument('--host', default='localhost')
+    rec.add_argument('--port', type=int, default=1883)
+    rec.add_argument('--duration', type=float, help="seconds to record (default: until Ctrl+C)")
+
+    rep = sub.add_parser('replay', help="feed a capture back to the handler")
+    rep.add_argument('path')
+    rep.add_argument('--speed', type=float, default=1,
+                     help="1 = real time, 10 = ten times faster, 0 = as fast as possible")
+    rep.add_argument('--broker', help="publish to this broker instead of calling the handler in-process")
+    rep.add_argument('--port', type=int, default=1883)
+    rep.add_argument('--db', help="database for an in-process replay (default: a scratch copy of PARKING_DB)")
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.path, args.host, args.port, args.duration)
+    elif args.broker:
+        print(replay_to_broker(args.path, args.broker, args.port, args.speed))
+    else:
+        print(replay_in_process(args.path, args.speed, args.db))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import collections
+import os
+import threading
+import time
+
+import metrics
+
+# In-memory RFID -> user cache for gate decisions. Unknown cards are cached
+# too, so a stream of bad reads doesn't hit the database either.
+#
+# Invalidation: this process drops a card's entry itself when it changes the
+# user. Changes made by other processes are picked up through the
+# cache_generation table, which triggers bump on every insert, delete or
+# name/role change in user; the cache reads it at most once per
+# CHECK_INTERVAL and starts over when it has moved.
+#
+# Whether a card is parked is not cached: cards enter and leave through
+# several processes, and nothing tells the others, so gates ask the logs.
+
+CACHE_SIZE = int(os.environ.get('PARKING_RFID_CACHE_SIZE', '10000'))
+CHECK_INTERVAL = 1.0
+
+CachedUser = collections.namedtuple('CachedUser', 'role name')
+
+
+class RfidCache:
+    """Bounded LRU of card -> CachedUser (or None for unknown cards)"""
+
+    def __init__(self, maxsize=CACHE_SIZE, check_interval=CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0.0
+        # Bumped on every clear so a lookup that raced with one doesn't
+        # store what it read before it
+        self._epoch = 0
+
+    def lookup(self, conn, rfid):
+        """The card's CachedUser, or None if no such user"""
+        self._check_generation(conn)
+        with self._lock:
+            if rfid in self._entries:
+                self._entries.move_to_end(rfid)
+                metrics.rfid_cache_lookups.inc('hit')
+                return self._entries[rfid]
+            epoch = self._epoch
+
+        metrics.rfid_cache_lookups.inc('miss')
+        row = conn.execute('SELECT role, name FROM user WHERE rfid = ?', (rfid,)).fetchone()
+        user = CachedUser(row['role'], row['name']) if row else None
+        with self._lock:
+            if epoch == self._epoch and rfid not in self._entries:
+                self._entries[rfid] = user
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, rfid):
+        with self._lock:
+            self._entries.pop(rfid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _check_generation(self, conn):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        row = conn.execute("SELECT value FROM cache_generation WHERE name = 'user'").fetchone()
+        generation = row[0] if row else None
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
@@ -1,63 +1,46 @@
-import sqlite3
-import os
+import argparse
+import random
+import time
 from datetime import datetime, timedelta
 import math
 
-def format_duration(seconds):
-    """Convert seconds to hours and minutes format"""
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
-    
-    if hours == 0:
-        if minutes == 0:
-            return f"{seconds} second{'s' if seconds != 1 else ''}"
-        return f"{minutes} minute{'s' if minutes != 1 else ''} {seconds} second{'s' if seconds != 1 else ''}"
-    return f"{hours} hour{'s' if hours != 1 else ''} {minutes} minute{'s' if minutes != 1 else ''}"
-
-def calculate_parking_charge(seconds):
-    """Calculate parking charge based on duration in seconds"""
-    hours = seconds / 3600
-    # First hour or part thereof: ₹50
-    # Each additional hour or part thereof: ₹50
-    if hours <= 1:
-        return 50
-    # Round up to nearest hour
-    rounded_hours = math.ceil(hours)
-    return 50 + ((rounded_hours - 1) * 50)
+import billing
+import db
+import lots
+import migrations
+import tariff
+import timestamps
 
 def add_sample_data():
-    # Ensure database directory exists
-    if not os.path.exists('database'):
-        os.makedirs('database')
-    
-    conn = sqlite3.connect('database/db.sqlite3')
+    conn = db.open_connection()
     cur = conn.cursor()
 
     try:
         # Add sample parking logs for the user (RFID: 1)
         now = datetime.now()
+        first_in = timestamps.from_datetime(now - timedelta(days=2, minutes=15))
+        third_in = timestamps.from_datetime(now - timedelta(hours=2, minutes=35))
         user_logs = [
             # First log: 15 minutes parking, paid (₹50)
             ('1', 
-             (now - timedelta(days=2, minutes=15)).strftime("%Y-%m-%d %H:%M:%S"),
-             (now - timedelta(days=2)).strftime("%Y-%m-%d %H:%M:%S"),
-             format_duration(15 * 60),  # 15 minutes in seconds
-             calculate_parking_charge(15 * 60)),  # ₹50 (first hour or part thereof)
+             first_in,
+             timestamps.from_datetime(now - timedelta(days=2)),
+             15 * 60,  # 15 minutes in seconds
+             tariff.charge(15 * 60, first_in, 'user')),  # ₹50 (first hour or part thereof)
             
             # Second log: 1 hour 15 minutes parking, unpaid
             ('1',
-             (now - timedelta(days=1, hours=1, minutes=15)).strftime("%Y-%m-%d %H:%M:%S"),
-             (now - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"),
-             format_duration(75 * 60),  # 1 hour 15 minutes in seconds
+             timestamps.from_datetime(now - timedelta(days=1, hours=1, minutes=15)),
+             timestamps.from_datetime(now - timedelta(days=1)),
+             75 * 60,  # 1 hour 15 minutes in seconds
              0.00),  # Unpaid (should be ₹100)
             
             # Third log: 2 hours 35 minutes parking, paid
             ('1',
-             (now - timedelta(hours=2, minutes=35)).strftime("%Y-%m-%d %H:%M:%S"),
-             now.strftime("%Y-%m-%d %H:%M:%S"),
-             format_duration(155 * 60),  # 2 hours 35 minutes in seconds
-             calculate_parking_charge(155 * 60))  # ₹150 (₹50 + ₹50 + ₹50)
+             third_in,
+             timestamps.from_datetime(now),
+             155 * 60,  # 2 hours 35 minutes in seconds
+             tariff.charge(155 * 60, third_in, 'user'))  # ₹150 (₹50 + ₹50 + ₹50)
         ]
 
         # Add parking logs
@@ -67,16 +50,8 @@ def add_sample_data():
                 VALUES (?, ?, ?, ?, ?)
             """, log)
 
-        # Update user's amount based on paid logs
-        cur.execute("""
-            UPDATE user 
-            SET amount = (
-                SELECT COALESCE(SUM(amount), 0)
-                FROM logs
-                WHERE logs.rfid = user.rfid
-            )
-            WHERE rfid = '1'
-        """)
+        # Bring the user's billing totals up to date with the new logs
+        billing.rebuild(cur, '1')
         
         conn.commit()
         print("Sample data added successfully!")
@@ -86,5 +61,141 @@ def add_sample_data():
     finally:
         conn.close()
 
+# Bulk synthetic history for capacity planning and benchmarks. Everything
+# random comes from one seeded generator, so the same arguments always produce
+# the same rows.
+
+# Relative arrival rate for each hour of the day: morning and evening peaks
+HOURLY_PROFILE = [
+    0.2, 0.1, 0.1, 0.1, 0.2, 0.5, 1.5, 4.0, 6.0, 5.0, 3.0, 2.5,
+    3.0, 2.5, 2.0, 2.0, 2.5, 3.5, 4.0, 3.0, 2.0, 1.2, 0.6, 0.3,
+]
+
+def _poisson(rng, mean):
+    # Normal approximation is plenty for the daily volumes we generate
+    if mean > 30:
+        return max(0, int(round(rng.gauss(mean, math.sqrt(mean)))))
+    limit, k, p = math.exp(-mean), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
+
+def generate_sessions(rng, rfids, days, end, visits_per_day, dwell_median_minutes,
+                      dwell_sigma, paid_ratio):
+    """Yield (rfid, in_time, out_time, duration, amount, payment_status) in in_time order"""
+    end_ts = timestamps.from_datetime(end)
+    start_day = end - timedelta(days=days)
+    mu = math.log(dwell_median_minutes * 60)
+    hours = list(range(24))
+    open_rfids = set()
+
+    for day in range(days):
+        day_start = timestamps.from_datetime(start_day + timedelta(days=day))
+        count = _poisson(rng, visits_per_day)
+        arrivals = sorted(
+            rng.choices(hours, HOURLY_PROFILE)[0] * 3600 + rng.randrange(3600)
+            for _ in range(count)
+        )
+        for offset in arrivals:
+            in_ts = day_start + offset
+            if in_ts >= end_ts:
+                break
+            dwell = int(min(max(rng.lognormvariate(mu, dwell_sigma), 60), 24 * 3600))
+            rfid = rng.choice(rfids)
+            out_ts = in_ts + dwell
+
+            if out_ts > end_ts:
+                # Still parked at the end of the generated period; a card
+                # can only have one open session
+                if rfid in open_rfids:
+                    continue
+                open_rfids.add(rfid)
+                yield (rfid, in_ts, None, None, None, 'unpaid')
+                continue
+
+            amount = tariff.charge(dwell, in_ts, 'user')
+            status = 'paid' if rng.random() < paid_ratio else 'unpaid'
+            yield (rfid, in_ts, out_ts, dwell, amount, status)
+
+def generate_bulk_data(users=2000, slots=8, days=90, seed=1, end=None,
+                       visits_per_day=None, dwell_median_minutes=90, dwell_sigma=0.9,
+                       paid_ratio=0.85, chunk_size=50000, conn=None):
+    """Write a reproducible multi-month parking history; returns rows written"""
+    rng = random.Random(seed)
+    end = end or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if visits_per_day is None:
+        # Roughly one visit per user every other working day
+        visits_per_day = users * 0.4
+
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+    migrations.migrate(conn)
+
+    # Durability doesn't matter while loading a throwaway dataset
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-200000')
+
+    try:
+        rfids = [f'U{i:06d}' for i in range(1, users + 1)]
+        with db.transaction(conn):
+            conn.executemany("INSERT OR IGNORE INTO user (rfid, name, role) VALUES (?, ?, 'user')",
+                             [(rfid, f'User {rfid[1:].lstrip("0")}') for rfid in rfids])
+            lots.ensure_lot(conn.cursor(), lots.DEFAULT_LOT, slots=slots)
+
+        sessions = generate_sessions(rng, rfids, days, end, visits_per_day,
+                                     dwell_median_minutes, dwell_sigma, paid_ratio)
+        written = 0
+        started = time.perf_counter()
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), sessions)]
+            if not chunk:
+                break
+            with db.transaction(conn):
+                conn.executemany("""
+                    INSERT INTO logs (rfid, in_time, out_time, duration, amount, payment_status)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, chunk)
+            written += len(chunk)
+            print(f"{written} logs written ({written / (time.perf_counter() - started):.0f} rows/s)")
+
+        with db.transaction(conn):
+            billing.rebuild(conn.cursor())
+        return written
+    finally:
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if own_conn:
+            conn.close()
+
 if __name__ == '__main__':
-    add_sample_data() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Add sample parking data")
+    parser.add_argument('--bulk', action='store_true',
+                        help="generate a large synthetic history instead of three sample logs")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--slots', type=int, default=8)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--end', help="last day of history, YYYY-MM-DD (default: today); "
+                                      "pin it to get identical datasets on different days")
+    parser.add_argument('--visits-per-day', type=float,
+                        help="mean sessions per day (default: 0.4 per user)")
+    parser.add_argument('--dwell-median', type=float, default=90,
+                        help="median parking time in minutes")
+    parser.add_argument('--dwell-sigma', type=float, default=0.9,
+                        help="spread of the log-normal parking time")
+    parser.add_argument('--paid-ratio', type=float, default=0.85,
+                        help="share of finished sessions that are paid")
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    if args.bulk:
+        end = datetime.strptime(args.end, "%Y-%m-%d") if args.end else None
+        generate_bulk_data(users=args.users, slots=args.slots, days=args.days, seed=args.seed,
+                           end=end, visits_per_day=args.visits_per_day,
+                           dwell_median_minutes=args.dwell_median, dwell_sigma=args.dwell_sigma,
+                           paid_ratio=args.paid_ratio, chunk_size=args.chunk_size)
+    else:
+        add_sample_data()
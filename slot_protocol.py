@@ -0,0 +1,111 @@
+import struct
+
+from occupancy import FREE, OCCUPIED
+
+# Slot status payloads on parking/slots and parking/<lot>/slots.
+#
+# Legacy text, one sensor per message:
+#
+#     3:occupied
+#
+# Compact (version 1), any number of sensors per message, big-endian:
+#
+#     u8   version (1)
+#     u8   encoding: 0 = bitmap, 1 = list
+#   bitmap - every slot in a contiguous range:
+#     u16  first slot id
+#     u16  slot count n
+#     ceil(n / 8) bytes: slot first + i is bit i % 8 of byte i // 8, 1 = occupied
+#   list - only the slots given:
+#     u16  entry count m
+#     m x u16: slot id in the low 15 bits, top bit set = occupied
+#
+# A controller publishes a list of the sensors that changed as they change,
+# and its full state (bitmap or list) as a periodic heartbeat. A legacy
+# payload always starts with an ASCII digit, so the first byte tells the
+# formats apart.
+
+VERSION = 1
+BITMAP = 0
+LIST = 1
+MAX_SLOT = 0x7FFF
+
+_HEADER = struct.Struct('>BB')
+_RANGE = struct.Struct('>HH')
+_COUNT = struct.Struct('>H')
+
+# Byte value -> offsets of its set bits, so a bitmap is decoded a byte at a time
+_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+# The only statuses a sensor reports; anything else in a text payload is
+# rejected here, so it never reaches the occupancy table or the database
+STATUSES = (FREE, OCCUPIED)
+
+
+def is_compact(payload):
+    return payload[:1] == bytes([VERSION])
+
+
+def decode(payload):
+    """[(slot_id, status)] from a legacy or compact payload (bytes)
+
+    Raises ValueError if the payload is malformed or has a status other
+    than free or occupied.
+    """
+    if not is_compact(payload):
+        try:
+            slot, status = payload.decode().split(':')
+            slot = int(slot)
+        except (UnicodeDecodeError, ValueError):
+            raise ValueError(f"not a slot status message: {payload[:32]!r}")
+        if status not in STATUSES:
+            raise ValueError(f"unknown slot status {status[:32]!r}")
+        return [(slot, status)]
+
+    if len(payload) < _HEADER.size:
+        raise ValueError("truncated header")
+    _, encoding = _HEADER.unpack_from(payload)
+    body = memoryview(payload)[_HEADER.size:]
+    if encoding == BITMAP:
+        if len(body) < _RANGE.size:
+            raise ValueError("truncated bitmap header")
+        first, count = _RANGE.unpack_from(body)
+        bitmap = body[_RANGE.size:]
+        if len(bitmap) != (count + 7) // 8:
+            raise ValueError(f"bitmap of {len(bitmap)} bytes for {count} slots")
+        readings = [(slot, FREE) for slot in range(first, first + count)]
+        for index, value in enumerate(bitmap):
+            base = index * 8
+            for bit in _BITS[value]:
+                if base + bit < count:
+                    readings[base + bit] = (first + base + bit, OCCUPIED)
+        return readings
+    if encoding == LIST:
+        if len(body) < _COUNT.size:
+            raise ValueError("truncated list header")
+        count, = _COUNT.unpack_from(body)
+        if len(body) != _COUNT.size + 2 * count:
+            raise ValueError(f"list of {(len(body) - _COUNT.size) // 2} entries, expected {count}")
+        entries = struct.unpack_from(f'>{count}H', body, _COUNT.size)
+        return [(entry & MAX_SLOT, OCCUPIED if entry & 0x8000 else FREE) for entry in entries]
+    raise ValueError(f"unknown encoding {encoding}")
+
+
+def encode_bitmap(first, statuses):
+    """Compact payload for slots first, first + 1, ... with the given statuses"""
+    bitmap = bytearray((len(statuses) + 7) // 8)
+    for i, status in enumerate(statuses):
+        if status == OCCUPIED:
+            bitmap[i // 8] |= 1 << i % 8
+    return _HEADER.pack(VERSION, BITMAP) + _RANGE.pack(first, len(statuses)) + bytes(bitmap)
+
+
+def encode_list(readings):
+    """Compact payload for [(slot_id, status)]"""
+    entries = []
+    for slot, status in readings:
+        if not 0 <= slot <= MAX_SLOT:
+            raise ValueError(f"slot id {slot} out of range")
+        entries.append(slot | (0x8000 if status == OCCUPIED else 0))
+    return (_HEADER.pack(VERSION, LIST) + _COUNT.pack(len(entries))
+            + struct.pack(f'>{len(entries)}H', *entries))
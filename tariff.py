@@ -0,0 +1,280 @@
+"""Parking tariffs: pricing rules, live pricing and batch re-billing
+
+Rules come from the JSON file named by PARKING_TARIFF; without one the
+original flat rate applies (₹50 per started hour, minimum one hour).
+
+    {
+        "hourly_rate": 50,
+        "night_rate": 30, "night_start": 22, "night_end": 6,
+        "grace_minutes": 10,
+        "daily_cap": 600,
+        "roles": {"staff": {"hourly_rate": 20, "daily_cap": 200}}
+    }
+
+Every started hour of a stay is charged at the rate of the local hour it
+starts in. The daily cap applies to each 24 hours from arrival. Stays no
+longer than the grace period are free. Role entries override the defaults
+for cards with that role.
+
+Re-bill closed sessions after changing the rules:
+
+    python tariff.py --from 2026-01-01 --to 2026-02-01
+    python tariff.py --from 2026-01-01 --to 2026-02-01 --include-paid --dry-run
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import analytics
+import billing
+import db
+import migrations
+import timestamps
+
+TARIFF_PATH = os.environ.get('PARKING_TARIFF')
+
+# Sessions priced and updated per transaction by rebill(), and the pause
+# between chunks that lets gate traffic take the write lock
+REBILL_CHUNK_SIZE = 20000
+REBILL_PAUSE = 0.01
+
+_RULE_KEYS = ('hourly_rate', 'night_rate', 'night_start', 'night_end',
+              'grace_minutes', 'daily_cap', 'utc_offset_minutes')
+
+
+class Tariff:
+    """One set of pricing rules"""
+
+    def __init__(self, hourly_rate=50, night_rate=None, night_start=22, night_end=6,
+                 grace_minutes=0, daily_cap=None, utc_offset_minutes=None):
+        self.hourly_rate = hourly_rate
+        self.night_rate = hourly_rate if night_rate is None else night_rate
+        self.night_start = night_start
+        self.night_end = night_end
+        self.grace_minutes = grace_minutes
+        self.daily_cap = daily_cap
+        # Fixed offset used to find the local hour of arrival; daylight saving
+        # changes are not modelled. Defaults to this machine's current offset.
+        if utc_offset_minutes is None:
+            utc_offset_minutes = time.localtime().tm_gmtoff // 60
+        self.utc_offset_minutes = utc_offset_minutes
+
+        night = [self._is_night(hour) for hour in range(24)]
+        # _night_before[k]: night hours among k consecutive hours from midnight,
+        # over two days so any 24-hour window starting today can be looked up
+        self._night_before = [0]
+        for k in range(48):
+            self._night_before.append(self._night_before[-1] + night[k % 24])
+        self._night_hours = self._night_before[24]
+        day_total = (self._night_hours * self.night_rate
+                     + (24 - self._night_hours) * self.hourly_rate)
+        self._full_day = day_total if daily_cap is None else min(daily_cap, day_total)
+
+    def _is_night(self, hour):
+        if self.night_start <= self.night_end:
+            return self.night_start <= hour < self.night_end
+        return hour >= self.night_start or hour < self.night_end
+
+    def charge(self, duration, in_time):
+        """Price one stay of `duration` seconds that began at epoch `in_time`"""
+        if self.grace_minutes and duration <= self.grace_minutes * 60:
+            return 0
+        hours = max(1, -(-duration // 3600))
+        full_days, rest = divmod(hours, 24)
+        first = (in_time + self.utc_offset_minutes * 60) % 86400 // 3600
+        night = self._night_before[first + rest] - self._night_before[first]
+        rest_charge = night * self.night_rate + (rest - night) * self.hourly_rate
+        if self.daily_cap is not None:
+            rest_charge = min(self.daily_cap, rest_charge)
+        return full_days * self._full_day + rest_charge
+
+    def charge_many(self, durations, in_times):
+        """charge() over NumPy arrays of durations and start times"""
+        import numpy as np
+
+        durations = np.asarray(durations, dtype=np.int64)
+        in_times = np.asarray(in_times, dtype=np.int64)
+        hours = np.maximum(1, -(-durations // 3600))
+        full_days, rest = np.divmod(hours, 24)
+        first = (in_times + self.utc_offset_minutes * 60) % 86400 // 3600
+        night_before = np.asarray(self._night_before, dtype=np.int64)
+        night = night_before[first + rest] - night_before[first]
+        rest_charge = night * self.night_rate + (rest - night) * self.hourly_rate
+        if self.daily_cap is not None:
+            rest_charge = np.minimum(self.daily_cap, rest_charge)
+        charges = full_days * self._full_day + rest_charge
+        if self.grace_minutes:
+            charges = np.where(durations <= self.grace_minutes * 60, 0, charges)
+        return charges.astype(np.float64)
+
+
+class Tariffs:
+    """The default tariff plus per-role overrides"""
+
+    def __init__(self, default=None, roles=None):
+        self.default = default or Tariff()
+        self.roles = roles or {}
+
+    @classmethod
+    def from_dict(cls, config):
+        base = {key: config[key] for key in _RULE_KEYS if key in config}
+        roles = {}
+        for role, overrides in config.get('roles', {}).items():
+            unknown = set(overrides) - set(_RULE_KEYS)
+            if unknown:
+                raise ValueError(f"Unknown tariff rule(s) for role {role}: {', '.join(sorted(unknown))}")
+            roles[role] = Tariff(**dict(base, **overrides))
+        unknown = set(config) - set(_RULE_KEYS) - {'roles'}
+        if unknown:
+            raise ValueError(f"Unknown tariff rule(s): {', '.join(sorted(unknown))}")
+        return cls(Tariff(**base), roles)
+
+    def for_role(self, role):
+        return self.roles.get(role, self.default)
+
+    def charge(self, duration, in_time, role=None):
+        return self.for_role(role).charge(duration, in_time)
+
+    def charge_many(self, durations, in_times, roles=None):
+        """Price many stays at once; `roles` is a matching sequence or None"""
+        import numpy as np
+
+        if roles is None or not self.roles:
+            return self.default.charge_many(durations, in_times)
+        durations = np.asarray(durations, dtype=np.int64)
+        in_times = np.asarray(in_times, dtype=np.int64)
+        roles = np.asarray(roles, dtype=object)
+        charges = self.default.charge_many(durations, in_times)
+        for role, tariff in self.roles.items():
+            mask = roles == role
+            if mask.any():
+                charges[mask] = tariff.charge_many(durations[mask], in_times[mask])
+        return charges
+
+
+def load(path=None):
+    """Read tariffs from a JSON file; no path means the flat default rate"""
+    path = path or TARIFF_PATH
+    if not path:
+        return Tariffs()
+    with open(path) as f:
+        return Tariffs.from_dict(json.load(f))
+
+
+_current = None
+
+
+def current():
+    """The tariffs in force, loaded on first use"""
+    global _current
+    if _current is None:
+        _current = load()
+    return _current
+
+
+def charge(duration, in_time, role=None):
+    """Price one stay with the tariffs in force"""
+    return current().charge(duration, in_time, role)
+
+
+def _price_chunk(tariffs, rows):
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return [tariffs.charge(row['duration'], row['in_time'], row['role']) for row in rows]
+    return tariffs.charge_many([row['duration'] for row in rows],
+                               [row['in_time'] for row in rows],
+                               [row['role'] for row in rows]).tolist()
+
+
+def rebill(start, end, tariffs=None, include_paid=False, dry_run=False,
+           chunk_size=REBILL_CHUNK_SIZE, conn=None):
+    """Re-price closed sessions that began in [start, end) epoch seconds
+
+    Works through the range in chunks, one short transaction each, so gates
+    keep running. Paid sessions are left alone unless include_paid is set.
+    Users' billing totals and the revenue in the exit's analytics rollups
+    are adjusted by the difference in the same transaction. Returns
+    (sessions priced, sessions whose amount changed).
+    """
+    tariffs = tariffs or current()
+    own_conn = conn is None
+    if own_conn:
+        conn = db.open_connection()
+    migrations.migrate(conn)
+
+    paid_filter = '' if include_paid else "AND COALESCE(logs.payment_status, 'unpaid') = 'unpaid'"
+    last = (start, 0)
+    priced = changed = 0
+    try:
+        while True:
+            with db.transaction(conn):
+                rows = conn.execute(f'''
+                    SELECT logs.id, logs.rfid, logs.in_time, logs.out_time, logs.duration,
+                           logs.amount, logs.payment_status, logs.lot_id, user.role
+                    FROM logs
+                    LEFT JOIN user ON logs.rfid = user.rfid
+                    WHERE (logs.in_time, logs.id) > (?, ?) AND logs.in_time < ?
+                      AND logs.out_time IS NOT NULL {paid_filter}
+                    ORDER BY logs.in_time, logs.id
+                    LIMIT ?
+                ''', (last[0], last[1], end, chunk_size)).fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                deltas = {}
+                revenue = []
+                for row, amount in zip(rows, _price_chunk(tariffs, rows)):
+                    if row['amount'] == amount:
+                        continue
+                    updates.append((amount, row['id']))
+                    paid, outstanding = deltas.get(row['rfid'], (0, 0))
+                    delta = amount - (row['amount'] or 0)
+                    revenue.append((row['lot_id'], row['out_time'], delta))
+                    if row['payment_status'] == 'paid':
+                        paid += delta
+                    else:
+                        outstanding += delta
+                    deltas[row['rfid']] = (paid, outstanding)
+
+                if updates and not dry_run:
+                    conn.executemany('UPDATE logs SET amount = ? WHERE id = ?', updates)
+                    cur = conn.cursor()
+                    for rfid, (paid, outstanding) in deltas.items():
+                        billing.adjust(cur, rfid, paid, outstanding)
+                    for lot_id, out_time, delta in revenue:
+                        analytics.adjust_revenue(cur, lot_id, out_time, delta)
+
+            priced += len(rows)
+            changed += len(updates)
+            last = (rows[-1]['in_time'], rows[-1]['id'])
+            print(f"Priced {priced} sessions, {changed} changed")
+            time.sleep(REBILL_PAUSE)
+        return priced, changed
+    finally:
+        if own_conn:
+            conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-bill closed parking sessions with the current tariff")
+    parser.add_argument('--from', dest='start', required=True,
+                        help="first day to re-bill, YYYY-MM-DD (local time)")
+    parser.add_argument('--to', dest='end', required=True,
+                        help="day after the last one to re-bill, YYYY-MM-DD")
+    parser.add_argument('--tariff', help="rules file (default: $PARKING_TARIFF or the flat rate)")
+    parser.add_argument('--include-paid', action='store_true',
+                        help="also re-price sessions that were already paid")
+    parser.add_argument('--dry-run', action='store_true', help="count changes without writing them")
+    parser.add_argument('--chunk-size', type=int, default=REBILL_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    start = timestamps.from_datetime(datetime.strptime(args.start, "%Y-%m-%d"))
+    end = timestamps.from_datetime(datetime.strptime(args.end, "%Y-%m-%d"))
+    priced, changed = rebill(start, end, load(args.tariff), args.include_paid,
+                             args.dry_run, args.chunk_size)
+    action = "would change" if args.dry_run else "changed"
+    print(f"Re-billed {priced} sessions; {action} {changed} amounts")
@@ -0,0 +1,37 @@
+import time
+from datetime import datetime
+
+# logs.in_time and logs.out_time hold UTC epoch seconds and logs.duration holds
+# seconds. They are only turned into readable local time when rendered.
+
+DISPLAY_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def now():
+    """Current time as UTC epoch seconds"""
+    return int(time.time())
+
+
+def format_timestamp(ts, default='N/A'):
+    """Epoch seconds -> local time text for display"""
+    if ts is None:
+        return default
+    return datetime.fromtimestamp(ts).strftime(DISPLAY_FORMAT)
+
+
+def from_datetime(dt):
+    """Naive local datetime -> epoch seconds"""
+    return int(dt.timestamp())
+
+
+def format_duration(seconds):
+    """Convert seconds to hours and minutes format"""
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    seconds = seconds % 60
+
+    if hours == 0:
+        if minutes == 0:
+            return f"{seconds} second{'s' if seconds != 1 else ''}"
+        return f"{minutes} minute{'s' if minutes != 1 else ''} {seconds} second{'s' if seconds != 1 else ''}"
+    return f"{hours} hour{'s' if hours != 1 else ''} {minutes} minute{'s' if minutes != 1 else ''}"
@@ -0,0 +1,146 @@
+"""Bulk user import from CSV
+
+    rfid,name,role
+    F1001,Fleet van 1,user
+
+role is optional and defaults to user. New cards are added and known ones
+take the file's name and role. Rows are written CHUNK_SIZE at a time, one
+transaction each, so a fleet of tens of thousands of cards costs a few
+commits. Rows that can't be imported are reported with their line number
+and skipped; the rest of the file still goes in.
+
+    python user_import.py fleet.csv
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+
+import db
+import migrations
+
+CHUNK_SIZE = 5000
+ROLES = ('user', 'owner')
+
+# Row errors kept in a result; error_count covers all of them
+MAX_ERRORS = 100
+
+# Rows whose name and role already match are left alone, so they don't
+# count as updated or bump the user cache generation
+_UPSERT = '''
+    INSERT INTO user (rfid, name, role) VALUES (?, ?, ?)
+    ON CONFLICT (rfid) DO UPDATE SET name = excluded.name, role = excluded.role
+    WHERE name IS NOT excluded.name OR role IS NOT excluded.role
+'''
+
+
+def _error(result, line, rfid, message):
+    result['error_count'] += 1
+    if len(result['errors']) < MAX_ERRORS:
+        result['errors'].append({'line': line, 'rfid': rfid, 'error': message})
+
+
+def _write(conn, chunk, result):
+    """Upsert (line, rfid, name, role) rows in one transaction"""
+    with db.transaction(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT rfid FROM user WHERE rfid IN (SELECT value FROM json_each(?))",
+                    (json.dumps([row[1] for row in chunk]),))
+        existing = {row[0] for row in cur.fetchall()}
+        cur.execute('SAVEPOINT import_chunk')
+        try:
+            cur.executemany(_UPSERT, [row[1:] for row in chunk])
+            written = chunk
+            changed = cur.rowcount
+        except sqlite3.Error:
+            # Find the rows at fault one by one
+            cur.execute('ROLLBACK TO import_chunk')
+            written, changed = [], 0
+            for row in chunk:
+                try:
+                    cur.execute(_UPSERT, row[1:])
+                except sqlite3.Error as e:
+                    _error(result, row[0], row[1], str(e))
+                    continue
+                written.append(row)
+                changed += cur.rowcount
+        cur.execute('RELEASE import_chunk')
+
+    added = sum(1 for row in written if row[1] not in existing)
+    result['added'] += added
+    result['updated'] += changed - added
+    result['unchanged'] += len(written) - changed
+
+
+def import_users(conn, lines, chunk_size=CHUNK_SIZE):
+    """Add or update the users in CSV text lines (any iterable, e.g. an open file)
+
+    Returns counts of users added, updated and unchanged, with the first
+    MAX_ERRORS row errors. Raises ValueError if the header has no rfid or
+    name column.
+    """
+    result = {'added': 0, 'updated': 0, 'unchanged': 0, 'error_count': 0, 'errors': []}
+    reader = csv.reader(lines)
+    header = [column.strip().lower() for column in next(reader, [])]
+    if 'rfid' not in header or 'name' not in header:
+        raise ValueError("CSV header must have rfid and name columns")
+    rfid_at, name_at = header.index('rfid'), header.index('name')
+    role_at = header.index('role') if 'role' in header else None
+
+    seen = {}
+    chunk = []
+    while True:
+        try:
+            row = next(reader, None)
+        except (csv.Error, UnicodeDecodeError) as e:
+            # The reader can't go on past this
+            _error(result, reader.line_num, None, f"unreadable CSV: {str(e)}")
+            break
+        if row is None:
+            break
+        if not any(cell.strip() for cell in row):
+            continue
+        line = reader.line_num
+        cells = row + [''] * (len(header) - len(row))
+        rfid, name = cells[rfid_at].strip(), cells[name_at].strip()
+        role = (cells[role_at].strip().lower() if role_at is not None else '') or 'user'
+        if not rfid:
+            _error(result, line, None, "rfid is empty")
+        elif not name:
+            _error(result, line, rfid, "name is empty")
+        elif role not in ROLES:
+            _error(result, line, rfid, f"role must be one of {', '.join(ROLES)}")
+        elif rfid in seen:
+            _error(result, line, rfid, f"duplicate of line {seen[rfid]}")
+        else:
+            seen[rfid] = line
+            chunk.append((line, rfid, name, role))
+            if len(chunk) >= chunk_size:
+                _write(conn, chunk, result)
+                chunk = []
+    if chunk:
+        _write(conn, chunk, result)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add or update users from a CSV file")
+    parser.add_argument('path', help="CSV with rfid, name and optional role columns")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="rows per transaction")
+    args = parser.parse_args()
+
+    conn = db.open_connection()
+    try:
+        migrations.migrate(conn)
+        with open(args.path, encoding='utf-8-sig', newline='') as f:
+            result = import_users(conn, f, args.chunk_size)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    finally:
+        conn.close()
+    for error in result['errors']:
+        print(f"line {error['line']}: {error['error']}")
+    print(f"{result['added']} added, {result['updated']} updated, {result['unchanged']} unchanged, "
+          f"{result['error_count']} row(s) skipped")
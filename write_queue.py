@@ -0,0 +1,219 @@
+import os
+import queue
+import threading
+import time
+
+import db
+import metrics
+
+# Write-behind persistence for the MQTT handler. Callers hand writes to a
+# bounded queue and return straight away; one writer thread drains it and
+# commits each batch in a single transaction, so a burst of messages costs one
+# fsync instead of one per message.
+
+BATCH_SIZE = int(os.environ.get('PARKING_WRITE_BATCH_SIZE', '200'))
+MAX_LATENCY_MS = int(os.environ.get('PARKING_WRITE_MAX_LATENCY_MS', '50'))
+QUEUE_SIZE = int(os.environ.get('PARKING_WRITE_QUEUE_SIZE', '10000'))
+# How long put() blocks on a full queue before the write is dropped
+PUT_TIMEOUT_MS = int(os.environ.get('PARKING_WRITE_PUT_TIMEOUT_MS', '1000'))
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Bounded queue of writes applied in batches by a dedicated thread
+
+    `handlers` maps an operation kind to a function(cur, *args) that performs
+    it. Kinds listed in `coalesce` are "latest value wins" per key: only the
+    last queued write for a key in a batch is applied, after the batch's other
+    writes. Everything else is applied in the order it was queued.
+    """
+
+    def __init__(self, handlers, coalesce=(), batch_size=BATCH_SIZE,
+                 max_latency_ms=MAX_LATENCY_MS, maxsize=QUEUE_SIZE,
+                 put_timeout_ms=PUT_TIMEOUT_MS):
+        self.handlers = handlers
+        self.coalesce = set(coalesce)
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.put_timeout = put_timeout_ms / 1000
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._counters = {
+            'enqueued': 0,
+            'blocked': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'max_depth': 0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Flush everything still queued and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, kind, key, *args, wait=False):
+        """Queue a write; returns False if it was dropped because the queue stayed full
+
+        With wait=True it blocks until there is room instead, for writes that
+        must never be lost.
+        """
+        item = (kind, key, args)
+        tracked = kind not in self.coalesce
+        if tracked:
+            # Counted before the writer thread can see the item, so its flush
+            # always finds the count to take back
+            with self._lock:
+                self._pending[(kind, key)] = self._pending.get((kind, key), 0) + 1
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count('blocked')
+            try:
+                self._queue.put(item, timeout=None if wait else self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self._counters['dropped'] += 1
+                    if tracked:
+                        self._release((kind, key))
+                print(f"Write queue full, dropped {kind} write for {key}")
+                return False
+
+        with self._lock:
+            self._counters['enqueued'] += 1
+            depth = self._queue.qsize()
+            if depth > self._counters['max_depth']:
+                self._counters['max_depth'] = depth
+        return True
+
+    def after_commit(self, fn):
+        """Call fn() on the writer thread once everything queued before it is committed
+
+        Also called if those writes failed, or straight away if the queue
+        stays full.
+        """
+        try:
+            self._queue.put((None, None, fn), timeout=self.put_timeout)
+        except queue.Full:
+            fn()
+
+    def pending(self, kind, key):
+        """Number of queued, not yet committed writes of `kind` for `key`"""
+        with self._lock:
+            return self._pending.get((kind, key), 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['depth'] = self._queue.qsize()
+        return stats
+
+    def _release(self, pending_key):
+        """Take one write off the pending count; call with _lock held"""
+        remaining = self._pending.get(pending_key, 0) - 1
+        if remaining > 0:
+            self._pending[pending_key] = remaining
+        else:
+            self._pending.pop(pending_key, None)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+
+        # Drain whatever was queued behind the stop marker
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        ordered = []
+        latest = {}
+        callbacks = []
+        for kind, key, args in batch:
+            if kind is None:
+                callbacks.append(args)
+            elif kind in self.coalesce:
+                if (kind, key) in latest:
+                    self._count('coalesced')
+                latest[(kind, key)] = (kind, key, args)
+            else:
+                ordered.append((kind, key, args))
+        ops = ordered + list(latest.values())
+        if ops:
+            self._write(ops)
+
+        with self._lock:
+            if ops:
+                self._counters['batches'] += 1
+            for kind, key, args in ordered:
+                self._release((kind, key))
+
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Error in after-commit callback: {str(e)}")
+
+    def _write(self, ops):
+        with db.connection() as conn, metrics.track_db('write_queue'):
+            try:
+                with db.transaction(conn):
+                    cur = conn.cursor()
+                    for kind, key, args in ops:
+                        self.handlers[kind](cur, *args)
+                self._count('written', len(ops))
+            except Exception as e:
+                # Retry one by one so a single bad write doesn't lose the batch
+                print(f"Error writing batch of {len(ops)}, retrying individually: {str(e)}")
+                for kind, key, args in ops:
+                    try:
+                        with db.transaction(conn):
+                            self.handlers[kind](conn.cursor(), *args)
+                        self._count('written')
+                    except Exception as e:
+                        print(f"Error writing {kind} for {key}: {str(e)}")
+                        self._count('failed')